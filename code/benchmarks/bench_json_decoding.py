@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Benchmark of the JSON decoders of json_decoding on crawl pages, reported as seconds per GB of input. As the
+simdjson decoder is lazy, time for decoding plus mapping the pages with map_page is reported as well. Without input
+files, synthetic pages are used."""
+import importlib
+import json
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create-db'))
+initial_load = importlib.import_module('1_initial_load')
+json_decoding = importlib.import_module('json_decoding')
+bench_page_mapping = importlib.import_module('bench_page_mapping')
+
+
+def read_lines(files: list[str], max_bytes: int) -> list[bytes]:
+    lines = []
+    size = 0
+    for file in files:
+        with open(file, 'rb') as f:
+            for line in f:
+                lines.append(line)
+                size += len(line)
+                if size >= max_bytes:
+                    return lines
+    return lines
+
+
+def seconds_per_gb(f, lines: list[bytes], size: int) -> float:
+    start = time.perf_counter()
+    for line in lines:
+        f(line)
+    return (time.perf_counter() - start) / size * 1024 ** 3
+
+
+@click.argument('files', nargs=-1)
+@click.option('-m', '--max-bytes', default=256 * 1024 ** 2, show_default=True, help="maximum number of bytes of input to read into memory")
+@click.option('-s', '--synthetic-pages', default=50, show_default=True, help="number of synthetic 500 tweet pages to use if no files are given")
+@click.command
+def bench_json_decoding(files: list[str], max_bytes: int, synthetic_pages: int):
+    """Measure decode time per GB of crawl pages for each installed JSON decoder"""
+    if files:
+        lines = read_lines(files, max_bytes)
+    else:
+        page = {'data': [bench_page_mapping.synthetic_tweet(i) for i in range(500)],
+                'includes': {'tweets': [bench_page_mapping.synthetic_tweet(500 + i) for i in range(100)],
+                             'users': [bench_page_mapping.synthetic_user(i) for i in range(400)]},
+                'meta': {'result_count': 500}}
+        lines = [json.dumps(page).encode('utf-8') + b'\n'] * synthetic_pages
+    size = sum(map(len, lines))
+    print(f"{len(lines)} pages, {size / 1024 ** 2:.1f} MiB")
+    print(f"{'decoder':10} {'decode s/GB':>12} {'decode+map s/GB':>16}")
+    for name in json_decoding.decoders:
+        try:
+            decoder = json_decoding.get_decoder(name)
+        except ImportError:
+            print(f"{name:10} {'not installed':>12}")
+            continue
+        decode = seconds_per_gb(decoder.decode, lines, size)
+        decode_map = seconds_per_gb(lambda line: initial_load.map_page(decoder.decode(line), True), lines, size)
+        print(f"{name:10} {decode:12.1f} {decode_map:16.1f}")
+
+
+if __name__ == '__main__':
+    bench_json_decoding()
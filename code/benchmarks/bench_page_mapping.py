@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Microbenchmark of mapping one page of API results to insert tuples: the dataclass based mapping load_db used
+to do versus map_page. Run from anywhere; the loader is imported from code/create-db."""
+import dataclasses
+import importlib
+import itertools
+import os
+import sys
+import timeit
+from dataclasses import dataclass, astuple
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create-db'))
+initial_load = importlib.import_module('1_initial_load')
+
+
+@dataclass
+class LegacyTweet:
+    ur_conversation_id: int | None
+    conversation_id: int | None
+    id: int | None
+    author_id: int | None
+    created_at: str | None
+    retweet_count: int | None
+    reply_count: int | None
+    like_count: int | None
+    quote_count: int | None
+    lang: str | None
+    text: str | None
+    in_reply_to: int | None
+    in_reply_to_user_id: int | None
+    quotes: int | None
+    retweet_of: int | None
+    error_short: str | None
+    error_detail: str | None
+    original: bool
+    hashtags: list[str] | None
+    urls: list[str] | None
+    mentions: list[int] | None
+
+    @classmethod
+    def map_tweet(cls, tweet: dict, original: bool, mentions_id_map: dict):
+        in_reply_to = None
+        in_reply_to_user_id = None
+        quotes = None
+        retweet_of = None
+        text = tweet['text']
+        hashtags = None
+        urls = None
+        mentions = None
+        if 'entities' in tweet:
+            if 'urls' in tweet['entities']:
+                urls = list()
+                urlmap = dict()
+                for url in tweet['entities']['urls']:
+                    if 'unwound_url' in url:
+                        urlmap[url['url']] = url['unwound_url']
+                        urls.append(url['unwound_url'])
+                    elif 'expanded_url' in url:
+                        urlmap[url['url']] = url['expanded_url']
+                        urls.append(url['expanded_url'])
+                    else:
+                        urls.append(url['url'])
+                for (ourl, nurl) in urlmap.items():
+                    text = text.replace(ourl, nurl)
+            if 'hashtags' in tweet['entities']:
+                hashtags = list(map(lambda hashtag: hashtag['tag'], tweet['entities']['hashtags']))
+            if 'mentions' in tweet['entities']:
+                mentions = list()
+                for mention in tweet['entities']['mentions']:
+                    mentions_id_map[mention['username']] = int(mention['id'])
+                    mentions.append(int(mention['id']))
+        if 'referenced_tweets' in tweet:
+            for ref_tweet in tweet['referenced_tweets']:
+                if ref_tweet['type'] == 'retweeted':
+                    retweet_of = int(ref_tweet['id'])
+                elif ref_tweet['type'] == 'replied_to':
+                    in_reply_to = int(ref_tweet['id'])
+                    in_reply_to_user_id = int(tweet['in_reply_to_user_id'])
+                else:
+                    quotes = int(ref_tweet['id'])
+        return cls(None, int(tweet['conversation_id']), int(tweet['id']), int(tweet['author_id']),
+                   tweet['created_at'][0:10] + ' ' + tweet['created_at'][11:18],
+                   int(tweet['public_metrics']['retweet_count']), int(tweet['public_metrics']['reply_count']),
+                   int(tweet['public_metrics']['like_count']), int(tweet['public_metrics']['quote_count']),
+                   tweet['lang'], text, in_reply_to, in_reply_to_user_id, quotes, retweet_of, None, None, original,
+                   hashtags, urls, mentions)
+
+    def as_tuple(self):
+        return tuple(getattr(self, field.name) if field.name != "hashtags" and field.name != "mentions" and field.name != "urls" or getattr(self, field.name) is None else len(getattr(self, field.name)) for field in dataclasses.fields(self))
+
+
+@dataclass
+class LegacyUser:
+    id: int
+    username: str | None
+    name: str | None
+    description: str | None
+    created_at: str | None
+    verified: bool | None
+    protected: bool | None
+    url: str | None
+    location: str | None
+    followers_count: int | None
+    following_count: int | None
+    tweet_count: int | None
+    listed_count: int | None
+    error_short: str | None
+    error_detail: str | None
+
+    @classmethod
+    def map_user(cls, user: dict):
+        url = user['url']
+        description = user['description']
+        if 'entities' in user:
+            urlmap = dict()
+            for field_entities in user['entities'].values():
+                if 'urls' in field_entities:
+                    for murl in field_entities['urls']:
+                        if 'expanded_url' in murl:
+                            urlmap[murl['url']] = murl['expanded_url']
+            for (ourl, nurl) in urlmap.items():
+                url = url.replace(ourl, nurl)
+                description = description.replace(ourl, nurl)
+        return cls(int(user['id']), user['username'], user['name'], description if description != '' else None,
+                   user['created_at'][0:10] + ' ' + user['created_at'][11:18], user['verified'], user['protected'],
+                   url if url != '' else None,
+                   user['location'] if 'location' in user and user['location'] != '' else None,
+                   user['public_metrics']['followers_count'], user['public_metrics']['following_count'],
+                   user['public_metrics']['tweet_count'], user['public_metrics']['listed_count'], None, None)
+
+
+def legacy_map_page(r: dict, original: bool) -> tuple[list, list, list, list, list]:
+    mentions_id_map = dict()
+    tweets = map(lambda tweet: LegacyTweet.map_tweet(tweet, original, mentions_id_map), r['data'])
+    if 'tweets' in r['includes']:
+        tweets = itertools.chain(tweets, map(lambda tweet: LegacyTweet.map_tweet(tweet, original, mentions_id_map), r['includes']['tweets']))
+    users = map(LegacyUser.map_user, r['includes']['users'])
+    tweets = list(tweets)
+    return ([tweet.as_tuple() for tweet in tweets],
+            list(itertools.chain.from_iterable(map(lambda tweet: map(lambda hashtag: (tweet.id, hashtag), tweet.hashtags), filter(lambda tweet: tweet.hashtags is not None, tweets)))),
+            list(itertools.chain.from_iterable(map(lambda tweet: map(lambda mention: (tweet.id, mention), tweet.mentions), filter(lambda tweet: tweet.mentions is not None, tweets)))),
+            list(itertools.chain.from_iterable(map(lambda tweet: map(lambda url: (tweet.id, url), tweet.urls), filter(lambda tweet: tweet.urls is not None, tweets)))),
+            list(map(lambda user: astuple(user), users)))
+
+
+def synthetic_tweet(i: int) -> dict:
+    short_urls = [f"https://t.co/a{i:08d}", f"https://t.co/b{i:08d}"]
+    text = f"@user{i % 97} replying about #convoy and #Ottawa {short_urls[0]} with more words to make it realistic {short_urls[1]}"
+    urls = []
+    for short_url in short_urls:
+        start = text.index(short_url)
+        urls.append({'start': start, 'end': start + len(short_url), 'url': short_url,
+                     'expanded_url': f"https://example.org/article/{i}/{short_url[-9:]}", 'display_url': 'example.org/…'})
+    return {
+        'id': str(1490000000000000000 + i),
+        'conversation_id': str(1490000000000000000 + i - i % 10),
+        'author_id': str(1000 + i % 331),
+        'created_at': '2022-02-05T12:34:56.000Z',
+        'lang': 'en',
+        'text': text,
+        'public_metrics': {'retweet_count': i % 7, 'reply_count': i % 3, 'like_count': i % 50, 'quote_count': i % 2},
+        'in_reply_to_user_id': str(1000 + (i - 1) % 331),
+        'referenced_tweets': [{'type': 'replied_to', 'id': str(1490000000000000000 + i - 1)}],
+        'entities': {
+            'urls': urls,
+            'hashtags': [{'start': 27, 'end': 34, 'tag': 'convoy'}, {'start': 39, 'end': 46, 'tag': 'Ottawa'}],
+            'mentions': [{'start': 0, 'end': 8, 'username': f"user{i % 97}", 'id': str(2000 + i % 97)}],
+        },
+    }
+
+
+def synthetic_user(i: int) -> dict:
+    return {'id': str(1000 + i), 'username': f"user{i}", 'name': f"User {i}", 'description': 'Just a user',
+            'created_at': '2010-01-01T00:00:00.000Z', 'verified': False, 'protected': False, 'url': '',
+            'location': 'Ottawa', 'public_metrics': {'followers_count': i, 'following_count': i, 'tweet_count': i, 'listed_count': 0}}
+
+
+@click.option('-t', '--tweets', default=500, show_default=True, help="tweets in data per page")
+@click.option('-n', '--number', default=200, show_default=True, help="pages mapped per measurement")
+@click.command
+def bench_page_mapping(tweets: int, number: int):
+    """Measure the time to map one page of API results to insert tuples"""
+    page = {'data': [synthetic_tweet(i) for i in range(tweets)],
+            'includes': {'tweets': [synthetic_tweet(tweets + i) for i in range(tweets // 5)],
+                         'users': [synthetic_user(i) for i in range(tweets * 4 // 5)]},
+            'meta': {'result_count': tweets}}
+    rows = initial_load.map_page(page, True)
+    legacy_rows = legacy_map_page(page, True)
+    assert (rows.tweets, rows.hashtags, rows.mentions, rows.urls, rows.users) == legacy_rows, "mappings differ"
+    legacy = min(timeit.repeat(lambda: legacy_map_page(page, True), number=number, repeat=5)) / number
+    current = min(timeit.repeat(lambda: initial_load.map_page(page, True), number=number, repeat=5)) / number
+    print(f"legacy dataclass mapping: {legacy * 1000:8.3f} ms/page")
+    print(f"map_page:                 {current * 1000:8.3f} ms/page")
+    print(f"speedup:                  {legacy / current:8.2f}x")
+
+
+if __name__ == '__main__':
+    bench_page_mapping()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Benchmark of the layouts of tweets_a built by 4_create_tweets_a.py: the denormalised table versus the narrow
+tweets_hot_a with the statistics in tweet_stats_a behind a view. Builds tweets_a in each layout in turn from the
+tweets_i and tweet_stats_i in the database, and reports the build time, the disk footprint of the tables and the
+latency of typical queries through tweets_a. tweets_a is left in the last layout built, so run this against a
+development database, e.g. one loaded with 1_initial_load.py --sample. Run from anywhere; the stages are imported from
+code/create-db."""
+import importlib
+import os
+import statistics
+import sys
+import time
+from contextlib import closing
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create-db'))
+convoy_db = importlib.import_module('convoy_db')
+create_tweets_a = importlib.import_module('4_create_tweets_a')
+
+# Typical queries as (name, statement, parameters). The parameters are filled in with the author_id and
+# ur_conversation_id of a tweet from the middle of tweets_i.
+queries = [
+    ("tweets per day", "SELECT date_created_at, COUNT(*) FROM tweets_a GROUP BY date_created_at", ()),
+    ("likes per language", "SELECT lang, COUNT(*), SUM(like_count) FROM tweets_a GROUP BY lang", ()),
+    ("author timeline", "SELECT tweet_id, created_at, text FROM tweets_a WHERE author_id = %s ORDER BY tweet_id", ("author_id",)),
+    ("ur-conversation tree", "SELECT tweet_id, in_reply_to, retweet_of, quotes, descendants, max_depth FROM tweets_a WHERE ur_conversation_id = %s", ("ur_conversation_id",)),
+    ("deepest originals", "SELECT tweet_id, max_depth FROM tweets_a WHERE original ORDER BY max_depth DESC LIMIT 100", ())
+]
+
+
+def footprint(cur, layout: str) -> tuple[int, int]:
+    """Returns the data and index bytes of the tables of a layout"""
+    tables = [tbl for (tbl, _) in create_tweets_a.layouts[layout]]
+    cur.execute(f"SELECT SUM(DATA_LENGTH), SUM(INDEX_LENGTH) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({','.join(['%s'] * len(tables))})", tuple(tables))
+    (data_bytes, index_bytes) = cur.fetchone()
+    return int(data_bytes or 0), int(index_bytes or 0)
+
+
+def time_query(cur, stmt: str, params: tuple, repeat: int) -> tuple[float, float]:
+    """Returns the time of the first run of a query and the median of the rest"""
+    times = []
+    for _ in range(repeat + 1):
+        start_time = time.perf_counter()
+        cur.execute(stmt, params)
+        cur.fetchall()
+        times.append(time.perf_counter() - start_time)
+    return times[0], statistics.median(times[1:])
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-l', '--layout', 'bench_layouts', type=click.Choice(list(create_tweets_a.layouts)), multiple=True, default=list(create_tweets_a.layouts), show_default=True, help="layouts to build and measure, in order")
+@click.option('-w', '--workers', default=4, show_default=True, help="number of workers to build tweets_a with")
+@click.option('-n', '--repeat', default=5, show_default=True, help="runs of each query after the first one")
+@click.option('--no-fulltext', is_flag=True, help="build tweets_a without the FULLTEXT index on text")
+@click.command
+def bench_tweets_a_layout(password: str | None, bench_layouts: list[str], workers: int, repeat: int, no_fulltext: bool):
+    """Measure build time, disk footprint and query latency of the tweets_a layouts"""
+    with convoy_db.connection(password) as conn, closing(conn.cursor()) as cur:
+        cur.execute("SELECT author_id, ur_conversation_id FROM tweets_i WHERE author_id IS NOT NULL AND tweet_id >= (SELECT (MIN(tweet_id) + MAX(tweet_id)) DIV 2 FROM tweets_i) ORDER BY tweet_id LIMIT 1")
+        (author_id, ur_conversation_id) = cur.fetchone()
+    params = dict(author_id=author_id, ur_conversation_id=ur_conversation_id)
+    for layout in bench_layouts:
+        args = ['--layout', layout, '--workers', str(workers)] + (['--password', password] if password is not None else []) + (['--no-fulltext'] if no_fulltext else [])
+        start_time = time.perf_counter()
+        create_tweets_a.create_tweets_a.main(args, standalone_mode=False)
+        build_seconds = time.perf_counter() - start_time
+        with convoy_db.connection(password, "analytic read") as conn, closing(conn.cursor()) as cur:
+            (data_bytes, index_bytes) = footprint(cur, layout)
+            print(f"{layout}:")
+            print(f"  build:     {build_seconds:10.1f} s")
+            print(f"  data:      {data_bytes / 1024 ** 2:10.1f} MiB")
+            print(f"  indexes:   {index_bytes / 1024 ** 2:10.1f} MiB")
+            for (name, stmt, param_names) in queries:
+                (first, median) = time_query(cur, stmt, tuple(params[param_name] for param_name in param_names), repeat)
+                print(f"  {name + ':':30s} {first * 1000:10.1f} ms first, {median * 1000:10.1f} ms median")
+
+
+if __name__ == '__main__':
+    bench_tweets_a_layout()
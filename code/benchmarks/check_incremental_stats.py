@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Check that the incremental statistics of 3_create_tweet_stats_i.py --incremental match a full rebuild. Loads a
+sample of the original files, runs stages 2 and 3, appends the same sample of the appended files with
+1_initial_load.py --append and runs stage 2 and stage 3 --incremental. The statistics tables are then set aside, stage 3
+is rerun in full and the two versions of each table are compared row by row. The database is reloaded from scratch, so
+run this against a development database. Run from anywhere; the stages are imported from code/create-db."""
+import importlib
+import os
+import sys
+from contextlib import closing
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create-db'))
+convoy_db = importlib.import_module('convoy_db')
+initial_load = importlib.import_module('1_initial_load')
+enrich_ur_conversation_ids = importlib.import_module('2_enrich_ur_conversation_ids')
+create_tweet_stats_i = importlib.import_module('3_create_tweet_stats_i')
+
+stats_tables = ["tweet_stats_i", "ur_conversation_stats_i", "conversation_stats_i"]
+
+
+def differing_rows(cur, tbl: str) -> tuple[int, int]:
+    """Returns the number of rows only in the incremental and only in the full version of a table"""
+    cur.execute(f"SELECT COUNT(*) FROM (SELECT * FROM {tbl}_incremental EXCEPT SELECT * FROM {tbl}) AS d")
+    (only_incremental,) = cur.fetchone()
+    cur.execute(f"SELECT COUNT(*) FROM (SELECT * FROM {tbl} EXCEPT SELECT * FROM {tbl}_incremental) AS d")
+    (only_full,) = cur.fetchone()
+    return only_incremental, only_full
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-o', '--original', required=True, multiple=True, help="jsonl files to load first")
+@click.option('-a', '--appended', required=True, multiple=True, help="jsonl files to append afterwards")
+@click.option('-s', '--sample', default=0.01, show_default=True, type=click.FloatRange(0, 1, min_open=True), help="fraction of the ur-conversations to load")
+@click.command
+def check_incremental_stats(password: str | None, original: list[str], appended: list[str], sample: float):
+    """Compare incrementally computed tweet statistics with a full rebuild"""
+    password_args = ['--password', password] if password is not None else []
+    sample_args = ['--sample', str(sample)]
+    initial_load.load_db.main(password_args + sample_args + [arg for file_name in original for arg in ('--original', file_name)], standalone_mode=False)
+    enrich_ur_conversation_ids.enrich_ur_conversation_ids.main(password_args, standalone_mode=False)
+    create_tweet_stats_i.enrich_conversations.main(password_args, standalone_mode=False)
+    initial_load.load_db.main(password_args + sample_args + ['--append'] + [arg for file_name in appended for arg in ('--original', file_name)], standalone_mode=False)
+    enrich_ur_conversation_ids.enrich_ur_conversation_ids.main(password_args, standalone_mode=False)
+    create_tweet_stats_i.enrich_conversations.main(password_args + ['--incremental'], standalone_mode=False)
+    with convoy_db.connection(password) as conn, closing(conn.cursor()) as cur:
+        for tbl in stats_tables:
+            cur.execute(f"DROP TABLE IF EXISTS {tbl}_incremental")
+            cur.execute(f"RENAME TABLE {tbl} TO {tbl}_incremental")
+    create_tweet_stats_i.enrich_conversations.main(password_args, standalone_mode=False)
+    mismatches = 0
+    with convoy_db.connection(password, "analytic read") as conn, closing(conn.cursor()) as cur:
+        for tbl in stats_tables:
+            (only_incremental, only_full) = differing_rows(cur, tbl)
+            print(f"{tbl + ':':25s} {only_incremental:10d} rows only incremental, {only_full:10d} rows only full")
+            mismatches += only_incremental + only_full
+        for tbl in stats_tables:
+            cur.execute(f"DROP TABLE {tbl}_incremental")
+    if mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    check_incremental_stats()
@@ -1,10 +1,9 @@
 #!/usr/bin/env python3
-import dataclasses
-import itertools
 import os
-from dataclasses import dataclass, astuple, field
+import time
+from dataclasses import dataclass, field
 from functools import reduce
-from typing import Iterable, TextIO
+from typing import BinaryIO, Iterable
 
 import click
 from mysql.connector import MySQLConnection
@@ -13,10 +12,14 @@ from contextlib import closing
 from more_itertools import chunked
 from json import JSONDecodeError
 import tqdm
-import json
 import logging
 import mariadb
 
+import convoy_db
+from json_decoding import get_decoder, decoders, StdlibDecoder, OrjsonDecoder, SimdjsonDecoder
+from profiling import profiled, phase
+from sampling import Sample
+
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
@@ -24,14 +27,15 @@ logging.basicConfig(
 
 
 class RecoveringCursor:
-    def __init__(self, **config):
+    def __init__(self, config: dict, chunk_size: int = 1000):
+        self.chunk_size = chunk_size
         self.config = config
-        self.conn = mariadb.connect(**self.config)
+        self.conn = convoy_db.connect(self.config, "bulk load")
         self.cur = self.conn.cursor()
 
     def executemany(self, stmt, data):
         if len(data) > 0:
-            chunk_size = 1000
+            chunk_size = self.chunk_size
             for db in chunked(data, chunk_size):
                 while True:
                     try:
@@ -47,7 +51,7 @@ class RecoveringCursor:
                         logging.error(db)
                         self.cur.close()
                         self.conn.close()
-                        self.conn = mariadb.connect(**self.config)
+                        self.conn = convoy_db.connect(self.config, "bulk load")
                         self.cur = self.conn.cursor()
                         chunk_size = max(chunk_size // 2, 1)
                     except mariadb.DataError:
@@ -62,32 +66,40 @@ class RecoveringCursor:
         self.conn.close()
 
 
-@dataclass
+@dataclass(slots=True)
+class PageRows:
+    """Insert tuples for all target tables, mapped from one or more pages of API results"""
+    tweets: list[tuple] = field(default_factory=list)
+    hashtags: list[tuple[int, str]] = field(default_factory=list)
+    mentions: list[tuple[int, int]] = field(default_factory=list)
+    urls: list[tuple[int, str]] = field(default_factory=list)
+    users: list[tuple] = field(default_factory=list)
+
+
+def rewrite_urls(text: str, spans: list[tuple[int, int, str, str]]) -> str:
+    """Replace the (start, end, url, expanded_url) spans of text with their expanded urls in one pass. If the entity offsets don't line up with the text, falls back to replacing every url by value."""
+    spans.sort()
+    parts = []
+    pos = 0
+    for (start, end, url, expanded_url) in spans:
+        if start < pos or text[start:end] != url:
+            for (_, _, url, expanded_url) in spans:
+                text = text.replace(url, expanded_url)
+            return text
+        parts.append(text[pos:start])
+        parts.append(expanded_url)
+        pos = end
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
 class Tweet:
-    ur_conversation_id: int | None
-    conversation_id: int | None
-    id: int | None
-    author_id: int | None
-    created_at: str | None
-    retweet_count: int | None
-    reply_count: int | None
-    like_count: int | None
-    quote_count: int | None
-    lang: str | None
-    text: str | None
-    in_reply_to: int | None
-    in_reply_to_user_id: int | None
-    quotes: int | None
-    retweet_of: int | None
-    error_short: str | None
-    error_detail: str | None
-    original: bool
-    hashtags: list[str] | None
-    urls: list[str] | None
-    mentions: list[int] | None
-
-    @classmethod
-    def map_tweet(cls, tweet: dict, original: bool, mentions_id_map: dict):
+    columns = ('ur_conversation_id', 'conversation_id', 'id', 'author_id', 'created_at', 'retweet_count', 'reply_count', 'like_count', 'quote_count', 'lang', 'text', 'in_reply_to', 'in_reply_to_user_id', 'quotes', 'retweet_of', 'error_short', 'error_detail', 'original', 'hashtags', 'urls', 'mentions')
+
+    @staticmethod
+    def map_tweet(tweet: dict, original: bool, mentions_id_map: dict, rows: PageRows):
+        """Append the tweets_i row of tweet and its hashtag, mention and url rows to rows"""
+        tweet_id = int(tweet['id'])
         in_reply_to = None
         in_reply_to_user_id = None
         quotes = None
@@ -97,27 +109,32 @@ class Tweet:
         urls = None
         mentions = None
         if 'entities' in tweet:
-            if 'urls' in tweet['entities']:
-                urls = list()
-                urlmap = dict()
-                for url in tweet['entities']['urls']:
+            entities = tweet['entities']
+            if 'urls' in entities:
+                spans = []
+                for url in entities['urls']:
                     if 'unwound_url' in url:
-                        urlmap[url['url']] = url['unwound_url']
-                        urls.append(url['unwound_url'])
+                        expanded_url = url['unwound_url']
                     elif 'expanded_url' in url:
-                        urlmap[url['url']] = url['expanded_url']
-                        urls.append(url['expanded_url'])
+                        expanded_url = url['expanded_url']
                     else:
-                        urls.append(url['url'])
-                for (ourl, nurl) in urlmap.items():
-                    text = text.replace(ourl, nurl)
-            if 'hashtags' in tweet['entities']:
-                hashtags = list(map(lambda hashtag: hashtag['tag'],tweet['entities']['hashtags']))
-            if 'mentions' in tweet['entities']:
-                mentions = list()
-                for mention in tweet['entities']['mentions']:
-                    mentions_id_map[mention['username']] = int(mention['id'])
-                    mentions.append(int(mention['id']))
+                        rows.urls.append((tweet_id, url['url']))
+                        continue
+                    rows.urls.append((tweet_id, expanded_url))
+                    spans.append((url['start'] if 'start' in url else -1, url['end'] if 'end' in url else -1, url['url'], expanded_url))
+                urls = len(entities['urls'])
+                if spans:
+                    text = rewrite_urls(text, spans)
+            if 'hashtags' in entities:
+                for hashtag in entities['hashtags']:
+                    rows.hashtags.append((tweet_id, hashtag['tag']))
+                hashtags = len(entities['hashtags'])
+            if 'mentions' in entities:
+                for mention in entities['mentions']:
+                    user_id = int(mention['id'])
+                    mentions_id_map[mention['username']] = user_id
+                    rows.mentions.append((tweet_id, user_id))
+                mentions = len(entities['mentions'])
         if 'referenced_tweets' in tweet:
             for ref_tweet in tweet['referenced_tweets']:
                 if ref_tweet['type'] == 'retweeted':
@@ -127,32 +144,33 @@ class Tweet:
                     in_reply_to_user_id = int(tweet['in_reply_to_user_id'])
                 else:
                     quotes = int(ref_tweet['id'])
-        return cls(None,
-                   int(tweet['conversation_id']),
-                   int(tweet['id']),
-                   int(tweet['author_id']),
-                   tweet['created_at'][0:10] + ' ' + tweet['created_at'][11:18],
-                   int(tweet['public_metrics']['retweet_count']),
-                   int(tweet['public_metrics']['reply_count']),
-                   int(tweet['public_metrics']['like_count']),
-                   int(tweet['public_metrics']['quote_count']),
-                   tweet['lang'],
-                   text,
-                   in_reply_to,
-                   in_reply_to_user_id,
-                   quotes,
-                   retweet_of,
-                   None,
-                   None,
-                   original,
-                   hashtags,
-                   urls,
-                   mentions
-                   )
-
-    @classmethod
-    def error(cls, error: dict, original: bool):
-        return cls(None, None, int(error['resource_id']), None, None, None, None, None, None, None, None, None, None, None, None, error['title'], error['detail'], original, None, None, None)
+        created_at = tweet['created_at']
+        public_metrics = tweet['public_metrics']
+        rows.tweets.append((None,
+                            int(tweet['conversation_id']),
+                            tweet_id,
+                            int(tweet['author_id']),
+                            created_at[0:10] + ' ' + created_at[11:18],
+                            int(public_metrics['retweet_count']),
+                            int(public_metrics['reply_count']),
+                            int(public_metrics['like_count']),
+                            int(public_metrics['quote_count']),
+                            tweet['lang'],
+                            text,
+                            in_reply_to,
+                            in_reply_to_user_id,
+                            quotes,
+                            retweet_of,
+                            None,
+                            None,
+                            original,
+                            hashtags,
+                            urls,
+                            mentions))
+
+    @staticmethod
+    def error(error: dict, original: bool) -> tuple:
+        return None, None, int(error['resource_id']), None, None, None, None, None, None, None, None, None, None, None, None, error['title'], error['detail'], original, None, None, None
 
     @staticmethod
     def prepare_tweets_tables(conn: MySQLConnection):
@@ -184,24 +202,54 @@ class Tweet:
                 INDEX(ur_conversation_id, tweet_id),
                 INDEX(conversation_id, tweet_id)
                 ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0""")
+            # Hashtags and urls are interned to integer ids by Dictionary. The fact tables only hold the ids, and
+            # views with the names and shapes of the former string tables join the strings back in.
+            cur.execute("DROP TABLE IF EXISTS dictionary_ids_i")
+            cur.execute("""
+                         CREATE TABLE dictionary_ids_i (
+                             dimension VARCHAR(64) PRIMARY KEY,
+                             next_id BIGINT UNSIGNED NOT NULL
+                         ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
+                         """)
+            cur.execute("INSERT INTO dictionary_ids_i VALUES ('hashtags_a', 1), ('urls_a', 1)")
             cur.execute("DROP TABLE IF EXISTS tweet_hashtags_a")
+            cur.execute("DROP TABLE IF EXISTS hashtags_a")
             cur.execute("""
-                         CREATE TABLE tweet_hashtags_a (
+                         CREATE TABLE hashtags_a (
+                             hashtag_id INTEGER UNSIGNED PRIMARY KEY,
+                             hashtag VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+                             INDEX (hashtag)
+                         ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
+                         """)
+            cur.execute("DROP TABLE IF EXISTS tweet_hashtag_ids_a")
+            cur.execute("""
+                         CREATE TABLE tweet_hashtag_ids_a (
                              tweet_id BIGINT UNSIGNED,
-                             hashtag VARCHAR(255) CHARACTER SET utf8mb4,
-                             PRIMARY KEY (hashtag, tweet_id),
-                             INDEX (tweet_id, hashtag)
+                             hashtag_id INTEGER UNSIGNED,
+                             PRIMARY KEY (hashtag_id, tweet_id),
+                             INDEX (tweet_id, hashtag_id)
                          ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
                          """)
+            cur.execute("CREATE OR REPLACE VIEW tweet_hashtags_a AS SELECT f.tweet_id, d.hashtag FROM tweet_hashtag_ids_a f INNER JOIN hashtags_a d USING (hashtag_id)")
             cur.execute("DROP TABLE IF EXISTS tweet_urls_a")
+            cur.execute("DROP TABLE IF EXISTS urls_a")
+            cur.execute("""
+                         CREATE TABLE urls_a (
+                             url_id INTEGER UNSIGNED PRIMARY KEY,
+                             url VARCHAR(570) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+                             INDEX (url(250))
+                         ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
+                         """)
+            cur.execute("DROP TABLE IF EXISTS tweet_url_ids_a")
             cur.execute("""
-                         CREATE TABLE tweet_urls_a (
+                         CREATE TABLE tweet_url_ids_a (
                              tweet_id BIGINT UNSIGNED,
-                             url VARCHAR(570) CHARACTER SET utf8mb4,
-                             PRIMARY KEY (url, tweet_id),
-                             INDEX (tweet_id, url)
+                             url_id INTEGER UNSIGNED,
+                             PRIMARY KEY (url_id, tweet_id),
+                             INDEX (tweet_id, url_id)
                          ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
                          """)
+            cur.execute("CREATE OR REPLACE VIEW tweet_urls_a AS SELECT f.tweet_id, d.url FROM tweet_url_ids_a f INNER JOIN urls_a d USING (url_id)")
             cur.execute("DROP TABLE IF EXISTS tweet_mentions_a")
             cur.execute("""
                          CREATE TABLE tweet_mentions_a (
@@ -212,38 +260,20 @@ class Tweet:
                          ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
                          """)
 
-    def as_tuple(self):
-        return tuple(getattr(self, field.name) if field.name != "hashtags" and field.name != "mentions" and field.name != "urls" or getattr(self, field.name) is None else len(getattr(self, field.name)) for field in dataclasses.fields(self))
+    insert_stmt = f"INSERT IGNORE INTO tweets_i VALUES ({'%s,' * (len(columns) - 1)}%s)"
 
-    insert_stmt = f"INSERT IGNORE INTO tweets_i VALUES ({'%s,'*20}%s)"
+    insert_hashtags_stmt = "INSERT IGNORE INTO tweet_hashtag_ids_a VALUES (%s, %s)"
 
-    insert_hashtags_stmt = "INSERT IGNORE INTO tweet_hashtags_a VALUES (%s, %s)"
-
-    insert_urls_stmt = "INSERT IGNORE INTO tweet_urls_a VALUES (%s, %s)"
+    insert_urls_stmt = "INSERT IGNORE INTO tweet_url_ids_a VALUES (%s, %s)"
 
     insert_mentions_stmt = "INSERT IGNORE INTO tweet_mentions_a VALUES (%s, %s)"
 
 
-@dataclass
 class User:
-    id: int
-    username: str | None
-    name: str | None
-    description: str | None
-    created_at: str | None
-    verified: bool | None
-    protected: bool | None
-    url: str | None
-    location: str | None
-    followers_count: int | None
-    following_count: int | None
-    tweet_count: int | None
-    listed_count: int | None
-    error_short: str | None
-    error_detail: str | None
-
-    @classmethod
-    def map_user(cls, user: dict):
+    columns = ('id', 'username', 'name', 'description', 'created_at', 'verified', 'protected', 'url', 'location', 'followers_count', 'following_count', 'tweet_count', 'listed_count', 'error_short', 'error_detail')
+
+    @staticmethod
+    def map_user(user: dict) -> tuple:
         url = user['url']
         description = user['description']
         if 'entities' in user:
@@ -252,34 +282,33 @@ class User:
                 if 'urls' in field_entities:
                     for murl in field_entities['urls']:
                         if 'unwound_url' in murl:
-                            urlmap[url['url']] = murl['unwound_url']
+                            urlmap[murl['url']] = murl['unwound_url']
                         elif 'expanded_url' in murl:
                             urlmap[murl['url']] = murl['expanded_url']
             for (ourl, nurl) in urlmap.items():
                 url = url.replace(ourl, nurl)
                 description = description.replace(ourl, nurl)
+        created_at = user['created_at']
+        public_metrics = user['public_metrics']
+        return (int(user['id']),
+                user['username'],
+                user['name'],
+                description if description != '' else None,
+                created_at[0:10] + ' ' + created_at[11:18],
+                user['verified'],
+                user['protected'],
+                url if url != '' else None,
+                user['location'] if 'location' in user and user['location'] != '' else None,
+                public_metrics['followers_count'],
+                public_metrics['following_count'],
+                public_metrics['tweet_count'],
+                public_metrics['listed_count'],
+                None,
+                None)
 
-        return cls(
-            int(user['id']),
-            user['username'],
-            user['name'],
-            description if description != '' else None,
-            user['created_at'][0:10] + ' ' + user['created_at'][11:18],
-            user['verified'],
-            user['protected'],
-            url if url != '' else None,
-            user['location'] if 'location' in user and user['location'] != '' else None,
-            user['public_metrics']['followers_count'],
-            user['public_metrics']['following_count'],
-            user['public_metrics']['tweet_count'],
-            user['public_metrics']['listed_count'],
-            None,
-            None
-        )
-
-    @classmethod
-    def error(cls, id: int, error: dict):
-        return cls(id, None, None, None, None, None, None, None, None, None, None, None, None, error['title'], error['detail'])
+    @staticmethod
+    def error(id: int, error: dict) -> tuple:
+        return id, None, None, None, None, None, None, None, None, None, None, None, None, error['title'], error['detail']
 
     @staticmethod
     def prepare_users_table(conn: MySQLConnection):
@@ -309,101 +338,255 @@ class User:
                  ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
                 ;""")
 
-    insert_stmt = f"INSERT IGNORE INTO users_a VALUES ({'%s,' * 14}%s)"
+    insert_stmt = f"INSERT IGNORE INTO users_a VALUES ({'%s,' * (len(columns) - 1)}%s)"
+
 
+class Dictionary:
+    """Interns the strings of a dimension table to integer ids. The ids of the strings seen so far are kept in memory,
+    and ids for new strings are taken from blocks reserved in dictionary_ids_i, so an appending or restarted load never
+    hands out an id twice. As the in-memory dictionary decides which strings are new, only one loader may write to a
+    dimension table at a time."""
 
-def yield_pages(tweet_file: TextIO, original: bool) -> Iterable[tuple[Iterable[Tweet],Iterable[User]]]:
+    def __init__(self, config: dict, tbl: str, id_col: str, value_col: str, fold=None, block_size: int = 10000):
+        self.config = config
+        self.tbl = tbl
+        self.id_col = id_col
+        self.value_col = value_col
+        self.fold = fold
+        self.block_size = block_size
+        self.ids: dict[str, int] = dict()
+        self.next_id = self.block_end = 0
+        self.new_rows: list[tuple[int, str]] = []
+        self.insert_stmt = f"INSERT IGNORE INTO {tbl} VALUES (%s, %s)"
+
+    def load(self):
+        """Read the strings interned by earlier loads"""
+        with closing(convoy_db.connect(self.config)) as conn, closing(conn.cursor()) as cur:
+            cur.execute(f"SELECT {self.id_col}, {self.value_col} FROM {self.tbl}")
+            for (id, value) in cur:
+                self.ids[value] = id
+
+    def reserve(self):
+        with closing(convoy_db.connect(self.config)) as conn, closing(conn.cursor()) as cur:
+            cur.execute("UPDATE dictionary_ids_i SET next_id = LAST_INSERT_ID(next_id + %s) WHERE dimension = %s", (self.block_size, self.tbl))
+            cur.execute("SELECT LAST_INSERT_ID()")
+            (self.block_end,) = cur.fetchone()
+        self.next_id = self.block_end - self.block_size
+
+    def intern(self, value: str) -> int:
+        if self.fold is not None:
+            value = self.fold(value)
+        id = self.ids.get(value)
+        if id is None:
+            if self.next_id == self.block_end:
+                self.reserve()
+            id = self.next_id
+            self.next_id += 1
+            self.ids[value] = id
+            self.new_rows.append((id, value))
+        return id
+
+    def pop_new_rows(self) -> list[tuple[int, str]]:
+        """Returns the rows of the strings interned since the last call, for inserting into the dimension table"""
+        (rows, self.new_rows) = (self.new_rows, [])
+        return rows
+
+
+class TableBatch:
+    """The buffered rows of one table. If the rows reference ids of a dimension table, depends_on is the batch of that
+    table, which is written first so that no row is written before the dimension row it references."""
+    __slots__ = ('stmt', 'row_bytes', 'depends_on', 'rows', 'bytes')
+
+    def __init__(self, stmt: str, row_bytes, depends_on: 'TableBatch | None' = None):
+        self.stmt = stmt
+        self.row_bytes = row_bytes
+        self.depends_on = depends_on
+        self.rows = []
+        self.bytes = 0
+
+
+class Batcher:
+    """Buffers rows per target table. A table's rows are written with one executemany as soon as they reach max_rows
+    rows or an estimated max_bytes bytes, and all buffered rows are written once max_seconds have passed since the
+    last time everything was written. This keeps insert sizes and memory use steady whatever the shape of the pages."""
+
+    def __init__(self, cur: RecoveringCursor, max_rows: int, max_bytes: int, max_seconds: float, hashtag_dictionary: Dictionary, url_dictionary: Dictionary):
+        self.cur = cur
+        self.hashtag_dictionary = hashtag_dictionary
+        self.url_dictionary = url_dictionary
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.last_flush = time.monotonic()
+        # Row size estimates: a fixed part for numbers, dates and row overhead plus the variable length strings.
+        self.tweets = TableBatch(Tweet.insert_stmt, lambda row: 160 + len(row[10] or ''))
+        self.hashtag_values = TableBatch(hashtag_dictionary.insert_stmt, lambda row: 8 + len(row[1]))
+        self.hashtags = TableBatch(Tweet.insert_hashtags_stmt, lambda row: 16, self.hashtag_values)
+        self.mentions = TableBatch(Tweet.insert_mentions_stmt, lambda row: 16)
+        self.url_values = TableBatch(url_dictionary.insert_stmt, lambda row: 8 + len(row[1]))
+        self.urls = TableBatch(Tweet.insert_urls_stmt, lambda row: 16, self.url_values)
+        self.users = TableBatch(User.insert_stmt, lambda row: 120 + len(row[2] or '') + len(row[3] or '') + len(row[7] or '') + len(row[8] or ''))
+
+    def add(self, batch: TableBatch, rows: list[tuple]):
+        row_bytes = batch.row_bytes
+        for row in rows:
+            batch.rows.append(row)
+            batch.bytes += row_bytes(row)
+            if len(batch.rows) >= self.max_rows or batch.bytes >= self.max_bytes:
+                self.flush_batch(batch)
+
+    def add_page(self, page: PageRows):
+        self.add(self.tweets, page.tweets)
+        # The strings are interned and their new dictionary rows buffered before the rows referencing them, so that
+        # writing out the referencing rows writes the dictionary rows first.
+        intern = self.hashtag_dictionary.intern
+        hashtags = [(tweet_id, intern(hashtag)) for (tweet_id, hashtag) in page.hashtags]
+        self.add(self.hashtag_values, self.hashtag_dictionary.pop_new_rows())
+        self.add(self.hashtags, hashtags)
+        self.add(self.mentions, page.mentions)
+        intern = self.url_dictionary.intern
+        urls = [(tweet_id, intern(url)) for (tweet_id, url) in page.urls]
+        self.add(self.url_values, self.url_dictionary.pop_new_rows())
+        self.add(self.urls, urls)
+        self.add(self.users, page.users)
+        if time.monotonic() - self.last_flush >= self.max_seconds:
+            self.flush()
+
+    def flush_batch(self, batch: TableBatch):
+        if len(batch.rows) == 0:
+            return
+        if batch.depends_on is not None:
+            self.flush_batch(batch.depends_on)
+        self.cur.executemany(batch.stmt, batch.rows)
+        batch.rows = []
+        batch.bytes = 0
+
+    def flush(self):
+        for batch in (self.tweets, self.hashtag_values, self.hashtags, self.mentions, self.url_values, self.urls, self.users):
+            self.flush_batch(batch)
+        self.last_flush = time.monotonic()
+
+
+def map_page(r: dict, original: bool) -> PageRows:
+    """Map one page of API results straight to the insert tuples of all target tables"""
+    rows = PageRows()
+    mentions_id_map = dict()
+    for tweet in r['data']:
+        Tweet.map_tweet(tweet, original, mentions_id_map, rows)
+    includes = r['includes']
+    if 'tweets' in includes:
+        for tweet in includes['tweets']:
+            Tweet.map_tweet(tweet, original, mentions_id_map, rows)
+    for user in includes['users']:
+        rows.users.append(User.map_user(user))
+    if 'errors' in r:
+        for error in r['errors']:
+            if error['resource_type'] == 'tweet':
+                rows.tweets.append(Tweet.error(error, original))
+            if error['parameter'] == 'in_reply_to_user_id':
+                rows.users.append(User.error(int(error['resource_id']), error))
+            elif error['parameter'] == 'entities.mentions.username':
+                rows.users.append(User.error(mentions_id_map[error['resource_id']], error))
+    return rows
+
+
+def yield_pages(tweet_file: BinaryIO, original: bool, decoder: StdlibDecoder | OrjsonDecoder | SimdjsonDecoder) -> Iterable[PageRows]:
     response = tweet_file.readline()
     line_number = 1
     while response:
         try:
-            r = json.loads(response)
-            mentions_id_map = dict()
-            tweets: Iterable[Tweet] = map(lambda tweet: Tweet.map_tweet(tweet, original, mentions_id_map), r['data'])
-            if 'tweets' in r['includes']:
-                tweets = itertools.chain(tweets, map(lambda tweet: Tweet.map_tweet(tweet, original, mentions_id_map), r['includes']['tweets']))
-            users = map(User.map_user, r['includes']['users'])
-            if 'errors' in r:
-                tweets = itertools.chain(tweets, map(lambda tweet: Tweet.error(tweet, original), filter(lambda e: e['resource_type'] == 'tweet', r['errors'])))
-                users = itertools.chain(users, map(lambda error: User.error(int(error['resource_id']), error), filter(lambda e: e['parameter'] == 'in_reply_to_user_id', r['errors'])))
-                users = itertools.chain(users, map(lambda error: User.error(mentions_id_map[error['resource_id']], error), filter(lambda e: e['parameter'] == 'entities.mentions.username', r['errors'])))
-            yield tweets, users
+            yield map_page(decoder.decode(response), original)
         except JSONDecodeError:
             logging.exception(f"Exception parsing line number {line_number} of {tweet_file.name}. Skipping.")
         response = tweet_file.readline()
         line_number += 1
 
 
-@click.option('-p', '--password', required=True, help="database password")
+def yield_sampled_pages(tweet_file: BinaryIO, original: bool, decoder: StdlibDecoder | OrjsonDecoder | SimdjsonDecoder, sample: Sample) -> Iterable[PageRows]:
+    """Like yield_pages, but only reads the pages with sampled conversations and leaves out the tweets of the others"""
+    for response in sample.lines(tweet_file):
+        yield map_page(sample.filter_page(decoder.decode(response)), original)
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
 @click.option('-o', '--original', required=True, multiple=True, help="file names of jsonl files containing the tweets in the original sample")
 @click.option('-e', '--expansion', multiple=True, help="file names of jsonl files containing tweets from expanded conversations", default=[])
+@click.option('--batch-rows', default=5000, show_default=True, help="maximum number of rows per insert into a table")
+@click.option('--batch-bytes', default=4 * 1024 * 1024, show_default=True, help="maximum estimated size in bytes of the rows per insert into a table")
+@click.option('--batch-seconds', default=30.0, show_default=True, help="maximum time in seconds rows are buffered before being inserted")
+@click.option('--json-decoder', type=click.Choice(['auto'] + list(decoders)), default='auto', show_default=True, help="JSON decoder to parse the pages with. auto picks the fastest one installed")
+@click.option('-a', '--append', is_flag=True, help="top up the existing tables instead of recreating them")
+@click.option('--sample', type=click.FloatRange(0, 1, min_open=True), help="only load this fraction of the ur-conversations, chosen deterministically, see sampling.py")
+@profiled
 @click.command
-def load_db(password: str, original: list[str], expansion: list[str]):
+def load_db(password: str | None, original: list[str], expansion: list[str], batch_rows: int, batch_bytes: int, batch_seconds: float, json_decoder: str, append: bool, sample: float | None):
     """Load tweets into the database"""
-    with closing(mariadb.connect(user="convoy",
-                                 password=password,
-                                 host="vm1788.kaj.pouta.csc.fi",
-                                 port=3306,
-                                 autocommit=True)) as conn, closing(conn.cursor()) as cur:
+    config = convoy_db.connection_config(password)
+    with convoy_db.connection(password, database=None) as conn, closing(conn.cursor()) as cur:
         cur: MySQLCursor
-        cur.execute("CREATE DATABASE IF NOT EXISTS convoy;")
-
-    with closing(mariadb.connect(user="convoy",
-                                 password=password,
-                                 host="vm1788.kaj.pouta.csc.fi",
-                                 port=3306,
-                                 database="convoy",
-                                 autocommit=True)) as conn:
+        cur.execute(f"CREATE DATABASE IF NOT EXISTS {config['database']};")
+
+    with convoy_db.connection(password) as conn:
         conn: MySQLConnection
-        logging.info("Preparing tweets tables.")
-        Tweet.prepare_tweets_tables(conn)
-        logging.info("Preparing users table.")
-        User.prepare_users_table(conn)
+        if append:
+            # Tweets not loaded before are inserted with a NULL ur_conversation_id, which is what marks their
+            # ur-conversations as dirty for the incremental statistics run once ur-conversation ids are assigned.
+            logging.info("Appending to existing tables.")
+        else:
+            logging.info("Preparing tweets tables.")
+            Tweet.prepare_tweets_tables(conn)
+            logging.info("Preparing users table.")
+            User.prepare_users_table(conn)
+            # Keys are only disabled for a fresh load. Rebuilding them would take as long as for the full tables
+            # however little is appended.
+            with closing(conn.cursor()) as cur:
+                cur: MySQLCursor
+                cur.execute("ALTER TABLE tweet_hashtag_ids_a DISABLE KEYS;")
+                cur.execute("ALTER TABLE tweet_mentions_a DISABLE KEYS;")
+                cur.execute("ALTER TABLE tweet_url_ids_a DISABLE KEYS;")
+                cur.execute("ALTER TABLE tweets_i DISABLE KEYS;")
+                cur.execute("ALTER TABLE users_a DISABLE KEYS;")
         logging.info("Loading data.")
-        with closing(conn.cursor()) as cur:
-            cur: MySQLCursor
-            cur.execute("ALTER TABLE tweet_hashtags_a DISABLE KEYS;")
-            cur.execute("ALTER TABLE tweet_mentions_a DISABLE KEYS;")
-            cur.execute("ALTER TABLE tweet_urls_a DISABLE KEYS;")
-            cur.execute("ALTER TABLE tweets_i DISABLE KEYS;")
-            cur.execute("ALTER TABLE users_a DISABLE KEYS;")
-        with closing(RecoveringCursor(user="convoy",
-                                 password=password,
-                                 host="vm1788.kaj.pouta.csc.fi",
-                                 port=3306,
-                                 database="convoy",
-                                 autocommit=True)) as cur:
+        with closing(RecoveringCursor(config, chunk_size=batch_rows)) as cur:
             cur: RecoveringCursor
+            hashtag_dictionary = Dictionary(cur.config, "hashtags_a", "hashtag_id", "hashtag", fold=str.casefold)
+            url_dictionary = Dictionary(cur.config, "urls_a", "url_id", "url")
+            if append:
+                logging.info("Reading interned hashtags and urls.")
+                hashtag_dictionary.load()
+                url_dictionary.load()
+            batcher = Batcher(cur, batch_rows, batch_bytes, batch_seconds, hashtag_dictionary, url_dictionary)
+            decoder = get_decoder(json_decoder)
+            logging.info(f"Decoding pages using {decoder.name}.")
             tweet_file_names = original + expansion
+            if sample is not None:
+                logging.info(f"Sampling {sample} of the ur-conversations.")
+                page_sample = Sample(tweet_file_names, sample, decoder)
+                logging.info(f"Loading {page_sample.sampled_components} of {page_sample.components} ur-conversations from {sum(map(len, page_sample.pages.values()))} pages.")
             tsize = reduce(lambda tsize, tweet_file_name: tsize + os.path.getsize(tweet_file_name), tweet_file_names, 0)
             pbar = tqdm.tqdm(total=tsize, unit='b', unit_scale=True, unit_divisor=1024)
             processed_files_tsize = 0
-            for tweet_file_name in tweet_file_names:
-                is_original = tweet_file_name in original
-                logging.info(f"Starting to process {'original' if original else 'expanded'} file {tweet_file_name}.")
-                with open(tweet_file_name, "rt") as tweet_file:
-                    for chunk_number, pages in enumerate(chunked(yield_pages(tweet_file, is_original), 10)):
-                        tweets = list(itertools.chain.from_iterable(map(lambda page: page[0], pages)))
-                        cur.executemany(Tweet.insert_stmt, [tweet.as_tuple() for tweet in tweets])
-                        cur.executemany(Tweet.insert_hashtags_stmt, list(
-                            itertools.chain.from_iterable(
-                                map(lambda tweet: map(lambda hashtag: (tweet.id, hashtag), tweet.hashtags), filter(lambda tweet: tweet.hashtags is not None, tweets)))))
-                        cur.executemany(Tweet.insert_mentions_stmt, list(
-                            itertools.chain.from_iterable(
-                                map(lambda tweet: map(lambda mention: (tweet.id, mention), tweet.mentions), filter(lambda tweet: tweet.mentions is not None, tweets)))))
-                        cur.executemany(Tweet.insert_urls_stmt, list(
-                            itertools.chain.from_iterable(
-                                map(lambda tweet: map(lambda url: (tweet.id, url), tweet.urls), filter(lambda tweet: tweet.urls is not None, tweets)))))
-                        cur.executemany(User.insert_stmt, list(map(lambda user: astuple(user), itertools.chain.from_iterable(map(lambda page: page[1], pages)))))
-                        pbar.n = processed_files_tsize + tweet_file.tell()
-                        pbar.update(0)
-                processed_files_tsize += os.path.getsize(tweet_file_name)
+            with phase("parse"):
+                for tweet_file_name in tweet_file_names:
+                    is_original = tweet_file_name in original
+                    logging.info(f"Starting to process {'original' if original else 'expanded'} file {tweet_file_name}.")
+                    with open(tweet_file_name, "rb") as tweet_file:
+                        for page in yield_pages(tweet_file, is_original, decoder) if sample is None else yield_sampled_pages(tweet_file, is_original, decoder, page_sample):
+                            batcher.add_page(page)
+                            pbar.n = processed_files_tsize + tweet_file.tell()
+                            pbar.update(0)
+                    batcher.flush()
+                    processed_files_tsize += os.path.getsize(tweet_file_name)
+    if append:
+        logging.info("Done.")
+        return
+    with convoy_db.connection(password, "index build") as conn:
         with closing(conn.cursor()) as cur:
             cur: MySQLCursor
             logging.info('Insert complete. Enabling keys.')
-            cur.execute("ALTER TABLE tweet_hashtags_a ENABLE KEYS;")
+            cur.execute("ALTER TABLE tweet_hashtag_ids_a ENABLE KEYS;")
             cur.execute("ALTER TABLE tweet_mentions_a ENABLE KEYS;")
-            cur.execute("ALTER TABLE tweet_urls_a ENABLE KEYS;")
+            cur.execute("ALTER TABLE tweet_url_ids_a ENABLE KEYS;")
             cur.execute("ALTER TABLE tweets_i ENABLE KEYS;")
             cur.execute("ALTER TABLE users_a ENABLE KEYS;")
             logging.info('Done enabling keys.')
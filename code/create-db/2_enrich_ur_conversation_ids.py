@@ -3,26 +3,24 @@ import logging
 from contextlib import closing
 
 import click
-import mariadb
 from mysql.connector import MySQLConnection
 from mysql.connector.cursor import MySQLCursor
 
+import convoy_db
+from profiling import profiled
+
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
 
-@click.option('-p', '--password', required=True, help="database password")
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@profiled
 @click.command
-def enrich_ur_conversation_ids(password: str):
+def enrich_ur_conversation_ids(password: str | None):
     """Enrich tweet database with ur-conversation ids"""
-    with closing(mariadb.connect(user="convoy",
-                                 password=password,
-                                 host="vm1788.kaj.pouta.csc.fi",
-                                 port=3306,
-                                 database="convoy",
-                                 autocommit=True)) as conn, closing(conn.cursor()) as cur:
+    with convoy_db.connection(password, "bulk load") as conn, closing(conn.cursor()) as cur:
         conn: MySQLConnection
         cur: MySQLCursor
         logging.info("Creating conversation ID map.")
@@ -45,11 +43,37 @@ def enrich_ur_conversation_ids(password: str):
             logging.info("Iteration changed %s values.", cur.rowcount)
             if cur.rowcount == 0:
                 break
+        # Tweets appended by 1_initial_load.py --append are the ones without a ur-conversation id yet. If no tweet has
+        # one, the tables were loaded afresh and everything is rebuilt anyway, and if all have one, nothing changed.
+        cur.execute("SELECT SUM(ur_conversation_id IS NULL), SUM(ur_conversation_id IS NOT NULL) FROM tweets_i WHERE conversation_id IS NOT NULL")
+        (appended, enriched) = cur.fetchone()
+        if not enriched:
+            logging.info("No ur-conversation ids assigned before. Dropping any recorded dirty ur-conversations.")
+            cur.execute("DROP TABLE IF EXISTS dirty_ur_conversations_i")
+        elif appended:
+            logging.info("Recording ur-conversations that gained tweets or were re-rooted.")
+            cur.execute("CREATE TABLE IF NOT EXISTS dirty_ur_conversations_i (ur_conversation_id BIGINT UNSIGNED PRIMARY KEY) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0")
+            for dirty_id in ["COALESCE(cim.to_conversation_id,t.conversation_id)", "t.ur_conversation_id"]:
+                cur.execute(f"""
+                            INSERT IGNORE INTO dirty_ur_conversations_i
+                            SELECT {dirty_id} FROM tweets_i t LEFT JOIN conversation_id_map_i cim ON cim.from_conversation_id = t.conversation_id
+                            WHERE NOT (t.ur_conversation_id <=> COALESCE(cim.to_conversation_id,t.conversation_id)) AND {dirty_id} IS NOT NULL
+                            """)
         logging.info("Projecting ur-conversation ids to tweets table.")
         cur.execute("""
                     UPDATE tweets_i t LEFT JOIN conversation_id_map_i cim ON cim.from_conversation_id = t.conversation_id
                     SET ur_conversation_id = COALESCE(cim.to_conversation_id,t.conversation_id)
                     """)
+        logging.info("Recording ur-conversation sizes.")
+        cur.execute("DROP TABLE IF EXISTS ur_conversation_sizes_i")
+        cur.execute("""
+                    CREATE TABLE ur_conversation_sizes_i
+                    (PRIMARY KEY (ur_conversation_id), INDEX (size)) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
+                    SELECT ur_conversation_id, COUNT(*) AS size
+                    FROM tweets_i
+                    WHERE ur_conversation_id IS NOT NULL
+                    GROUP BY ur_conversation_id
+                    """)
         logging.info("Dropping conversation id map table.")
         cur.execute("DROP TABLE conversation_id_map_i")
         logging.info("Done.")
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import logging
+import sys
 from contextlib import closing
 from dataclasses import dataclass, field
 from functools import reduce, lru_cache
@@ -11,6 +12,10 @@ from more_itertools import chunked
 from mysql.connector.cursor import MySQLCursor
 from tqdm import tqdm
 
+from conversation_trees import int_cols, float_cols, parent_edge, REPLY, ROOT
+import convoy_db
+from profiling import profiled, phase
+
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
@@ -222,22 +227,41 @@ class Tree:
                 )
 
 
-def enrich_conversation(cur: MySQLCursor, tweets: list[tuple[int, int, int, int, int, int, int, int, int]]):
+def aggregate_conversation(tweets: list[tuple[int, int, int, int, int, int, int, int, int, int]]) -> tuple[int, int, int, int, int, int]:
+    """Count tweets, distinct authors and sum the reply, like, quote and retweet counts of a (ur-)conversation"""
+    authors = set()
+    reply_count = like_count = quote_count = retweet_count = 0
+    for tweet in tweets:
+        authors.add(tweet[1])
+        reply_count += tweet[5]
+        quote_count += tweet[6]
+        like_count += tweet[7]
+        retweet_count += tweet[8]
+    return len(tweets), len(authors), reply_count, like_count, quote_count, retweet_count
+
+
+def enrich_conversation(cur: MySQLCursor, ur_conversation_id: int, tweets: list[tuple[int, int, int, int, int, int, int, int, int, int]]):
+    if len(tweets) == 0:
+        return
+    cur.execute("INSERT IGNORE INTO ur_conversation_stats_i VALUES (%s,%s,%s,%s,%s,%s,%s)", (ur_conversation_id,) + aggregate_conversation(tweets))
+    conversations: dict[int, list[tuple[int, int, int, int, int, int, int, int, int, int]]] = dict()
+    for tweet in tweets:
+        conversations.setdefault(tweet[9], []).append(tweet)
+    cur.executemany("INSERT IGNORE INTO conversation_stats_i VALUES (%s,%s,%s,%s,%s,%s,%s)", [(conversation_id,) + aggregate_conversation(conversation_tweets) for conversation_id, conversation_tweets in conversations.items()])
     tweet_trees = lru_cache(maxsize=None)(lambda id: Tree(id))
     for tweet in tqdm(tweets, unit="tweets", leave=False, desc="treeing"):
-        tweet: tuple[int, int, int, int, int, int, int, int, int]
+        tweet: tuple[int, int, int, int, int, int, int, int, int, int]
         tt = tweet_trees(tweet[0])
         tt.author_id = tweet[1]
         tt.reply_count = tweet[5]
         tt.quote_count = tweet[6]
         tt.like_count = tweet[7]
         tt.retweet_count = tweet[8]
-        if tweet[2] is not None:
-            tweet_trees(tweet[2]).children.add(tt)
-        elif tweet[3] is not None:
-            tweet_trees(tweet[3]).ur_children.add(tt)
-        elif tweet[4] is not None:
-            tweet_trees(tweet[4]).ur_children.add(tt)
+        (parent, kind) = parent_edge(tweet[2], tweet[3], tweet[4])
+        if kind == REPLY:
+            tweet_trees(parent).children.add(tt)
+        elif kind != ROOT:
+            tweet_trees(parent).ur_children.add(tt)
     for tweet in tqdm(tweets, unit="tweets", leave=False, desc="descending"):
         tt = tweet_trees(tweet[0])
         tt.count_statistics()
@@ -253,56 +277,103 @@ def enrich_conversation(cur: MySQLCursor, tweets: list[tuple[int, int, int, int,
         except mariadb.InterfaceError:
             logging.exception(f"InterfaceError for {data}")
 
-int_cols = [
-    'children',
-    'descendants',
-    'leaf_descendants',
-    'max_depth',
-    't_authors',
-    't_reply_count',
-    't_quote_count',
-    't_like_count',
-    't_retweet_count'
-]
 
-float_cols = [
-    'branching_factor',
-    'mean_depth',
-    'depth_mad',
-    'mean_reply_count',
-    'reply_count_mad',
-    'mean_quote_count',
-    'quote_count_mad',
-    'mean_like_count',
-    'like_count_mad',
-    'mean_retweet_count',
-    'retweet_count_mad'
-]
+# Approximate memory taken by the Tree of one tweet once its statistics are counted, used to estimate the size of a
+# ur-conversation tree from ur_conversation_sizes_i before building it.
+tree_bytes_per_tweet = 3500
+
+
+def prepare_tables(cur: MySQLCursor):
+    logging.info("Preparing tweet_stats_i table.")
+    cur.execute("DROP TABLE IF EXISTS tweet_stats_i")
+    create_stmt = "CREATE TABLE tweet_stats_i (tweet_id BIGINT UNSIGNED,"
+    for col in int_cols:
+        create_stmt += f"{col} INTEGER UNSIGNED, ur_{col} INTEGER UNSIGNED,"
+    for col in float_cols:
+        create_stmt += f"{col} FLOAT UNSIGNED, ur_{col} FLOAT UNSIGNED,"
+    create_stmt += "PRIMARY KEY (tweet_id)) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0"
+    cur.execute(create_stmt)
+    logging.info("Preparing conversation aggregate tables.")
+    cur.execute("DROP TABLE IF EXISTS ur_conversation_stats_i")
+    cur.execute("""
+        CREATE TABLE ur_conversation_stats_i (
+            ur_conversation_id BIGINT UNSIGNED PRIMARY KEY,
+            uc_ur_descendants BIGINT UNSIGNED,
+            authors BIGINT UNSIGNED,
+            uc_ur_t_reply_count BIGINT UNSIGNED,
+            uc_ur_t_like_count BIGINT UNSIGNED,
+            uc_ur_t_quote_count BIGINT UNSIGNED,
+            uc_ur_t_retweet_count BIGINT UNSIGNED
+        ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0""")
+    cur.execute("DROP TABLE IF EXISTS conversation_stats_i")
+    cur.execute("""
+        CREATE TABLE conversation_stats_i (
+            conversation_id BIGINT UNSIGNED PRIMARY KEY,
+            c_descendants BIGINT UNSIGNED,
+            authors BIGINT UNSIGNED,
+            c_t_reply_count BIGINT UNSIGNED,
+            c_t_like_count BIGINT UNSIGNED,
+            c_t_quote_count BIGINT UNSIGNED,
+            c_t_retweet_count BIGINT UNSIGNED
+        ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0""")
+
 
+def delete_dirty(cur: MySQLCursor):
+    """Remove the statistics and aggregates of all tweets and conversations in dirty ur-conversations. Ur-conversations
+    that lost all their tweets to a re-rooting are dirty too, so their stale aggregates go as well."""
+    cur.execute("""
+        DELETE ts FROM tweet_stats_i ts
+        INNER JOIN tweets_i t USING (tweet_id)
+        INNER JOIN dirty_ur_conversations_i d ON d.ur_conversation_id = t.ur_conversation_id
+        """)
+    cur.execute("""
+        DELETE cs FROM conversation_stats_i cs
+        INNER JOIN tweets_i t ON t.conversation_id = cs.conversation_id
+        INNER JOIN dirty_ur_conversations_i d ON d.ur_conversation_id = t.ur_conversation_id
+        """)
+    cur.execute("DELETE us FROM ur_conversation_stats_i us INNER JOIN dirty_ur_conversations_i d USING (ur_conversation_id)")
 
-@click.option('-p', '--password', required=True, help="database password")
+
+def dirty_join(incremental: bool, alias: str) -> str:
+    """Join restricting a query to the dirty ur-conversations when running incrementally"""
+    return f"INNER JOIN dirty_ur_conversations_i d ON d.ur_conversation_id = {alias}.ur_conversation_id" if incremental else ""
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-i', '--incremental', is_flag=True, help="only recompute the ur-conversations recorded as dirty by 2_enrich_ur_conversation_ids.py")
+@click.option('-m', '--max-tree-mib', type=int, help="skip ur-conversations whose tree is estimated to take more memory than this. Skipped ur-conversations are left in dirty_ur_conversations_i for a later --incremental run, and fail the run unless --allow-skipped is given")
+@click.option('--allow-skipped', is_flag=True, help="exit successfully even if ur-conversations were skipped by --max-tree-mib, leaving them without statistics and missing from the conversation tables until recomputed")
+@profiled
 @click.command
-def enrich_conversations(password: str):
+def enrich_conversations(password: str | None, incremental: bool, max_tree_mib: int | None, allow_skipped: bool):
     """Enrich conversations with statistical information"""
-    with closing(mariadb.connect(user="convoy",
-                                 password=password,
-                                 host="vm1788.kaj.pouta.csc.fi",
-                                 port=3306,
-                                 database="convoy",
-                                 autocommit=True)) as conn, closing(conn.cursor()) as cur, closing(conn.cursor()) as cur2:
+    with convoy_db.connection(password, "bulk load") as conn, closing(conn.cursor()) as cur, closing(conn.cursor()) as cur2:
         cur: MySQLCursor
         cur2: MySQLCursor
-        logging.info("Preparing tweet_stats_i table.")
-        cur.execute("DROP TABLE IF EXISTS tweet_stats_i")
-        create_stmt = "CREATE TABLE tweet_stats_i (tweet_id BIGINT UNSIGNED,"
-        for col in int_cols:
-            create_stmt += f"{col} INTEGER UNSIGNED, ur_{col} INTEGER UNSIGNED,"
-        for col in float_cols:
-            create_stmt += f"{col} FLOAT UNSIGNED, ur_{col} FLOAT UNSIGNED,"
-        create_stmt += "PRIMARY KEY (tweet_id)) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0"
-        cur.execute(create_stmt)
+        if incremental:
+            cur.execute("SHOW TABLES LIKE 'dirty_ur_conversations_i'")
+            if len(cur.fetchall()) == 0:
+                logging.info("No dirty ur-conversations recorded. Nothing to do.")
+                return
+            logging.info("Removing statistics of dirty ur-conversations.")
+            delete_dirty(cur)
+        else:
+            prepare_tables(cur)
+        logging.info("Calculating aggregates for singleton ur-conversations.")
+        cur.execute(f"""
+            INSERT INTO ur_conversation_stats_i
+            SELECT t.ur_conversation_id, 1, 1, t.reply_count, t.like_count, t.quote_count, t.retweet_count
+            FROM ur_conversation_sizes_i s INNER JOIN tweets_i t USING (ur_conversation_id) {dirty_join(incremental, 's')}
+            WHERE s.size = 1
+            """)
+        cur.execute(f"""
+            INSERT INTO conversation_stats_i
+            SELECT t.conversation_id, 1, u.authors, t.reply_count, t.like_count, t.quote_count, t.retweet_count
+            FROM ur_conversation_stats_i u INNER JOIN tweets_i t USING (ur_conversation_id) {dirty_join(incremental, 'u')}
+            WHERE u.uc_ur_descendants = 1
+            """)
         logging.info("Calculating statistics for singleton ur-conversations.")
-        cur.execute("""
+        cur.execute(f"""
             INSERT IGNORE INTO tweet_stats_i
             SELECT tweet_id,
             0 AS children,
@@ -345,21 +416,41 @@ def enrich_conversations(password: str):
             retweet_count AS ur_mean_retweet_count,
             0 AS mad_retweet_count,
             0 AS ur_mad_retweet_count
-            FROM tweets_i
-            WHERE tweet_id IN (SELECT ur_conversation_id FROM tweets_i
-            GROUP BY ur_conversation_id
-            HAVING COUNT(*)=1)
+            FROM ur_conversation_stats_i u INNER JOIN tweets_i t ON t.tweet_id = u.ur_conversation_id {dirty_join(incremental, 'u')}
+            WHERE u.uc_ur_descendants = 1
             """)
         logging.info("Calculating stat data.")
-        cur.execute("""
-            SELECT ur_conversation_id FROM tweets_i
-            GROUP BY ur_conversation_id
-            HAVING COUNT(*)>1 
+        cur.execute(f"""
+            SELECT s.ur_conversation_id, s.size FROM ur_conversation_sizes_i s {dirty_join(incremental, 's')}
+            WHERE s.size > 1
+            ORDER BY s.size DESC
             """)
-        for (ur_conversation_id,) in tqdm(cur.fetchall(), unit="ur-conversations"):
-            cur.execute("SELECT tweet_id, author_id, in_reply_to, retweet_of, quotes, reply_count, quote_count, like_count, retweet_count FROM tweets_i WHERE ur_conversation_id=%s ORDER BY tweet_id DESC", (ur_conversation_id,))
-            enrich_conversation(cur2, cur.fetchall())
-        logging.info("Done.")
+        ur_conversations = cur.fetchall()
+        skipped = []
+        with phase("trees"):
+            for (ur_conversation_id, size) in tqdm(ur_conversations, unit="ur-conversations"):
+                estimated_bytes = size * tree_bytes_per_tweet
+                if max_tree_mib is not None and estimated_bytes > max_tree_mib * 1024 ** 2:
+                    logging.warning(f"Skipping ur-conversation {ur_conversation_id} of {size} tweets, its tree would take about {estimated_bytes / 1024 ** 2:.0f} MiB.")
+                    skipped.append((ur_conversation_id,))
+                    continue
+                if estimated_bytes > 1024 ** 3:
+                    logging.info(f"Building tree of ur-conversation {ur_conversation_id} of {size} tweets, about {estimated_bytes / 1024 ** 2:.0f} MiB.")
+                cur.execute("SELECT tweet_id, author_id, in_reply_to, retweet_of, quotes, reply_count, quote_count, like_count, retweet_count, conversation_id FROM tweets_i WHERE ur_conversation_id=%s ORDER BY tweet_id DESC", (ur_conversation_id,))
+                enrich_conversation(cur2, ur_conversation_id, cur.fetchall())
+        if len(skipped) == 0:
+            cur.execute("DROP TABLE IF EXISTS dirty_ur_conversations_i")
+            logging.info("Done.")
+            return
+        # Only the skipped ur-conversations are left dirty, so that an incremental run with a higher limit computes them.
+        cur.execute("CREATE TABLE IF NOT EXISTS dirty_ur_conversations_i (ur_conversation_id BIGINT UNSIGNED PRIMARY KEY) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0")
+        cur.execute("DELETE FROM dirty_ur_conversations_i")
+        cur.executemany("INSERT INTO dirty_ur_conversations_i VALUES (%s)", skipped)
+        message = f"Skipped {len(skipped)} ur-conversations over the tree memory limit. They have no statistics and are recorded in dirty_ur_conversations_i. Rerun with --incremental and a higher --max-tree-mib to compute them."
+        if not allow_skipped:
+            logging.error(message)
+            sys.exit(1)
+        logging.warning(message)
 
 
 if __name__ == '__main__':
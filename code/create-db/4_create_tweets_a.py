@@ -1,53 +1,200 @@
 #!/usr/bin/env python3
 import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import closing
 import click
 import mariadb
 from mysql.connector.cursor import MySQLCursor
+from tqdm import tqdm
+
+from conversation_trees import stats_cols
+import convoy_db
+from profiling import profiled
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
+date_parts = [
+    ("date_created_at", "DATE(created_at)"),
+    ("year_created_at", "YEAR(created_at)"),
+    ("month_created_at", "MONTH(created_at)"),
+    ("day_created_at", "DAY(created_at)"),
+    ("week_created_at", "WEEK(created_at, 1)"),
+    ("hour_created_at", "HOUR(created_at)")
+]
+
+date_parts_select = ', '.join(f"{expr} AS {name}" for (name, expr) in date_parts)
+
+select_stmt = f"SELECT *, {date_parts_select} FROM tweets_i t LEFT JOIN tweet_stats_i ts USING (tweet_id)"
+
+# The tables of each layout of tweets_a as (table, statement selecting its rows from t). Each tweet_id range is copied
+# into all of them, and the secondary indexes are built on the first. In the split layout, tweets_a is a view joining
+# the narrow tweets_hot_a with the statistics in tweet_stats_a, so scans only read the statistics when asked for them.
+layouts = {
+    "denormalised": [("tweets_a", select_stmt)],
+    "split": [("tweets_hot_a", f"SELECT *, {date_parts_select} FROM tweets_i t"),
+              ("tweet_stats_a", "SELECT * FROM tweet_stats_i t")]
+}
+
+secondary_indexes = [
+    "UNIQUE INDEX(ur_conversation_id, tweet_id)",
+    "UNIQUE INDEX(conversation_id, tweet_id)",
+    "UNIQUE INDEX(author_id, tweet_id)",
+    "UNIQUE INDEX(created_at, tweet_id)",
+    "UNIQUE INDEX(lang, tweet_id)",
+    "FULLTEXT(text)",
+    "UNIQUE INDEX(in_reply_to, tweet_id)",
+    "UNIQUE INDEX(in_reply_to_user_id, tweet_id)",
+    "UNIQUE INDEX(quotes, tweet_id)",
+    "UNIQUE INDEX(retweet_of, tweet_id)",
+    "UNIQUE INDEX(error, tweet_id)",
+    "UNIQUE INDEX(original, tweet_id)"
+]
+
+
+def built_layout(cur: MySQLCursor) -> str | None:
+    """Returns the layout tweets_a was built in, or None if there is no tweets_a"""
+    cur.execute("SELECT TABLE_TYPE FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'tweets_a'")
+    table_type = cur.fetchone()
+    if table_type is None:
+        return None
+    return "split" if table_type[0] == 'VIEW' else "denormalised"
+
+
+def drop_tweets_a(cur: MySQLCursor):
+    """Drop tweets_a and the tables of all layouts, whichever layout they were built in"""
+    if built_layout(cur) == "split":
+        cur.execute("DROP VIEW tweets_a")
+    for tables in layouts.values():
+        for (tbl, _) in tables:
+            cur.execute(f"DROP TABLE IF EXISTS {tbl}")
+
+
+def create_tweets_a_view(cur: MySQLCursor):
+    """Create tweets_a of the split layout as a view with the columns of the denormalised table in the same order"""
+    cur.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'tweets_i' AND COLUMN_NAME != 'tweet_id' ORDER BY ORDINAL_POSITION")
+    cols = ["tweet_id"] + [f"h.{col}" for (col,) in cur.fetchall()] + [f"s.{col}" for col in stats_cols] + [f"h.{name}" for (name, _) in date_parts]
+    # As tweet_stats_a is joined on its primary key, MariaDB leaves it out of queries not using its columns.
+    cur.execute(f"CREATE ALGORITHM=MERGE VIEW tweets_a AS SELECT {', '.join(cols)} FROM tweets_hot_a h LEFT JOIN tweet_stats_a s USING (tweet_id)")
+
 
-@click.option('-p', '--password', required=True, help="database password")
+def prepare_tweets_a_table(cur: MySQLCursor, range_size: int, layout: str, indexes: list[str]):
+    """Create the tables of the layout, the first one with the given secondary indexes disabled until the copy is done,
+    and split tweets_i into tweet_id ranges of about range_size rows each in tweets_a_ranges_i"""
+    drop_tweets_a(cur)
+    for (i, (tbl, select)) in enumerate(layouts[layout]):
+        cur.execute(f"""
+            CREATE TABLE {tbl} (
+                {', '.join(['PRIMARY KEY (tweet_id)'] + (indexes if i == 0 else []))}
+            ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
+            {select}
+            WHERE 0""")
+    cur.execute(f"ALTER TABLE {layouts[layout][0][0]} DISABLE KEYS")
+    if layout == "split":
+        create_tweets_a_view(cur)
+    cur.execute("DROP TABLE IF EXISTS tweets_a_ranges_i")
+    cur.execute("""
+        CREATE TABLE tweets_a_ranges_i (
+            range_start BIGINT UNSIGNED PRIMARY KEY,
+            range_end BIGINT UNSIGNED,
+            done BOOLEAN NOT NULL DEFAULT 0,
+            row_count INTEGER UNSIGNED,
+            seconds FLOAT
+        ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0""")
+    cur.execute("""
+        INSERT INTO tweets_a_ranges_i (range_start, range_end)
+        SELECT tweet_id, LEAD(tweet_id) OVER (ORDER BY tweet_id) FROM
+        (SELECT tweet_id, ROW_NUMBER() OVER (ORDER BY tweet_id) AS rn FROM tweets_i) AS r
+        WHERE MOD(rn - 1, %s) = 0""", (range_size,))
+
+
+def disabled_indexes(cur: MySQLCursor, tbl: str) -> int:
+    """Returns the number of indexes of a table disabled by DISABLE KEYS and not yet built"""
+    cur.execute("SELECT COUNT(DISTINCT INDEX_NAME) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COMMENT = 'disabled'", (tbl,))
+    return cur.fetchone()[0]
+
+
+def copy_range(pool: convoy_db.ConnectionPool, layout: str, range_start: int, range_end: int | None) -> int:
+    """Copy one tweet_id range [range_start, range_end) from tweets_i into the tables of the layout and mark it done. Rows left over from a failed earlier attempt are removed first, so a range can always be retried."""
+    condition = "tweet_id >= %s" if range_end is None else "tweet_id >= %s AND tweet_id < %s"
+    params = (range_start,) if range_end is None else (range_start, range_end)
+    with pool.connection("bulk copy") as conn, closing(conn.cursor()) as cur:
+        cur: MySQLCursor
+        start_time = time.perf_counter()
+        row_count = None
+        for (tbl, select) in layouts[layout]:
+            cur.execute(f"DELETE FROM {tbl} WHERE {condition}", params)
+            cur.execute(f"INSERT INTO {tbl} {select} WHERE t.{condition}", params)
+            if row_count is None:
+                row_count = cur.rowcount
+        cur.execute("UPDATE tweets_a_ranges_i SET done = 1, row_count = %s, seconds = %s WHERE range_start = %s", (row_count, time.perf_counter() - start_time, range_start))
+        return row_count
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-w', '--workers', default=4, show_default=True, help="number of tweet_id ranges to copy in parallel, each over its own connection. Concurrent copies into the same Aria table serialise on its table lock, so more workers mostly keep a failed range from holding up the others rather than speed up the copy")
+@click.option('-r', '--range-size', default=1000000, show_default=True, help="approximate number of tweets per tweet_id range")
+@click.option('--resume', is_flag=True, help="continue an interrupted build, copying only the ranges not yet marked done in tweets_a_ranges_i and building the secondary indexes unless they already are")
+@click.option('--layout', type=click.Choice(list(layouts)), help="build tweets_a as one wide table, or split into the narrow tweets_hot_a carrying the indexes and the statistics in tweet_stats_a, joined by the view tweets_a. Defaults to denormalised, or with --resume to the layout of the interrupted build")
+@click.option('--index-threads', default=1, show_default=True, help="number of threads (aria_repair_threads) to build the secondary indexes with after the copy")
+@click.option('--no-fulltext', is_flag=True, help="leave out the FULLTEXT index on text, e.g. when searching texts through the index of 8_build_text_index.py instead")
+@profiled
 @click.command
-def create_tweets_a(password: str):
+def create_tweets_a(password: str | None, workers: int, range_size: int, resume: bool, layout: str | None, index_threads: int, no_fulltext: bool):
     """Create tweets_a table"""
-    with closing(mariadb.connect(user="convoy",
-                                 password=password,
-                                 host="vm1788.kaj.pouta.csc.fi",
-                                 port=3306,
-                                 database="convoy",
-                                 autocommit=True)) as conn, closing(conn.cursor()) as cur:
+    with convoy_db.connection(password) as conn, closing(conn.cursor()) as cur:
         cur: MySQLCursor
-        logging.info("Creating tweets_a table.")
-        cur.execute("DROP TABLE IF EXISTS tweets_a")
-        cur.execute("""
-            CREATE TABLE tweets_a (
-                PRIMARY KEY (tweet_id),
-                UNIQUE INDEX(ur_conversation_id, tweet_id),
-                UNIQUE INDEX(conversation_id, tweet_id),
-                UNIQUE INDEX(author_id, tweet_id),
-                UNIQUE INDEX(created_at, tweet_id),
-                UNIQUE INDEX(lang, tweet_id),
-                FULLTEXT(text),
-                UNIQUE INDEX(in_reply_to, tweet_id),
-                UNIQUE INDEX(in_reply_to_user_id, tweet_id),
-                UNIQUE INDEX(quotes, tweet_id),
-                UNIQUE INDEX(retweet_of, tweet_id),
-                UNIQUE INDEX(error, tweet_id),
-                UNIQUE INDEX(original, tweet_id)            
-            ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
-            SELECT *, DATE(created_at) AS date_created_at, YEAR(created_at) AS year_created_at, MONTH(created_at) AS month_created_at, DAY(created_at) AS day_created_at, WEEK(created_at, 1) AS week_created_at, HOUR(created_at) AS hour_created_at 
-            FROM tweets_i t LEFT JOIN tweet_stats_i ts USING (tweet_id) 
-            WHERE 0""")
-        cur.execute("ALTER TABLE tweets_a DISABLE KEYS")
-        cur.execute("INSERT INTO tweets_a SELECT *, DATE(created_at) AS date_created_at, YEAR(created_at) AS year_created_at, MONTH(created_at) AS month_created_at, DAY(created_at) AS day_created_at, WEEK(created_at, 1) AS week_created_at, HOUR(created_at) AS hour_created_at FROM tweets_i t LEFT JOIN tweet_stats_i ts USING (tweet_id)")
-        logging.info('Insert complete. Enabling keys.')
-        cur.execute("ALTER TABLE tweets_a ENABLE KEYS")
-        logging.info("Done enabling keys.")
+        if resume:
+            resumed_layout = built_layout(cur)
+            if resumed_layout is None:
+                logging.error("There is no tweets_a to resume building.")
+                sys.exit(1)
+            if layout is not None and layout != resumed_layout:
+                logging.error(f"tweets_a was being built in the {resumed_layout} layout, not {layout}.")
+                sys.exit(1)
+            layout = resumed_layout
+            logging.info(f"Resuming tweets_a table creation in the {layout} layout.")
+        else:
+            layout = layout or "denormalised"
+            logging.info(f"Creating tweets_a table in the {layout} layout.")
+            prepare_tweets_a_table(cur, range_size, layout, [index for index in secondary_indexes if not (no_fulltext and index.startswith("FULLTEXT"))])
+        cur.execute("SELECT range_start, range_end FROM tweets_a_ranges_i WHERE NOT done ORDER BY range_start")
+        ranges = cur.fetchall()
+        logging.info("Copying %d tweet_id ranges using %d workers.", len(ranges), workers)
+        failed = 0
+        pool = convoy_db.ConnectionPool(convoy_db.connection_config(password), workers)
+        with closing(pool), ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=len(ranges), unit="ranges") as pbar:
+            futures = {executor.submit(copy_range, pool, layout, range_start, range_end): range_start for (range_start, range_end) in ranges}
+            rows = 0
+            for future in as_completed(futures):
+                try:
+                    rows += future.result()
+                except mariadb.Error:
+                    logging.exception("Copying the range starting from %d failed.", futures[future])
+                    failed += 1
+                pbar.set_postfix(rows=rows, failed=failed)
+                pbar.update()
+        if failed > 0:
+            logging.error("%d ranges failed. Rerun with --resume to retry them.", failed)
+            sys.exit(1)
+    with convoy_db.connection(password, "index build") as conn, closing(conn.cursor()) as cur:
+        cur: MySQLCursor
+        indexes = disabled_indexes(cur, layouts[layout][0][0])
+        if indexes == 0:
+            logging.info("Insert complete. The secondary indexes are already built.")
+            return
+        # ENABLE KEYS builds all disabled indexes in one pass over the table, sorting their keys, where adding them
+        # with ALTER TABLE would copy the whole table again.
+        logging.info('Insert complete. Enabling %d secondary indexes using %d threads.', indexes, index_threads)
+        cur.execute(f"SET SESSION aria_repair_threads = {index_threads}")
+        start_time = time.perf_counter()
+        cur.execute(f"ALTER TABLE {layouts[layout][0][0]} ENABLE KEYS")
+        cur.execute("SET SESSION aria_repair_threads = DEFAULT")
+        logging.info("Done building indexes in %.1f seconds.", time.perf_counter() - start_time)
 
 
 if __name__ == '__main__':
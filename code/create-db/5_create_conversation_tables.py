@@ -3,47 +3,43 @@ import logging
 from contextlib import closing
 
 import click
-import mariadb
 from mysql.connector import MySQLConnection
 from mysql.connector.cursor import MySQLCursor
 
+import convoy_db
+from profiling import profiled
+
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
 
-@click.option('-p', '--password', required=True, help="database password")
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@profiled
 @click.command
-def create_conversation_tables(password: str):
+def create_conversation_tables(password: str | None):
     """Create conversation tables"""
-    with closing(mariadb.connect(user="convoy",
-                                 password=password,
-                                 host="vm1788.kaj.pouta.csc.fi",
-                                 port=3306,
-                                 database="convoy",
-                                 autocommit=True)) as conn, closing(conn.cursor()) as cur:
+    with convoy_db.connection(password, "bulk load") as conn, closing(conn.cursor()) as cur:
         conn: MySQLConnection
         cur: MySQLCursor
+        # The aggregates of each (ur-)conversation were computed by 3_create_tweet_stats_i.py, so here they only need
+        # to be joined with the root tweet.
         logging.info("Creating ur-conversation table.")
         cur.execute("DROP TABLE IF EXISTS ur_conversations_a")
         cur.execute("""
-                    CREATE TABLE ur_conversations_a ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
+                    CREATE TABLE ur_conversations_a (PRIMARY KEY (ur_conversation_id)) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
                     SELECT * FROM
                     (SELECT * FROM tweets_a t WHERE t.ur_conversation_id=t.tweet_id) AS a RIGHT JOIN
-                    (SELECT t.ur_conversation_id, COUNT(*) AS uc_ur_descendants, COUNT(DISTINCT t.author_id) AS authors, SUM(t.reply_count) AS uc_ur_t_reply_count, SUM(t.like_count) AS uc_ur_t_like_count, SUM(t.quote_count) AS uc_ur_t_quote_count, SUM(t.retweet_count) AS uc_ur_t_retweet_count 
-                     FROM tweets_a t
-                     GROUP BY t.ur_conversation_id) AS b USING (ur_conversation_id)
+                    ur_conversation_stats_i AS b USING (ur_conversation_id)
                     """)
         logging.info("Creating conversation table.")
         cur.execute("DROP TABLE IF EXISTS conversations_a")
         cur.execute("""
-                    CREATE TABLE conversations_a ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
+                    CREATE TABLE conversations_a (PRIMARY KEY (conversation_id)) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0
                     SELECT * FROM
                     (SELECT * FROM tweets_a t WHERE t.conversation_id=t.tweet_id) AS a RIGHT JOIN
-                    (SELECT t.conversation_id, COUNT(*) AS c_descendants, COUNT(DISTINCT t.author_id) AS authors, SUM(t.reply_count) AS c_t_reply_count, SUM(t.like_count) AS c_t_like_count, SUM(t.quote_count) AS c_t_quote_count, SUM(t.retweet_count) AS c_t_retweet_count 
-                     FROM tweets_a t
-                     GROUP BY t.conversation_id) AS b USING (conversation_id)
+                    conversation_stats_i AS b USING (conversation_id)
                     """)
         logging.info("Done.")
 
@@ -1,41 +1,158 @@
 #!/usr/bin/env python3
 import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import closing
 import click
 import mariadb
 from mysql.connector.cursor import MySQLCursor
+from tqdm import tqdm
+
+import convoy_db
+from profiling import profiled
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
+# Tables to copy, with the indexed key column they are copied in ranges of.
+tables = [
+    ("tweets", "tweet_id"),
+    ("hashtags", "hashtag_id"),
+    ("tweet_hashtag_ids", "tweet_id"),
+    ("tweet_mentions", "tweet_id"),
+    ("urls", "url_id"),
+    ("tweet_url_ids", "tweet_id"),
+    ("users", "user_id"),
+    ("conversations", "conversation_id"),
+    ("ur_conversations", "ur_conversation_id")
+]
+
+# Views over the copied tables restoring the string shapes of the dictionary encoded hashtag and url tables.
+views = [
+    ("tweet_hashtags_c", "SELECT f.tweet_id, d.hashtag FROM tweet_hashtag_ids_c f INNER JOIN hashtags_c d USING (hashtag_id)"),
+    ("tweet_urls_c", "SELECT f.tweet_id, d.url FROM tweet_url_ids_c f INNER JOIN urls_c d USING (url_id)")
+]
+
 
-def copy_table(cur: MySQLCursor, tbl: str):
-    logging.info(f"Copying {tbl} table to ColumnStore.")
+def prepare_ranges_table(cur: MySQLCursor):
+    cur.execute("DROP TABLE IF EXISTS columnstore_copy_ranges_i")
+    cur.execute("""
+        CREATE TABLE columnstore_copy_ranges_i (
+            tbl VARCHAR(64),
+            range_start BIGINT UNSIGNED,
+            range_end BIGINT UNSIGNED,
+            done BOOLEAN NOT NULL DEFAULT 0,
+            row_count INTEGER UNSIGNED,
+            seconds FLOAT,
+            PRIMARY KEY (tbl, range_start)
+        ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0""")
+
+
+def prepare_table(cur: MySQLCursor, tbl: str, key: str, range_size: int):
+    """Create the empty ColumnStore copy of a table and split the key space of the Aria table into ranges of about range_size keys"""
     cur.execute(f"DROP TABLE IF EXISTS {tbl}_c")
     cur.execute(f"CREATE TABLE {tbl}_c ENGINE=ColumnStore SELECT * FROM {tbl}_a WHERE 0")
-    cur.execute(f"INSERT INTO {tbl}_c SELECT * FROM {tbl}_a")
+    cur.execute(f"""
+        INSERT INTO columnstore_copy_ranges_i (tbl, range_start, range_end)
+        SELECT %s, {key}, LEAD({key}) OVER (ORDER BY {key}) FROM
+        (SELECT {key}, ROW_NUMBER() OVER (ORDER BY {key}) AS rn FROM (SELECT DISTINCT {key} FROM {tbl}_a) AS k) AS r
+        WHERE MOD(rn - 1, %s) = 0""", (tbl, range_size))
+
+
+def copy_range(cur: MySQLCursor, tbl: str, key: str, range_start: int, range_end: int | None) -> int:
+    """Copy one key range [range_start, range_end) of a table to ColumnStore and mark it done. Rows left over from a failed earlier attempt are removed first."""
+    condition = f"{key} >= %s" if range_end is None else f"{key} >= %s AND {key} < %s"
+    params = (range_start,) if range_end is None else (range_start, range_end)
+    start_time = time.perf_counter()
+    cur.execute(f"DELETE FROM {tbl}_c WHERE {condition}", params)
+    cur.execute(f"INSERT INTO {tbl}_c SELECT * FROM {tbl}_a WHERE {condition}", params)
+    row_count = cur.rowcount
+    cur.execute("UPDATE columnstore_copy_ranges_i SET done = 1, row_count = %s, seconds = %s WHERE tbl = %s AND range_start = %s", (row_count, time.perf_counter() - start_time, tbl, range_start))
+    return row_count
+
+
+def copy_table(config: dict, tbl: str, key: str, tries: int, pbar: tqdm):
+    """Copy the ranges of a table not yet done one after another, retrying each range up to tries times over a fresh connection"""
+    conn = convoy_db.connect(config, "bulk copy")
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT range_start, range_end FROM columnstore_copy_ranges_i WHERE tbl = %s AND NOT done ORDER BY range_start", (tbl,))
+        ranges = cur.fetchall()
+        logging.info(f"Copying {len(ranges)} ranges of {tbl} table to ColumnStore.")
+        for (range_start, range_end) in ranges:
+            for attempt in range(1, tries + 1):
+                try:
+                    pbar.update(copy_range(cur, tbl, key, range_start, range_end))
+                    break
+                except mariadb.Error:
+                    if attempt == tries:
+                        raise
+                    logging.exception(f"Copying range {range_start} of {tbl} failed on attempt {attempt}/{tries}. Retrying.")
+                    cur.close()
+                    conn.close()
+                    conn = convoy_db.connect(config, "bulk copy")
+                    cur = conn.cursor()
+        logging.info(f"Done copying {tbl} table to ColumnStore.")
+    finally:
+        cur.close()
+        conn.close()
+
+
+def verify_table(cur: MySQLCursor, tbl: str) -> bool:
+    cur.execute(f"SELECT (SELECT COUNT(*) FROM {tbl}_a), (SELECT COUNT(*) FROM {tbl}_c)")
+    (a_rows, c_rows) = cur.fetchone()
+    if a_rows != c_rows:
+        logging.error(f"{tbl}_a has {a_rows} rows but {tbl}_c has {c_rows}.")
+        return False
+    logging.info(f"{tbl}_a and {tbl}_c both have {a_rows} rows.")
+    return True
 
 
-@click.option('-p', '--password', required=True, help="database password")
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-w', '--workers', default=3, show_default=True, help="number of tables to copy concurrently, each over its own connection")
+@click.option('-r', '--range-size', default=1000000, show_default=True, help="approximate number of keys per copied range")
+@click.option('-t', '--tries', default=3, show_default=True, help="number of times to try copying a range before giving up on its table")
+@click.option('--resume', is_flag=True, help="continue an interrupted copy, copying only the ranges not yet marked done in columnstore_copy_ranges_i")
+@profiled
 @click.command
-def copy_to_columnstore(password: str):
+def copy_to_columnstore(password: str | None, workers: int, range_size: int, tries: int, resume: bool):
     """Copy tables from Aria to ColumnStore"""
-    with closing(mariadb.connect(user="convoy",
-                                 password=password,
-                                 host="vm1788.kaj.pouta.csc.fi",
-                                 port=3306,
-                                 database="convoy",
-                                 autocommit=True)) as conn, closing(conn.cursor()) as cur:
+    config = convoy_db.connection_config(password)
+    with convoy_db.connection(password) as conn, closing(conn.cursor()) as cur:
         cur: MySQLCursor
-        copy_table(cur, "tweets")
-        copy_table(cur, "tweet_hashtags")
-        copy_table(cur, "tweet_mentions")
-        copy_table(cur, "tweet_urls")
-        copy_table(cur, "users")
-        copy_table(cur, "conversations")
-        copy_table(cur, "ur_conversations")
+        if not resume:
+            logging.info("Preparing ColumnStore tables.")
+            prepare_ranges_table(cur)
+            for (tbl, key) in tables:
+                prepare_table(cur, tbl, key, range_size)
+        cur.execute("SELECT SUM(r.row_count) FROM columnstore_copy_ranges_i r WHERE r.done")
+        (done_rows,) = cur.fetchone()
+        total_rows = 0
+        for (tbl, _) in tables:
+            cur.execute(f"SELECT COUNT(*) FROM {tbl}_a")
+            total_rows += cur.fetchone()[0]
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=total_rows, initial=done_rows or 0, unit="rows", unit_scale=True) as pbar:
+            futures = {executor.submit(copy_table, config, tbl, key, tries, pbar): tbl for (tbl, key) in tables}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except mariadb.Error:
+                    logging.exception(f"Copying {futures[future]} table to ColumnStore failed.")
+                    failed += 1
+        if failed > 0:
+            logging.error(f"{failed} tables failed. Rerun with --resume to continue from the last completed range.")
+            sys.exit(1)
+        logging.info("Verifying row counts.")
+        if not all([verify_table(cur, tbl) for (tbl, _) in tables]):
+            sys.exit(1)
+        logging.info("Creating views.")
+        for (view, select) in views:
+            cur.execute(f"DROP TABLE IF EXISTS {view}")
+            cur.execute(f"CREATE OR REPLACE VIEW {view} AS {select}")
         logging.info("Done.")
 
 
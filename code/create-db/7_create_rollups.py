@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import datetime
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+import click
+import mariadb
+from mysql.connector.cursor import MySQLCursor
+from tqdm import tqdm
+
+import convoy_db
+from profiling import profiled
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+# Rollup tables as (name, key column definitions, key expressions, source, window in days). Every rollup counts tweets,
+# replies, likes and distinct authors per key. A rollup is built with one grouping scan of tweets_a and maintained one
+# window of created_at at a time. Its first key column is the start of the window, so a window can always be recomputed
+# on its own with exact distinct author counts.
+rollups = [
+    ("rollup_day_hashtag_a",
+     "day DATE NOT NULL, hashtag VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL",
+     "t.date_created_at, h.hashtag",
+     "tweets_a t INNER JOIN tweet_hashtags_a h USING (tweet_id)",
+     1),
+    ("rollup_day_lang_a",
+     "day DATE NOT NULL, lang VARCHAR(3) CHARACTER SET utf8mb4 NOT NULL",
+     "t.date_created_at, COALESCE(t.lang, '')",
+     "tweets_a t",
+     1),
+    ("rollup_week_author_a",
+     "week DATE NOT NULL, author_id BIGINT UNSIGNED NOT NULL",
+     "DATE_SUB(t.date_created_at, INTERVAL WEEKDAY(t.date_created_at) DAY), t.author_id",
+     "tweets_a t",
+     7),
+    ("rollup_hour_original_a",
+     "day DATE NOT NULL, hour TINYINT UNSIGNED NOT NULL, original BOOLEAN NOT NULL",
+     "t.date_created_at, t.hour_created_at, t.original",
+     "tweets_a t",
+     1)
+]
+
+
+def prepare_rollup_table(cur: MySQLCursor, tbl: str, key_defs: str, recreate: bool):
+    if recreate:
+        cur.execute(f"DROP TABLE IF EXISTS {tbl}")
+    key_cols = ', '.join(key_def.split()[0] for key_def in key_defs.split(', '))
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {tbl} (
+            {key_defs},
+            tweets INTEGER UNSIGNED NOT NULL,
+            replies INTEGER UNSIGNED NOT NULL,
+            likes BIGINT UNSIGNED NOT NULL,
+            authors INTEGER UNSIGNED NOT NULL,
+            PRIMARY KEY ({key_cols})
+        ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0""")
+
+
+def windows(first_day: datetime.date, last_day: datetime.date, window_days: int) -> list[datetime.date]:
+    """Returns the starts of the windows covering [first_day, last_day]. Week windows start on Mondays."""
+    if window_days == 7:
+        first_day -= datetime.timedelta(days=first_day.weekday())
+    return [first_day + datetime.timedelta(days=day) for day in range(0, (last_day - first_day).days + 1, window_days)]
+
+
+def build_rollup(pool: convoy_db.ConnectionPool, tbl: str, key_exprs: str, source: str) -> int:
+    """Compute all rows of a freshly created rollup with a single scan of tweets_a"""
+    with pool.connection("analytic read") as conn, closing(conn.cursor()) as cur:
+        cur: MySQLCursor
+        cur.execute(f"""
+            INSERT INTO {tbl}
+            SELECT {key_exprs}, COUNT(*), SUM(t.in_reply_to IS NOT NULL), COALESCE(SUM(t.like_count), 0), COUNT(DISTINCT t.author_id)
+            FROM {source}
+            WHERE t.created_at IS NOT NULL
+            GROUP BY {key_exprs}""")
+        return cur.rowcount
+
+
+def build_window(pool: convoy_db.ConnectionPool, tbl: str, key_defs: str, key_exprs: str, source: str, window_start: datetime.date, window_days: int) -> int:
+    """Recompute the rows of a rollup for the tweets created in [window_start, window_start + window_days days), scanning
+    tweets_a by its (created_at, tweet_id) index. Old rows of the window are removed first, so a window can always be redone."""
+    window_end = window_start + datetime.timedelta(days=window_days)
+    first_key_col = key_defs.split()[0]
+    with pool.connection("analytic read") as conn, closing(conn.cursor()) as cur:
+        cur: MySQLCursor
+        cur.execute(f"DELETE FROM {tbl} WHERE {first_key_col} >= %s AND {first_key_col} < %s", (window_start, window_end))
+        cur.execute(f"""
+            INSERT INTO {tbl}
+            SELECT {key_exprs}, COUNT(*), SUM(t.in_reply_to IS NOT NULL), COALESCE(SUM(t.like_count), 0), COUNT(DISTINCT t.author_id)
+            FROM {source}
+            WHERE t.created_at >= %s AND t.created_at < %s
+            GROUP BY {key_exprs}""", (window_start, window_end))
+        return cur.rowcount
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-s', '--since', type=click.DateTime(formats=["%Y-%m-%d"]), help="only recompute the rollups for tweets created on or after this day, e.g. after appending new tweets; by default all rollups are rebuilt from scratch")
+@click.option('-w', '--workers', default=4, show_default=True, help="number of rollups, or with --since rollup windows, to compute in parallel, each over its own connection")
+@profiled
+@click.command
+def create_rollups(password: str | None, since: datetime.datetime | None, workers: int):
+    """Create pre-aggregated rollup tables of tweets_a for dashboards"""
+    with convoy_db.connection(password) as conn, closing(conn.cursor()) as cur:
+        cur: MySQLCursor
+        logging.info("Preparing rollup tables.")
+        for (tbl, key_defs, _, _, _) in rollups:
+            prepare_rollup_table(cur, tbl, key_defs, since is None)
+        cur.execute("SELECT DATE(MIN(created_at)), DATE(MAX(created_at)) FROM tweets_a")
+        (first_day, last_day) = cur.fetchone()
+        if first_day is None:
+            logging.info("No tweets to roll up.")
+            return
+        pool = convoy_db.ConnectionPool(convoy_db.connection_config(password), workers)
+        if since is None:
+            tasks = [(build_rollup, (pool, tbl, key_exprs, source), tbl) for (tbl, _, key_exprs, source, _) in rollups]
+            logging.info("Computing %d rollups using %d workers.", len(tasks), workers)
+        else:
+            first_day = max(first_day, since.date())
+            tasks = [(build_window, (pool, tbl, key_defs, key_exprs, source, window_start, window_days), f"{tbl} for the window starting from {window_start}")
+                     for (tbl, key_defs, key_exprs, source, window_days) in rollups
+                     for window_start in windows(first_day, last_day, window_days)]
+            logging.info("Computing %d rollup windows from %s to %s using %d workers.", len(tasks), first_day, last_day, workers)
+        start_time = time.perf_counter()
+        failed = 0
+        with closing(pool), ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=len(tasks), unit="tasks") as pbar:
+            futures = {executor.submit(build, *args): description for (build, args, description) in tasks}
+            rows = 0
+            for future in as_completed(futures):
+                try:
+                    rows += future.result()
+                except mariadb.Error:
+                    logging.exception("Computing %s failed.", futures[future])
+                    failed += 1
+                pbar.set_postfix(rows=rows, failed=failed)
+                pbar.update()
+        if failed > 0:
+            if since is None:
+                logging.error("%d rollups failed. Rerun to rebuild them.", failed)
+            else:
+                logging.error("%d windows failed. Rerun with --since set to the earliest failed window to redo them.", failed)
+            sys.exit(1)
+        logging.info("Done computing rollups in %.1f seconds.", time.perf_counter() - start_time)
+
+
+if __name__ == '__main__':
+    create_rollups()
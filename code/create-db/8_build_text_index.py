@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import logging
+import os
+import shutil
+from contextlib import closing
+from typing import Iterator
+
+import click
+from mysql.connector.cursor import MySQLCursor
+from tqdm import tqdm
+
+import convoy_db
+from profiling import profiled, phase
+from text_index import IndexWriter, TextIndex
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def stream_texts(cur: MySQLCursor, batch_size: int) -> Iterator[tuple[int, str | None, str]]:
+    """Yields (tweet_id, lang, text) of all tweets with a text in primary key order, paging through tweets_a by
+    tweet_id so that every batch is a range read of the primary key"""
+    last_tweet_id = -1
+    while True:
+        cur.execute("SELECT tweet_id, lang, text FROM tweets_a WHERE tweet_id > %s AND text IS NOT NULL ORDER BY tweet_id LIMIT %s", (last_tweet_id, batch_size))
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            return
+        yield from rows
+        last_tweet_id = rows[-1][0]
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-o', '--output', required=True, help="directory to write the index to, replacing any index in it once the new one is complete")
+@click.option('-b', '--batch-size', default=50000, show_default=True, help="number of tweets to read per query")
+@click.option('-s', '--segment-mib', default=256, show_default=True, help="approximate memory in MiB to collect postings in before writing them out as a segment")
+@click.option('-q', '--query', multiple=True, help="query the finished index with this and log the number of matching tweets, e.g. to check the index")
+@profiled
+@click.command
+def build_text_index(password: str | None, output: str, batch_size: int, segment_mib: int, query: list[str]):
+    """Build an on-disk inverted index of tweet texts"""
+    with convoy_db.connection(password, "analytic read") as conn, closing(conn.cursor()) as cur:
+        cur: MySQLCursor
+        cur.execute("SELECT COUNT(*) FROM tweets_a")
+        (total,) = cur.fetchone()
+        tmp_output = f"{output.rstrip(os.sep)}.tmp"
+        shutil.rmtree(tmp_output, ignore_errors=True)
+        writer = IndexWriter(tmp_output, segment_mib * 1024 ** 2)
+        logging.info(f"Indexing the texts of up to {total} tweets into {tmp_output}.")
+        with phase("index"):
+            for (tweet_id, lang, text) in tqdm(stream_texts(cur, batch_size), total=total, unit="tweets"):
+                writer.add(tweet_id, lang, text)
+            writer.close()
+    logging.info(f"Wrote {len(writer.segments)} segments of {sum(segment['docs'] for segment in writer.segments)} tweets. Moving the index to {output}.")
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_output, output)
+    if len(query) > 0:
+        index = TextIndex(output)
+        for q in query:
+            logging.info(f"{len(index.search(q))} tweets match {q}")
+    logging.info("Done.")
+
+
+if __name__ == '__main__':
+    build_text_index()
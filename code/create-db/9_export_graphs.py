@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import datetime
+import json
+import logging
+import os
+import shutil
+from contextlib import closing
+
+import click
+from more_itertools import chunked
+from mysql.connector.cursor import MySQLCursor
+from tqdm import tqdm
+
+import convoy_db
+from interaction_graphs import CsrWriter, NpyWriter, levels
+from profiling import profiled, phase
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+epoch_seconds = "TIMESTAMPDIFF(SECOND, '1970-01-01', t.created_at)"
+
+# The ids of the nodes of each level, by level as (id column, queries of the ids).
+node_sources = {
+    "tweet": ("tweet_id", [
+        "SELECT tweet_id FROM tweets_a",
+        "SELECT in_reply_to FROM tweets_a WHERE in_reply_to IS NOT NULL",
+        "SELECT quotes FROM tweets_a WHERE quotes IS NOT NULL",
+        "SELECT retweet_of FROM tweets_a WHERE retweet_of IS NOT NULL"
+    ]),
+    "user": ("user_id", [
+        "SELECT user_id FROM users_a",
+        "SELECT author_id FROM tweets_a WHERE author_id IS NOT NULL",
+        "SELECT in_reply_to_user_id FROM tweets_a WHERE in_reply_to_user_id IS NOT NULL",
+        "SELECT user_id FROM tweet_mentions_a"
+    ])
+}
+
+# Tweet graphs as (name, column of tweets_a referencing the target tweet). A tweet has at most one edge of each kind.
+tweet_graphs = [
+    ("reply", "in_reply_to"),
+    ("quote", "quotes"),
+    ("retweet", "retweet_of")
+]
+
+# User graphs as (name, source of the tweets making up the edges, target user id). The source user is the author of t.
+user_graphs = [
+    ("reply", "tweets_a t", "t.in_reply_to_user_id"),
+    ("quote", "tweets_a t INNER JOIN tweets_a q ON q.tweet_id = t.quotes", "q.author_id"),
+    ("retweet", "tweets_a t INNER JOIN tweets_a r ON r.tweet_id = t.retweet_of", "r.author_id"),
+    ("mention", "tweets_a t INNER JOIN tweet_mentions_a m USING (tweet_id)", "m.user_id")
+]
+
+
+def prepare_nodes_table(cur: MySQLCursor, level: str) -> int:
+    """Number the ids of a level densely from 0 in graph_<level>_nodes_i, returning the number of nodes"""
+    (id_col, queries) = node_sources[level]
+    cur.execute(f"DROP TABLE IF EXISTS graph_{level}_nodes_i")
+    cur.execute(f"""
+        CREATE TABLE graph_{level}_nodes_i (
+            {id_col} BIGINT UNSIGNED PRIMARY KEY,
+            node INTEGER UNSIGNED NOT NULL
+        ) ENGINE=ARIA TRANSACTIONAL=0 PAGE_CHECKSUM=0""")
+    cur.execute(f"""
+        INSERT INTO graph_{level}_nodes_i
+        SELECT {id_col}, ROW_NUMBER() OVER (ORDER BY {id_col}) - 1 FROM ({' UNION '.join(queries)}) AS ids""")
+    return cur.rowcount
+
+
+def stream(cur: MySQLCursor, stmt: str, batch_size: int):
+    cur.execute(stmt)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if len(rows) == 0:
+            return
+        yield from rows
+
+
+def export_nodes(cur: MySQLCursor, output: str, level: str, batch_size: int):
+    (id_col, _) = node_sources[level]
+    writer = NpyWriter(os.path.join(output, level, "nodes.npy"), 'Q')
+    for rows in chunked(stream(cur, f"SELECT {id_col} FROM graph_{level}_nodes_i ORDER BY node", batch_size), batch_size):
+        writer.extend(id for (id,) in rows)
+    writer.close()
+
+
+def export_graph(cur: MySQLCursor, path: str, nodes: int, stmt: str, value_typecodes: dict[str, str], batch_size: int) -> int:
+    """Write the edges selected by stmt as (source node, target node, *values), ordered by source and target node,
+    into the CSR arrays of a graph, returning the number of edges"""
+    writer = CsrWriter(path, nodes, value_typecodes, batch_size)
+    for row in tqdm(stream(cur, stmt, batch_size), unit="edges", unit_scale=True, desc=os.path.basename(path), leave=False):
+        writer.add(*row)
+    writer.close()
+    return writer.edges
+
+
+def graph_statements(level: str) -> list[tuple[str, str, dict[str, str]]]:
+    """Returns the (name, statement, value typecodes) of the graphs of a level"""
+    if level == "tweet":
+        return [(name, f"""
+                 SELECT s.node, d.node, {epoch_seconds}
+                 FROM tweets_a t
+                 INNER JOIN graph_tweet_nodes_i s ON s.tweet_id = t.tweet_id
+                 INNER JOIN graph_tweet_nodes_i d ON d.tweet_id = t.{col}
+                 WHERE t.created_at IS NOT NULL
+                 ORDER BY s.node, d.node""", dict(times='q'))
+                for (name, col) in tweet_graphs]
+    return [(name, f"""
+             SELECT s.node, d.node, COUNT(*), MIN({epoch_seconds}), MAX({epoch_seconds})
+             FROM {source}
+             INNER JOIN graph_user_nodes_i s ON s.user_id = t.author_id
+             INNER JOIN graph_user_nodes_i d ON d.user_id = {target}
+             WHERE t.created_at IS NOT NULL
+             GROUP BY s.node, d.node
+             ORDER BY s.node, d.node""", dict(weights='I', first_seen='q', last_seen='q'))
+            for (name, source, target) in user_graphs]
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-o', '--output', required=True, help="directory to write the graphs to, replacing any export in it once the new one is complete")
+@click.option('-l', '--level', 'export_levels', type=click.Choice(levels), multiple=True, default=levels, show_default=True, help="levels of graphs to export")
+@click.option('-b', '--batch-size', default=100000, show_default=True, help="number of rows to fetch and write at a time")
+@profiled
+@click.command
+def export_graphs(password: str | None, output: str, export_levels: list[str], batch_size: int):
+    """Export the reply, quote, retweet and mention graphs of tweets and users as CSR arrays"""
+    tmp_output = f"{output.rstrip(os.sep)}.tmp"
+    shutil.rmtree(tmp_output, ignore_errors=True)
+    manifest = dict(version=1, created=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'))
+    with convoy_db.connection(password, "analytic read") as conn:
+        for level in export_levels:
+            with closing(conn.cursor()) as cur:
+                cur: MySQLCursor
+                logging.info(f"Numbering {level} nodes.")
+                nodes = prepare_nodes_table(cur, level)
+            os.makedirs(os.path.join(tmp_output, level))
+            with closing(conn.cursor(buffered=False)) as cur:
+                cur: MySQLCursor
+                export_nodes(cur, tmp_output, level, batch_size)
+            manifest[level] = dict(nodes=nodes, graphs=dict())
+            for (name, stmt, value_typecodes) in graph_statements(level):
+                logging.info(f"Exporting the {level} {name} graph.")
+                with phase(f"{level}-{name}"), closing(conn.cursor(buffered=False)) as cur:
+                    cur: MySQLCursor
+                    edges = export_graph(cur, os.path.join(tmp_output, level, name), nodes, stmt, value_typecodes, batch_size)
+                manifest[level]["graphs"][name] = dict(edges=edges, arrays=["indptr", "indices"] + list(value_typecodes))
+                logging.info(f"The {level} {name} graph has {edges} edges between {nodes} nodes.")
+            with closing(conn.cursor()) as cur:
+                cur.execute(f"DROP TABLE graph_{level}_nodes_i")
+    with open(os.path.join(tmp_output, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    logging.info(f"Moving the export to {output}.")
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_output, output)
+    logging.info("Done.")
+
+
+if __name__ == '__main__':
+    export_graphs()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""Read access to ur-conversation trees for analysis. A tree is fetched from tweets_a with one range query on the
+(ur_conversation_id, tweet_id) index and kept as parallel arrays, so that many trees fit in a TreeStore's LRU cache.
+Parents and edge kinds are decided by parent_edge, the same way 3_create_tweet_stats_i.py does when counting the
+statistics."""
+import logging
+import math
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import closing
+from typing import Iterable
+
+import click
+from mysql.connector.cursor import MySQLCursor
+
+import convoy_db
+
+# Kinds of the edge from a tweet to its parent in a ur-conversation tree.
+ROOT = 0
+REPLY = 1
+RETWEET = 2
+QUOTE = 3
+edge_kinds = ('root', 'reply', 'retweet', 'quote')
+
+int_cols = [
+    'children',
+    'descendants',
+    'leaf_descendants',
+    'max_depth',
+    't_authors',
+    't_reply_count',
+    't_quote_count',
+    't_like_count',
+    't_retweet_count'
+]
+
+float_cols = [
+    'branching_factor',
+    'mean_depth',
+    'depth_mad',
+    'mean_reply_count',
+    'reply_count_mad',
+    'mean_quote_count',
+    'quote_count_mad',
+    'mean_like_count',
+    'like_count_mad',
+    'mean_retweet_count',
+    'retweet_count_mad'
+]
+
+# Columns of tweet_stats_i after tweet_id, in table order.
+stats_cols = [c for col in int_cols for c in (col, f"ur_{col}")] + [c for col in float_cols for c in (col, f"ur_{col}")]
+
+select_stmt = f"SELECT ur_conversation_id, tweet_id, in_reply_to, retweet_of, quotes, author_id, {', '.join(stats_cols)} FROM tweets_a"
+
+
+def parent_edge(in_reply_to: int | None, retweet_of: int | None, quotes: int | None) -> tuple[int | None, int]:
+    """Returns the parent of a tweet in its ur-conversation tree and the kind of the edge to it. A tweet referring to
+    several others hangs under the tweet it replies to, failing that the one it retweets, failing that the one it quotes."""
+    if in_reply_to is not None:
+        return in_reply_to, REPLY
+    if retweet_of is not None:
+        return retweet_of, RETWEET
+    if quotes is not None:
+        return quotes, QUOTE
+    return None, ROOT
+
+
+class ConversationTree:
+    """The tweets of one ur-conversation, sorted by tweet id. For the tweet at position i, parents[i] is the position of
+    its parent or -1 if it has none in the ur-conversation, kinds[i] the kind of edge to the parent and stats[i * n:(i + 1) * n]
+    its n = len(stats_cols) tweet_stats_i metrics, NaN where missing. The children of the tweet at position i are at
+    positions child_positions[child_offsets[i]:child_offsets[i + 1]]."""
+    __slots__ = ('ur_conversation_id', 'tweet_ids', 'author_ids', 'parents', 'kinds', 'stats', 'child_offsets', 'child_positions')
+
+    def __init__(self, ur_conversation_id: int, rows: list[tuple]):
+        self.ur_conversation_id = ur_conversation_id
+        self.tweet_ids = array('Q', (row[1] for row in rows))
+        self.author_ids = array('Q', (row[5] or 0 for row in rows))
+        self.parents = array('l', [-1]) * len(rows)
+        self.kinds = bytearray(len(rows))
+        self.stats = array('d', (math.nan if value is None else value for row in rows for value in row[6:]))
+        child_counts = [0] * (len(rows) + 1)
+        for (position, row) in enumerate(rows):
+            (parent, kind) = parent_edge(row[2], row[3], row[4])
+            parent_position = self.position(parent) if parent is not None else -1
+            self.parents[position] = parent_position
+            self.kinds[position] = kind if parent_position != -1 else ROOT
+            if parent_position != -1:
+                child_counts[parent_position + 1] += 1
+        for position in range(len(rows)):
+            child_counts[position + 1] += child_counts[position]
+        self.child_offsets = array('l', child_counts)
+        self.child_positions = array('l', [0]) * child_counts[-1]
+        filled = child_counts[:-1]
+        for (position, parent_position) in enumerate(self.parents):
+            if parent_position != -1:
+                self.child_positions[filled[parent_position]] = position
+                filled[parent_position] += 1
+
+    def __len__(self) -> int:
+        return len(self.tweet_ids)
+
+    def __contains__(self, tweet_id: int) -> bool:
+        return self.position(tweet_id) != -1
+
+    def position(self, tweet_id: int) -> int:
+        """Returns the position of a tweet in the tree, or -1 if it is not in it"""
+        position = bisect_left(self.tweet_ids, tweet_id)
+        return position if position < len(self.tweet_ids) and self.tweet_ids[position] == tweet_id else -1
+
+    def _checked_position(self, tweet_id: int) -> int:
+        position = self.position(tweet_id)
+        if position == -1:
+            raise KeyError(tweet_id)
+        return position
+
+    def parent(self, tweet_id: int) -> int | None:
+        parent_position = self.parents[self._checked_position(tweet_id)]
+        return self.tweet_ids[parent_position] if parent_position != -1 else None
+
+    def kind(self, tweet_id: int) -> str:
+        """Returns the kind of the edge from a tweet to its parent: reply, retweet or quote, or root for a tweet whose
+        parent is not in the ur-conversation"""
+        return edge_kinds[self.kinds[self._checked_position(tweet_id)]]
+
+    def children(self, tweet_id: int) -> list[int]:
+        position = self._checked_position(tweet_id)
+        return [self.tweet_ids[child] for child in self.child_positions[self.child_offsets[position]:self.child_offsets[position + 1]]]
+
+    def roots(self) -> list[int]:
+        return [self.tweet_ids[position] for (position, parent) in enumerate(self.parents) if parent == -1]
+
+    def author(self, tweet_id: int) -> int | None:
+        return self.author_ids[self._checked_position(tweet_id)] or None
+
+    def metrics(self, tweet_id: int) -> dict[str, int | float | None]:
+        """Returns the tweet_stats_i metrics of a tweet by column name, None where the tweet has no statistics"""
+        start = self._checked_position(tweet_id) * len(stats_cols)
+        return {col: None if math.isnan(value) else int(value) if i < 2 * len(int_cols) else value
+                for (i, (col, value)) in enumerate(zip(stats_cols, self.stats[start:start + len(stats_cols)]))}
+
+    def edges(self) -> Iterable[tuple[int, int, str]]:
+        """Yields (parent, child, kind) for every edge in the tree"""
+        for (position, parent_position) in enumerate(self.parents):
+            if parent_position != -1:
+                yield self.tweet_ids[parent_position], self.tweet_ids[position], edge_kinds[self.kinds[position]]
+
+    def nbytes(self) -> int:
+        """Approximate memory taken by the tree"""
+        return (sum(a.itemsize * len(a) for a in (self.tweet_ids, self.author_ids, self.parents, self.stats, self.child_offsets, self.child_positions))
+                + len(self.kinds) + 64 * len(self.__slots__))
+
+
+def group_trees(rows: list[tuple]) -> dict[int, ConversationTree]:
+    """Builds trees from rows of select_stmt ordered by ur_conversation_id and tweet_id"""
+    trees = dict()
+    start = 0
+    for end in range(1, len(rows) + 1):
+        if end == len(rows) or rows[end][0] != rows[start][0]:
+            trees[rows[start][0]] = ConversationTree(rows[start][0], rows[start:end])
+            start = end
+    return trees
+
+
+class TreeStore:
+    """Fetches ur-conversation trees through a cursor and keeps the most recently used ones in memory, evicting the least
+    recently used once the trees take more than max_bytes. A tree larger than max_bytes by itself is returned but not kept.
+    Lookups of several trees at once are answered from the cache where possible and with a single query for the rest.
+    The ur-conversations of the tweets in the cached trees are kept in a map alongside the cache, which is counted in
+    the bytes taken by the trees."""
+
+    # Approximate memory taken by the entry of one tweet in the map from tweet ids to ur-conversation ids.
+    tweet_entry_bytes = 100
+
+    def __init__(self, cur: MySQLCursor, max_bytes: int = 512 * 1024 ** 2):
+        self.cur = cur
+        self.max_bytes = max_bytes
+        self.cache: OrderedDict[int, ConversationTree] = OrderedDict()
+        self.ur_conversation_ids: dict[int, int] = dict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _size(self, tree: ConversationTree) -> int:
+        return tree.nbytes() + self.tweet_entry_bytes * len(tree)
+
+    def _uncache(self, ur_conversation_id: int):
+        tree = self.cache.pop(ur_conversation_id)
+        self.cached_bytes -= self._size(tree)
+        for tweet_id in tree.tweet_ids:
+            if self.ur_conversation_ids.get(tweet_id) == ur_conversation_id:
+                del self.ur_conversation_ids[tweet_id]
+
+    def _cache(self, tree: ConversationTree):
+        size = self._size(tree)
+        if size > self.max_bytes:
+            return
+        if tree.ur_conversation_id in self.cache:
+            self._uncache(tree.ur_conversation_id)
+        self.cache[tree.ur_conversation_id] = tree
+        self.cached_bytes += size
+        for tweet_id in tree.tweet_ids:
+            self.ur_conversation_ids[tweet_id] = tree.ur_conversation_id
+        while self.cached_bytes > self.max_bytes:
+            self._uncache(next(iter(self.cache)))
+
+    def _fetch(self, condition: str, params: list[int]) -> dict[int, ConversationTree]:
+        self.cur.execute(f"{select_stmt} WHERE {condition} ORDER BY ur_conversation_id, tweet_id", params)
+        trees = group_trees(self.cur.fetchall())
+        for tree in trees.values():
+            self._cache(tree)
+        return trees
+
+    def trees(self, ur_conversation_ids: Iterable[int]) -> dict[int, ConversationTree]:
+        """Returns the trees of the given ur-conversations that exist, by ur-conversation id"""
+        found = dict()
+        missing = []
+        for ur_conversation_id in dict.fromkeys(ur_conversation_ids):
+            if ur_conversation_id in self.cache:
+                self.cache.move_to_end(ur_conversation_id)
+                found[ur_conversation_id] = self.cache[ur_conversation_id]
+            else:
+                missing.append(ur_conversation_id)
+        self.hits += len(found)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            found.update(self._fetch(f"ur_conversation_id IN ({','.join(['%s'] * len(missing))})", missing))
+        return found
+
+    def trees_of_tweets(self, tweet_ids: Iterable[int]) -> dict[int, ConversationTree]:
+        """Returns the trees of the ur-conversations the given tweets are in, by tweet id, for the tweets that exist"""
+        found = dict()
+        missing = []
+        for tweet_id in dict.fromkeys(tweet_ids):
+            ur_conversation_id = self.ur_conversation_ids.get(tweet_id)
+            if ur_conversation_id is not None:
+                self.cache.move_to_end(ur_conversation_id)
+                found[tweet_id] = self.cache[ur_conversation_id]
+            else:
+                missing.append(tweet_id)
+        self.hits += len(found)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            fetched = self._fetch(f"ur_conversation_id IN (SELECT ur_conversation_id FROM tweets_a WHERE tweet_id IN ({','.join(['%s'] * len(missing))}))", missing)
+            fetched_trees = {tweet_id: tree for tree in fetched.values() for tweet_id in tree.tweet_ids}
+            for tweet_id in missing:
+                if tweet_id in fetched_trees:
+                    found[tweet_id] = fetched_trees[tweet_id]
+        return found
+
+    def tree(self, ur_conversation_id: int) -> ConversationTree | None:
+        return self.trees([ur_conversation_id]).get(ur_conversation_id)
+
+    def tree_of_tweet(self, tweet_id: int) -> ConversationTree | None:
+        return self.trees_of_tweets([tweet_id]).get(tweet_id)
+
+
+def print_tree(tree: ConversationTree):
+    stack = [(root, 0) for root in reversed(tree.roots())]
+    while len(stack) > 0:
+        (tweet_id, depth) = stack.pop()
+        metrics = tree.metrics(tweet_id)
+        print(f"{'  ' * depth}{tree.kind(tweet_id)} {tweet_id} by {tree.author(tweet_id)}: {metrics['descendants']} descendants, {metrics['ur_descendants']} ur-descendants")
+        stack.extend((child, depth + 1) for child in reversed(tree.children(tweet_id)))
+
+
+@click.option('-p', '--password', help="database password, by default the one configured for convoy_db")
+@click.option('-t', '--tweet', 'by_tweet', is_flag=True, help="the ids are of tweets in the ur-conversations rather than of the ur-conversations")
+@click.argument('ids', nargs=-1, type=int)
+@click.command
+def show_trees(password: str | None, by_tweet: bool, ids: list[int]):
+    """Print the trees of the given ur-conversations"""
+    with convoy_db.connection(password, "analytic read") as conn, closing(conn.cursor()) as cur:
+        store = TreeStore(cur)
+        trees = store.trees_of_tweets(ids) if by_tweet else store.trees(ids)
+        for id in ids:
+            if id not in trees:
+                logging.warning(f"No ur-conversation found for {id}.")
+                continue
+            print(f"ur-conversation {trees[id].ur_conversation_id} ({len(trees[id])} tweets):")
+            print_tree(trees[id])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    show_trees()
@@ -0,0 +1,203 @@
+"""Connections to the convoy database, shared by all stages.
+
+Connection parameters default to the convoy database on vm1788.kaj.pouta.csc.fi. They are overridden by the [database]
+section (host, port, user, password, database) of the configuration file named by CONVOY_DB_CONFIG, by default
+~/.config/convoy/db.ini, then by the environment variables CONVOY_DB_HOST, CONVOY_DB_PORT, CONVOY_DB_USER,
+CONVOY_DB_PASSWORD and CONVOY_DB_DATABASE, and last by a password given on the command line.
+
+Connections are opened with one of the session_profiles, which set session variables suited to a kind of work. Pooled
+connections get the variables they had back when they are returned to the pool. The variables of a profile can be
+changed in a [profile <name>] section of the configuration file, e.g. to compare load times on a local MariaDB, and
+the values in effect are logged the first time a profile is used."""
+import configparser
+import logging
+import os
+import queue
+import threading
+from contextlib import closing, contextmanager
+from typing import Iterator
+
+import mariadb
+
+defaults = dict(user="convoy",
+                host="vm1788.kaj.pouta.csc.fi",
+                port=3306,
+                database="convoy")
+
+session_profiles = {
+    "default": {},
+    # Loading rows into tables whose keys are disabled or built afterwards. Unique checks stay on, as the loader and
+    # the enrichment stages rely on INSERT IGNORE against the primary keys to drop duplicates.
+    "bulk load": {
+        "sql_log_bin": 0,
+        "bulk_insert_buffer_size": 256 * 1024 ** 2,
+        "net_read_timeout": 3600,
+        "net_write_timeout": 3600,
+    },
+    # Copying ranges of a table keyed the same as the target, which can't contain duplicates, so that unique keys may
+    # be built by sorting.
+    "bulk copy": {
+        "unique_checks": 0,
+        "sql_log_bin": 0,
+        "bulk_insert_buffer_size": 256 * 1024 ** 2,
+        "net_read_timeout": 3600,
+        "net_write_timeout": 3600,
+    },
+    # ENABLE KEYS and ALTER TABLE ... ADD INDEX, which sort the keys in aria_sort_buffer_size.
+    "index build": {
+        "aria_sort_buffer_size": 1024 ** 3,
+        "sql_log_bin": 0,
+        "net_read_timeout": 3600,
+        "net_write_timeout": 3600,
+    },
+    # Long aggregating and scanning queries.
+    "analytic read": {
+        "join_buffer_size": 64 * 1024 ** 2,
+        "sort_buffer_size": 64 * 1024 ** 2,
+        "tmp_table_size": 1024 ** 3,
+        "max_heap_table_size": 1024 ** 3,
+        "max_statement_time": 0,
+        "net_write_timeout": 3600,
+    },
+}
+
+# Profiles whose values have been logged, and the (profile, variable) pairs that could not be set and aren't tried again.
+_logged_profiles = set()
+_failed_variables = set()
+_logged_lock = threading.Lock()
+
+
+def read_config_file() -> configparser.ConfigParser:
+    config_file = configparser.ConfigParser()
+    config_file.read(os.environ.get("CONVOY_DB_CONFIG", os.path.expanduser("~/.config/convoy/db.ini")))
+    return config_file
+
+
+def connection_config(password: str | None = None, database: str | None = "convoy") -> dict:
+    """Returns the parameters to connect with, see the module documentation. With database None, connects without
+    selecting a database."""
+    config = dict(defaults)
+    config_file = read_config_file()
+    if config_file.has_section("database"):
+        config.update(config_file["database"])
+    for key in ("host", "port", "user", "password", "database"):
+        if f"CONVOY_DB_{key.upper()}" in os.environ:
+            config[key] = os.environ[f"CONVOY_DB_{key.upper()}"]
+    if password is not None:
+        config["password"] = password
+    if database is None:
+        config.pop("database", None)
+    config["port"] = int(config["port"])
+    config["autocommit"] = True
+    return config
+
+
+def profile_variables(profile: str) -> dict[str, str | int]:
+    if profile not in session_profiles:
+        raise ValueError(f"Unknown session profile {profile}. Known profiles are {', '.join(session_profiles)}.")
+    variables = dict(session_profiles[profile])
+    config_file = read_config_file()
+    if config_file.has_section(f"profile {profile}"):
+        variables.update({variable: int(value) if value.isdigit() else value for (variable, value) in config_file[f"profile {profile}"].items()})
+    return variables
+
+
+def apply_profile(conn, profile: str) -> dict[str, str | int]:
+    """Sets the session variables of a profile on a connection, skipping the ones the server or user doesn't allow
+    setting, e.g. sql_log_bin without the SUPER privilege, and returns the previous values of the variables that were set"""
+    previous = dict()
+    with closing(conn.cursor()) as cur:
+        for (variable, value) in profile_variables(profile).items():
+            if (profile, variable) in _failed_variables:
+                continue
+            try:
+                cur.execute(f"SELECT @@SESSION.{variable}")
+                (previous_value,) = cur.fetchone()
+                cur.execute(f"SET SESSION {variable} = %s", (value,))
+                previous[variable] = previous_value
+            except mariadb.Error as e:
+                logging.warning(f"Could not set {variable} for session profile {profile}, leaving it out: {e}")
+                with _logged_lock:
+                    _failed_variables.add((profile, variable))
+        with _logged_lock:
+            if profile not in _logged_profiles and len(previous) > 0:
+                _logged_profiles.add(profile)
+                cur.execute(f"SELECT {', '.join(f'@@SESSION.{variable}' for variable in previous)}")
+                logging.info(f"Session profile {profile}: {', '.join(f'{variable}={value}' for (variable, value) in zip(previous, cur.fetchone()))}")
+    return previous
+
+
+def restore_variables(conn, previous: dict[str, str | int]):
+    with closing(conn.cursor()) as cur:
+        for (variable, value) in previous.items():
+            cur.execute(f"SET SESSION {variable} = %s", (value,))
+
+
+def connect(config: dict, profile: str = "default"):
+    """Opens a connection outside any pool, with the session variables of profile set for its lifetime"""
+    conn = mariadb.connect(**config)
+    apply_profile(conn, profile)
+    return conn
+
+
+class ConnectionPool:
+    """At most size connections, shared between threads. Borrowing a connection when all are in use waits for one to
+    be returned."""
+
+    def __init__(self, config: dict, size: int = 8):
+        self.config = config
+        self.idle = queue.LifoQueue()
+        self.slots = threading.Semaphore(size)
+
+    @contextmanager
+    def connection(self, profile: str = "default") -> Iterator:
+        self.slots.acquire()
+        conn = None
+        try:
+            try:
+                conn = self.idle.get_nowait()
+                conn.ping()
+            except queue.Empty:
+                conn = mariadb.connect(**self.config)
+            except mariadb.Error:
+                conn.close()
+                conn = mariadb.connect(**self.config)
+            previous = apply_profile(conn, profile)
+            try:
+                yield conn
+            except mariadb.InterfaceError:
+                conn.close()
+                conn = None
+                raise
+            restore_variables(conn, previous)
+            self.idle.put(conn)
+            conn = None
+        finally:
+            if conn is not None:
+                conn.close()
+            self.slots.release()
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+_pools: dict[tuple, ConnectionPool] = dict()
+_pools_lock = threading.Lock()
+
+
+def pool(password: str | None = None, database: str | None = "convoy") -> ConnectionPool:
+    """Returns the pool of this process for the given connection parameters"""
+    config = connection_config(password, database)
+    key = tuple(sorted(config.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(config)
+        return _pools[key]
+
+
+@contextmanager
+def connection(password: str | None = None, profile: str = "default", database: str | None = "convoy") -> Iterator:
+    """Borrows a connection from the pool with the session variables of profile set"""
+    with pool(password, database).connection(profile) as conn:
+        yield conn
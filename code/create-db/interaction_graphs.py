@@ -0,0 +1,146 @@
+"""Interaction graphs of tweets and users in compressed sparse row (CSR) form, written by 9_export_graphs.py so that
+network analyses can load a whole graph without the database.
+
+An export is a directory with a manifest.json and a subdirectory per level, tweet and user. The nodes of a level are
+numbered densely from 0 in increasing order of their tweet or user ids, and <level>/nodes.npy maps node numbers back to
+the ids. All graphs of a level share the same numbering, so they can be combined. Each graph is a directory
+<level>/<graph> of arrays:
+
+- indptr.npy: the edges from node i are the edges indptr[i] to indptr[i + 1], so that there are nodes + 1 entries
+- indices.npy: the target node of each edge, sorted within the edges of a source node
+- times.npy: for tweet graphs, the creation time of the source tweet in seconds since the epoch (UTC)
+- weights.npy, first_seen.npy and last_seen.npy: for user graphs, the number of tweets making up each edge and the
+  first and last of their creation times in seconds since the epoch (UTC)
+
+The arrays are .npy files in format version 1.0, so numpy.load(file, mmap_mode='r') maps them directly and
+scipy.sparse.csr_matrix((weights, indices, indptr)) turns a user graph into a sparse matrix. read_npy and Graph read
+them memory-mapped without numpy."""
+import ast
+import json
+import mmap
+import os
+import sys
+from array import array
+from typing import Iterable
+
+# The .npy dtype of each array typecode used. Arrays are written little-endian whatever the platform.
+npy_dtypes = {'i': '<i4', 'I': '<u4', 'q': '<i8', 'Q': '<u8'}
+typecodes = {dtype: typecode for (typecode, dtype) in npy_dtypes.items()}
+npy_magic = b'\x93NUMPY\x01\x00'
+# Headers are padded to a fixed length, so that the final shape can be written over the header once all values are in.
+npy_header_bytes = 128
+
+levels = ("tweet", "user")
+
+
+def npy_header(typecode: str, length: int) -> bytes:
+    header = repr(dict(descr=npy_dtypes[typecode], fortran_order=False, shape=(length,))).encode('latin1')
+    header = header.ljust(npy_header_bytes - len(npy_magic) - 2 - 1) + b'\n'
+    return npy_magic + len(header).to_bytes(2, 'little') + header
+
+
+class NpyWriter:
+    """Appends values to a one-dimensional .npy file without keeping them in memory"""
+
+    def __init__(self, file_name: str, typecode: str):
+        self.typecode = typecode
+        self.length = 0
+        self.f = open(file_name, "wb")
+        self.f.write(npy_header(typecode, 0))
+
+    def extend(self, values: Iterable[int]):
+        values = array(self.typecode, values)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        values.tofile(self.f)
+        self.length += len(values)
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(npy_header(self.typecode, self.length))
+        self.f.close()
+
+
+def read_npy(file_name: str) -> memoryview:
+    """Returns the values of a one-dimensional .npy file written by NpyWriter, memory-mapped"""
+    with open(file_name, "rb") as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if m[:len(npy_magic)] != npy_magic:
+        raise ValueError(f"{file_name} is not a version 1.0 .npy file.")
+    header_end = len(npy_magic) + 2 + int.from_bytes(m[len(npy_magic):len(npy_magic) + 2], 'little')
+    header = ast.literal_eval(m[len(npy_magic) + 2:header_end].decode('latin1'))
+    if header['descr'] not in typecodes or header['fortran_order'] or len(header['shape']) != 1 or sys.byteorder == 'big':
+        raise ValueError(f"Can't map {file_name} of {header}.")
+    return memoryview(m)[header_end:].cast(typecodes[header['descr']])
+
+
+class CsrWriter:
+    """Writes the arrays of one graph from edges added in order of source node. value_typecodes gives the names and
+    typecodes of the arrays of per-edge values, in the order the values are passed to add."""
+
+    def __init__(self, path: str, nodes: int, value_typecodes: dict[str, str], batch_size: int = 100000):
+        os.makedirs(path, exist_ok=True)
+        self.nodes = nodes
+        self.batch_size = batch_size
+        self.indptr = NpyWriter(os.path.join(path, "indptr.npy"), 'q')
+        self.indices = NpyWriter(os.path.join(path, "indices.npy"), 'i' if nodes < 2 ** 31 else 'q')
+        self.values = [NpyWriter(os.path.join(path, f"{name}.npy"), typecode) for (name, typecode) in value_typecodes.items()]
+        self.edges = 0
+        self.next_node = 0
+        self.batch: list[tuple] = []
+
+    def add(self, source: int, target: int, *values: int):
+        if source < self.next_node - 1:
+            raise ValueError(f"Edge from node {source} added after edges from node {self.next_node - 1}. Edges must be added in order of source node.")
+        # Every node up to the source starts where the edges added so far end.
+        self.indptr.extend([self.edges] * (source + 1 - self.next_node))
+        self.next_node = max(self.next_node, source + 1)
+        self.batch.append((target, *values))
+        self.edges += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        columns = list(zip(*self.batch))
+        if len(columns) > 0:
+            for (writer, column) in zip([self.indices] + self.values, columns):
+                writer.extend(column)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.indptr.extend([self.edges] * (self.nodes + 1 - self.next_node))
+        for writer in [self.indptr, self.indices] + self.values:
+            writer.close()
+
+
+class Graph:
+    """A graph of an export, memory-mapped"""
+
+    def __init__(self, path: str, level: str, graph: str):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)[level]["graphs"][graph]
+        self.nodes = read_npy(os.path.join(path, level, "nodes.npy"))
+        self.arrays = {name: read_npy(os.path.join(path, level, graph, f"{name}.npy")) for name in self.manifest["arrays"]}
+        self.indptr = self.arrays["indptr"]
+        self.indices = self.arrays["indices"]
+
+    def node(self, id: int) -> int | None:
+        """Returns the node number of a tweet or user id, or None if it is not in the graph"""
+        (low, high) = (0, len(self.nodes))
+        while low < high:
+            middle = (low + high) // 2
+            if self.nodes[middle] < id:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < len(self.nodes) and self.nodes[low] == id else None
+
+    def edges(self, node: int) -> range:
+        """Returns the positions of the edges from a node in indices and the per-edge arrays"""
+        return range(self.indptr[node], self.indptr[node + 1])
+
+    def targets(self, id: int) -> list[int]:
+        """Returns the ids the given tweet or user id has edges to"""
+        node = self.node(id)
+        return [] if node is None else [self.nodes[self.indices[edge]] for edge in self.edges(node)]
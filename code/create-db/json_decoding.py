@@ -0,0 +1,59 @@
+"""Interchangeable JSON decoders for the pages of the crawl files. Every decoder takes one line as bytes and raises
+json.JSONDecodeError for anything it can't decode, so callers can skip bad lines the same way whatever the backend."""
+import json
+from json import JSONDecodeError
+from typing import Any
+
+
+class StdlibDecoder:
+    name = 'json'
+
+    def decode(self, line: bytes) -> Any:
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            raise JSONDecodeError(str(e), '', 0) from e
+
+
+class OrjsonDecoder:
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+
+    def decode(self, line: bytes) -> Any:
+        try:
+            return self.loads(line)
+        except ValueError as e:
+            raise JSONDecodeError(str(e), '', 0) from e
+
+
+class SimdjsonDecoder:
+    """Decodes lazily with pysimdjson: a page is returned as a proxy object, and only the members that are actually
+    read are converted to Python objects. The proxies are only valid until the next line is decoded."""
+    name = 'simdjson'
+
+    def __init__(self):
+        import simdjson
+        self.parser = simdjson.Parser()
+
+    def decode(self, line: bytes) -> Any:
+        try:
+            return self.parser.parse(line)
+        except ValueError as e:
+            raise JSONDecodeError(str(e), '', 0) from e
+
+
+decoders = {decoder.name: decoder for decoder in (OrjsonDecoder, SimdjsonDecoder, StdlibDecoder)}
+
+
+def get_decoder(name: str = 'auto') -> StdlibDecoder | OrjsonDecoder | SimdjsonDecoder:
+    """Returns the named decoder, or for 'auto' the first installed of orjson, simdjson and the standard library json"""
+    if name != 'auto':
+        return decoders[name]()
+    for decoder in decoders.values():
+        try:
+            return decoder()
+        except ImportError:
+            pass
@@ -0,0 +1,198 @@
+"""Profiling harness shared by the click entry points of the pipeline, including the fetcher in
+code/fetch-conversations. Decorating a command with @profiled adds --profile, which writes a report directory per run
+with:
+
+- wall.folded and wall_top.txt: wall clock stacks of all threads sampled every --profile-interval seconds, in the
+  folded format of flamegraph.pl and speedscope, and the functions with the most samples. Threads waiting on the
+  database or the disk are sampled as much as running ones, so compare with the CPU time in summary.txt
+- memory-<phase>.txt: with --profile-memory, the peak and the largest allocation sites of the phases stages mark with
+  phase(), traced with tracemalloc
+- sql.tsv: for stages talking to the database, the time, calls and rows of each statement digest run during the
+  stage, taken from performance_schema on the server
+- summary.txt: arguments, wall and CPU time and maximum RSS
+
+Sampling and the statement digests cost little enough to leave on in production runs. tracemalloc slows allocation
+heavy code down noticeably, which is why it has a flag of its own."""
+import datetime
+import functools
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import closing, contextmanager
+
+import click
+
+active: 'Profiler | None' = None
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of all other threads, whether they are running or waiting"""
+
+    def __init__(self, interval: float):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for (thread_id, frame) in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, report_dir: str, top: int = 40):
+        with open(os.path.join(report_dir, "wall.folded"), "w") as f:
+            for (stack, count) in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        own = Counter()
+        total = Counter()
+        for (stack, count) in self.stacks.items():
+            functions = stack.split(';')
+            own[functions[-1]] += count
+            for function in set(functions):
+                total[function] += count
+        samples = sum(self.stacks.values())
+        with open(os.path.join(report_dir, "wall_top.txt"), "w") as f:
+            f.write(f"{self.samples} samples every {self.interval} s, {samples} thread stacks\n")
+            for (title, counter) in (("own", own), ("total", total)):
+                f.write(f"\nby {title} samples:\n")
+                for (function, count) in counter.most_common(top):
+                    f.write(f"{count:10d} {100 * count / max(samples, 1):6.2f}% {function}\n")
+
+
+def statement_digests(password: str | None) -> dict[str, tuple[str, int, int, int, int]]:
+    """Returns the statement digests performance_schema has recorded for the convoy schema as (text, calls, picoseconds,
+    rows examined, rows sent) by digest, or an empty dict if performance_schema is not enabled on the server"""
+    # Imported here, so that entry points without a database, like the fetcher, can be profiled without the driver.
+    import mariadb
+    import convoy_db
+    config = convoy_db.connection_config(password)
+    try:
+        with closing(convoy_db.connect(config)) as conn, closing(conn.cursor()) as cur:
+            cur.execute("""
+                SELECT DIGEST, DIGEST_TEXT, COUNT_STAR, SUM_TIMER_WAIT, SUM_ROWS_EXAMINED, SUM_ROWS_SENT
+                FROM performance_schema.events_statements_summary_by_digest
+                WHERE SCHEMA_NAME = %s""", (config['database'],))
+            return {digest: (text, calls, picoseconds, rows_examined, rows_sent) for (digest, text, calls, picoseconds, rows_examined, rows_sent) in cur.fetchall()}
+    except mariadb.Error:
+        logging.warning("Could not read statement digests from performance_schema, leaving out SQL timings.", exc_info=True)
+        return dict()
+
+
+class Profiler:
+    def __init__(self, report_dir: str, interval: float, memory: bool, sql: bool, password: str | None):
+        self.report_dir = report_dir
+        self.memory = memory
+        self.sql = sql
+        self.password = password
+        self.sampler = Sampler(interval)
+        self.digests = dict()
+        self.start_time = 0.0
+        self.start_usage = None
+
+    def start(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        if self.sql:
+            self.digests = statement_digests(self.password)
+        if self.memory:
+            tracemalloc.start()
+        self.start_time = time.perf_counter()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.sampler.start()
+
+    def stop(self, args: dict):
+        self.sampler.stopped.set()
+        self.sampler.join()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        wall = time.perf_counter() - self.start_time
+        if self.memory:
+            tracemalloc.stop()
+        self.sampler.write(self.report_dir)
+        if self.sql:
+            self.write_statements(statement_digests(self.password))
+        with open(os.path.join(self.report_dir, "summary.txt"), "w") as f:
+            f.write(f"script: {os.path.basename(sys.argv[0])}\n")
+            for (name, value) in args.items():
+                f.write(f"{name}: {'***' if name in ('password', 'bearer_token') else value}\n")
+            f.write(f"wall seconds: {wall:.1f}\n")
+            f.write(f"user cpu seconds: {usage.ru_utime - self.start_usage.ru_utime:.1f}\n")
+            f.write(f"system cpu seconds: {usage.ru_stime - self.start_usage.ru_stime:.1f}\n")
+            f.write(f"max rss MiB: {usage.ru_maxrss / 1024:.1f}\n")
+        logging.info(f"Wrote profile to {self.report_dir}.")
+
+    def write_statements(self, digests: dict[str, tuple[str, int, int, int, int]]):
+        rows = []
+        for (digest, (text, calls, picoseconds, rows_examined, rows_sent)) in digests.items():
+            (_, calls_before, picoseconds_before, rows_examined_before, rows_sent_before) = self.digests.get(digest, (None, 0, 0, 0, 0))
+            if calls > calls_before:
+                rows.append(((picoseconds - picoseconds_before) / 1e12, calls - calls_before, rows_examined - rows_examined_before, rows_sent - rows_sent_before, ' '.join((text or '').split())))
+        rows.sort(reverse=True)
+        with open(os.path.join(self.report_dir, "sql.tsv"), "w") as f:
+            f.write("seconds\tcalls\trows_examined\trows_sent\tstatement\n")
+            for row in rows:
+                f.write('\t'.join(map(str, row)) + '\n')
+
+    def write_phase(self, name: str, seconds: float, top: int = 30):
+        (current, peak) = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        with open(os.path.join(self.report_dir, f"memory-{name}.txt"), "w") as f:
+            f.write(f"seconds: {seconds:.1f}\npeak MiB: {peak / 1024 ** 2:.1f}\nat end MiB: {current / 1024 ** 2:.1f}\n\nlargest allocation sites at end:\n")
+            for stat in snapshot.statistics('lineno')[:top]:
+                f.write(f"{stat}\n")
+
+
+@contextmanager
+def phase(name: str):
+    """Marks a phase of a stage, such as parsing pages or building trees. Under --profile-memory, the peak memory traced
+    during the phase and the allocation sites at its end are written to the report."""
+    if active is None or not active.memory:
+        yield
+        return
+    tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        active.write_phase(name, time.perf_counter() - start_time)
+
+
+def profiled(command: click.Command) -> click.Command:
+    """Adds the profiling options to a click command. Apply it to the command, that is above @click.command."""
+    callback = command.callback
+
+    @functools.wraps(callback)
+    def profiled_callback(*args, profile: bool, profile_dir: str, profile_interval: float, profile_memory: bool, **kwargs):
+        global active
+        if not profile:
+            return callback(*args, **kwargs)
+        report_dir = os.path.join(profile_dir, f"{command.name}-{datetime.datetime.now():%Y%m%d-%H%M%S}")
+        active = Profiler(report_dir, profile_interval, profile_memory, 'password' in kwargs, kwargs.get('password'))
+        active.start()
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            active.stop(kwargs)
+            active = None
+
+    command.callback = profiled_callback
+    command.params.extend([
+        click.Option(['--profile'], is_flag=True, help="write a profile of the run into a timestamped directory under --profile-dir"),
+        click.Option(['--profile-dir'], default="profiles", show_default=True, help="directory to write profiles to"),
+        click.Option(['--profile-interval'], default=0.01, show_default=True, help="seconds between stack samples"),
+        click.Option(['--profile-memory'], is_flag=True, help="also trace memory allocations with tracemalloc during the phases of the stage, which slows it down"),
+    ])
+    return command
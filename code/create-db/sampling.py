@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Deterministic samples of the crawl files for development runs of the pipeline. A sample keeps a fixed fraction of
+the ur-conversations in full, so that every stage sees complete conversation trees.
+
+Ur-conversations are found the way 2_enrich_ur_conversation_ids.py forms them: conversations are joined by retweets
+and by quotes that are not replies. The conversations joined this way form one component, which is kept or dropped as
+a whole by a hash of its smallest conversation id, so the same fraction of the same data always gives the same sample.
+
+Finding the components takes a pass over all pages, so the conversations and references of every page are written into
+a sidecar index <file>.idx next to each crawl file together with the byte offset and length of the page, and the
+conversation of every tweet into the SQLite database <file>.idx.db. Later samples only read the indexes and then seek
+straight to the pages with sampled conversations. An index is rebuilt when the size or modification time of its crawl
+file has changed.
+
+Like in 2_enrich_ur_conversation_ids.py, references are resolved against the tweets of all pages of all the files
+sampled together, so a ur-conversation joined by tweets on different pages or in different files stays whole. The
+references and conversations are collected in a temporary SQLite database and joined with the tweets there, so that
+only the joined conversations and the sampled ones are held in memory, whatever the size of the crawl."""
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import zlib
+from contextlib import closing
+from json import JSONDecodeError
+from typing import Any, BinaryIO, Iterator
+
+import click
+from tqdm import tqdm
+
+from json_decoding import get_decoder, decoders, StdlibDecoder, OrjsonDecoder, SimdjsonDecoder
+
+index_version = 3
+
+
+def page_tweets(page: Any) -> Iterator[Any]:
+    yield from page['data'] if 'data' in page else []
+    if 'includes' in page and 'tweets' in page['includes']:
+        yield from page['includes']['tweets']
+
+
+def page_conversations(page: Any) -> tuple[list[int], list[tuple[int, int]], list[tuple[int, int]]]:
+    """Returns the conversation ids of the tweets of a page, the (tweet id, conversation id) of its tweets and the
+    (from conversation id, referenced tweet id) of the references that join conversations"""
+    tweets = dict()
+    refs = set()
+    for tweet in page_tweets(page):
+        if 'conversation_id' not in tweet:
+            continue
+        tweets[int(tweet['id'])] = int(tweet['conversation_id'])
+        if 'referenced_tweets' not in tweet:
+            continue
+        types = {ref_tweet['type'] for ref_tweet in tweet['referenced_tweets']}
+        for ref_tweet in tweet['referenced_tweets']:
+            if ref_tweet['type'] == 'retweeted' or ref_tweet['type'] == 'quoted' and 'replied_to' not in types:
+                refs.add((int(tweet['conversation_id']), int(ref_tweet['id'])))
+    return sorted(set(tweets.values())), sorted(tweets.items()), sorted(refs)
+
+
+def index_file_name(file_name: str) -> str:
+    return f"{file_name}.idx"
+
+
+def tweets_file_name(file_name: str) -> str:
+    return f"{index_file_name(file_name)}.db"
+
+
+def build_index(file_name: str, decoder: StdlibDecoder | OrjsonDecoder | SimdjsonDecoder):
+    """Write the sidecar indexes of a crawl file. The first line of <file>.idx describes the crawl file, every further
+    line is [offset, length, conversation ids, references] of one page. The tweets table of <file>.idx.db has the
+    conversation id of every tweet."""
+    stat = os.stat(file_name)
+    for tmp_file_name in (f"{index_file_name(file_name)}.tmp", f"{tweets_file_name(file_name)}.tmp"):
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+    with open(file_name, "rb") as f, open(f"{index_file_name(file_name)}.tmp", "w") as idx, closing(sqlite3.connect(f"{tweets_file_name(file_name)}.tmp")) as db:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute("CREATE TABLE tweets (tweet_id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL)")
+        idx.write(json.dumps(dict(version=index_version, size=stat.st_size, mtime_ns=stat.st_mtime_ns)) + "\n")
+        offset = 0
+        for (line_number, line) in enumerate(tqdm(f, desc=f"indexing {os.path.basename(file_name)}", unit="pages", leave=False), start=1):
+            try:
+                (conversation_ids, tweets, refs) = page_conversations(decoder.decode(line))
+                idx.write(json.dumps([offset, len(line), conversation_ids, refs]) + "\n")
+                db.executemany("INSERT OR IGNORE INTO tweets VALUES (?, ?)", tweets)
+            except JSONDecodeError:
+                logging.exception(f"Exception parsing line number {line_number} of {file_name}. Skipping.")
+            offset += len(line)
+        db.commit()
+    os.replace(f"{tweets_file_name(file_name)}.tmp", tweets_file_name(file_name))
+    os.replace(f"{index_file_name(file_name)}.tmp", index_file_name(file_name))
+
+
+def index_current(file_name: str) -> bool:
+    stat = os.stat(file_name)
+    try:
+        with open(index_file_name(file_name)) as idx:
+            header = json.loads(idx.readline())
+    except (FileNotFoundError, ValueError):
+        return False
+    return header == dict(version=index_version, size=stat.st_size, mtime_ns=stat.st_mtime_ns) and os.path.exists(tweets_file_name(file_name))
+
+
+def read_index(file_name: str, decoder: StdlibDecoder | OrjsonDecoder | SimdjsonDecoder) -> Iterator[tuple[int, int, list[int], list[list[int]]]]:
+    """Yields the pages of the sidecar index of a crawl file, building the index first if it is missing or stale"""
+    if not index_current(file_name):
+        logging.info(f"Building sidecar index of {file_name}.")
+        build_index(file_name, decoder)
+    with open(index_file_name(file_name)) as idx:
+        idx.readline()
+        for line in idx:
+            yield tuple(json.loads(line))
+
+
+def sampled(conversation_id: int, fraction: float) -> bool:
+    return zlib.crc32(str(conversation_id).encode('ascii')) < fraction * 2 ** 32
+
+
+class Sample:
+    """The sampled conversations of a set of crawl files and the offsets of the pages containing them"""
+
+    def __init__(self, file_names: list[str], fraction: float, decoder: StdlibDecoder | OrjsonDecoder | SimdjsonDecoder):
+        # Only conversations joined to others get an entry, every other conversation is its own root.
+        parents: dict[int, int] = dict()
+
+        def find(conversation_id: int) -> int:
+            while parents.get(conversation_id, conversation_id) != conversation_id:
+                parent = parents[conversation_id]
+                parents[conversation_id] = parents.get(parent, parent)
+                conversation_id = parents[conversation_id]
+            return conversation_id
+
+        self.conversation_ids = set()
+        self.components = self.sampled_components = 0
+        with tempfile.TemporaryDirectory() as tmp, closing(sqlite3.connect(os.path.join(tmp, "sample.db"))) as db:
+            db.execute("PRAGMA journal_mode = OFF")
+            db.execute("PRAGMA synchronous = OFF")
+            db.execute("CREATE TABLE conversations (conversation_id INTEGER PRIMARY KEY)")
+            db.execute("CREATE TABLE refs (from_conversation_id INTEGER NOT NULL, tweet_id INTEGER NOT NULL)")
+            for file_name in file_names:
+                for (_, _, conversation_ids, refs) in read_index(file_name, decoder):
+                    db.executemany("INSERT OR IGNORE INTO conversations VALUES (?)", ((conversation_id,) for conversation_id in conversation_ids))
+                    db.executemany("INSERT INTO refs VALUES (?, ?)", refs)
+            db.execute("CREATE INDEX refs_tweet_id ON refs (tweet_id)")
+            db.commit()
+            # The conversations of the referenced tweets, wherever in the files the tweets are.
+            for file_name in file_names:
+                db.execute("ATTACH DATABASE ? AS f", (tweets_file_name(file_name),))
+                for (from_conversation_id, to_conversation_id) in db.execute("""
+                        SELECT DISTINCT r.from_conversation_id, t.conversation_id
+                        FROM refs r INNER JOIN f.tweets t USING (tweet_id)
+                        WHERE r.from_conversation_id != t.conversation_id"""):
+                    (from_root, to_root) = (find(from_conversation_id), find(to_conversation_id))
+                    if from_root != to_root:
+                        # The smaller id becomes the root, so a component is always represented by its smallest id.
+                        (from_root, to_root) = sorted((from_root, to_root))
+                        parents[to_root] = from_root
+                db.execute("DETACH DATABASE f")
+            for (conversation_id,) in db.execute("SELECT conversation_id FROM conversations"):
+                root = find(conversation_id)
+                self.components += root == conversation_id
+                if sampled(root, fraction):
+                    self.conversation_ids.add(conversation_id)
+                    self.sampled_components += root == conversation_id
+        self.pages = {file_name: [(offset, length) for (offset, length, conversation_ids, _) in read_index(file_name, decoder)
+                                  if any(conversation_id in self.conversation_ids for conversation_id in conversation_ids)]
+                      for file_name in file_names}
+
+    def lines(self, f: BinaryIO) -> Iterator[bytes]:
+        """Yields the pages of an open crawl file that contain sampled conversations"""
+        for (offset, length) in self.pages[f.name]:
+            f.seek(offset)
+            yield f.read(length)
+
+    def filter_page(self, page: Any) -> dict:
+        """Returns a page with only the tweets of sampled conversations, and with the errors about mentions of the
+        dropped tweets dropped as well"""
+        data = [tweet for tweet in page['data'] if int(tweet['conversation_id']) in self.conversation_ids]
+        includes = dict(users=page['includes']['users'])
+        if 'tweets' in page['includes']:
+            includes['tweets'] = [tweet for tweet in page['includes']['tweets'] if 'conversation_id' in tweet and int(tweet['conversation_id']) in self.conversation_ids]
+        filtered = dict(data=data, includes=includes)
+        if 'errors' in page:
+            usernames = {mention['username'] for tweet in data + includes.get('tweets', [])
+                         if 'entities' in tweet and 'mentions' in tweet['entities'] for mention in tweet['entities']['mentions']}
+            filtered['errors'] = [error for error in page['errors'] if error['parameter'] != 'entities.mentions.username' or error['resource_id'] in usernames]
+        return filtered
+
+
+@click.option('-f', '--fraction', required=True, type=click.FloatRange(0, 1, min_open=True), help="fraction of the ur-conversations to keep")
+@click.option('-o', '--output', required=True, help="directory to write the sampled files to, under their original names")
+@click.option('--json-decoder', type=click.Choice(['auto'] + list(decoders)), default='auto', show_default=True, help="JSON decoder to parse the pages with")
+@click.argument('files', nargs=-1, required=True)
+@click.command
+def sample_files(fraction: float, output: str, json_decoder: str, files: list[str]):
+    """Write a deterministic sample of whole ur-conversations of crawl files"""
+    decoder = get_decoder(json_decoder)
+    sample = Sample(list(files), fraction, decoder)
+    logging.info(f"Sampled {sample.sampled_components} of {sample.components} ur-conversations.")
+    os.makedirs(output, exist_ok=True)
+    for file_name in files:
+        with open(file_name, "rb") as f, open(os.path.join(output, os.path.basename(file_name)), "w") as out:
+            for line in tqdm(sample.lines(f), total=len(sample.pages[file_name]), desc=os.path.basename(file_name), unit="pages"):
+                out.write(json.dumps(sample.filter_page(json.loads(line))) + "\n")
+    logging.info("Done.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    sample_files()
@@ -0,0 +1,68 @@
+from conversation_trees import ConversationTree, TreeStore, stats_cols
+
+
+def row(tweet_id: int, in_reply_to: int | None = None, retweet_of: int | None = None, quotes: int | None = None) -> tuple:
+    return (1, tweet_id, in_reply_to, retweet_of, quotes, 100 + tweet_id) + (None,) * len(stats_cols)
+
+
+def test_tree_edges():
+    tree = ConversationTree(1, [row(1), row(2, in_reply_to=1), row(3, retweet_of=1), row(4, in_reply_to=2, quotes=3)])
+    assert tree.roots() == [1]
+    assert tree.children(1) == [2, 3]
+    assert tree.parent(4) == 2
+    assert [tree.kind(tweet_id) for tweet_id in (1, 2, 3, 4)] == ['root', 'reply', 'retweet', 'reply']
+    assert sorted(tree.edges()) == [(1, 2, 'reply'), (1, 3, 'retweet'), (2, 4, 'reply')]
+
+
+def test_missing_parent_is_root():
+    tree = ConversationTree(1, [row(1), row(5, in_reply_to=99)])
+    assert tree.roots() == [1, 5]
+    assert tree.parent(5) is None
+    assert tree.kind(5) == 'root'
+    assert list(tree.edges()) == []
+
+
+class FakeCursor:
+    """Answers the queries of TreeStore from rows of select_stmt, counting the queries"""
+
+    def __init__(self, rows: list[tuple]):
+        self.rows = rows
+        self.queries = 0
+        self.result = []
+
+    def execute(self, stmt: str, params: list[int]):
+        self.queries += 1
+        if "SELECT ur_conversation_id FROM tweets_a WHERE tweet_id IN" in stmt:
+            ur_conversation_ids = {row[0] for row in self.rows if row[1] in params}
+        else:
+            ur_conversation_ids = set(params)
+        self.result = sorted(row for row in self.rows if row[0] in ur_conversation_ids)
+
+    def fetchall(self) -> list[tuple]:
+        return self.result
+
+
+def conversation(ur_conversation_id: int, tweet_ids: list[int]) -> list[tuple]:
+    return [(ur_conversation_id,) + row(tweet_id)[1:] for tweet_id in tweet_ids]
+
+
+def test_store_trees_of_tweets():
+    cur = FakeCursor(conversation(1, [1, 2, 3]) + conversation(10, [10, 11]))
+    store = TreeStore(cur)
+    trees = store.trees_of_tweets([2, 11, 404])
+    assert {tweet_id: tree.ur_conversation_id for (tweet_id, tree) in trees.items()} == {2: 1, 11: 10}
+    assert cur.queries == 1
+    assert store.tree_of_tweet(3).ur_conversation_id == 1
+    assert cur.queries == 1
+
+
+def test_store_evicts_tweet_map():
+    cur = FakeCursor(conversation(1, [1, 2, 3]) + conversation(10, [10, 11]))
+    tree_bytes = TreeStore(cur)._size(ConversationTree(1, conversation(1, [1, 2, 3])))
+    store = TreeStore(cur, max_bytes=tree_bytes)
+    store.tree(1)
+    store.tree(10)
+    assert list(store.cache) == [10]
+    assert set(store.ur_conversation_ids) == {10, 11}
+    assert store.tree_of_tweet(2).ur_conversation_id == 1
+    assert cur.queries == 3
@@ -0,0 +1,47 @@
+import json
+import os
+
+from json_decoding import StdlibDecoder
+from sampling import Sample, index_file_name, tweets_file_name
+
+
+def page(*tweets: dict) -> dict:
+    return dict(data=list(tweets), includes=dict(users=[]))
+
+
+def tweet(tweet_id: int, conversation_id: int, **refs: int) -> dict:
+    t = dict(id=str(tweet_id), conversation_id=str(conversation_id))
+    if refs:
+        t['referenced_tweets'] = [dict(type=kind, id=str(ref)) for (kind, ref) in refs.items()]
+    return t
+
+
+def write(path, name: str, *pages: dict) -> str:
+    file_name = os.path.join(path, name)
+    with open(file_name, "w") as f:
+        for p in pages:
+            f.write(json.dumps(p) + "\n")
+    return file_name
+
+
+def test_joins_across_files(tmp_path):
+    a = write(tmp_path, "a.jsonl", page(tweet(10, 10), tweet(11, 10, replied_to=10)), page(tweet(30, 30)))
+    b = write(tmp_path, "b.jsonl", page(tweet(20, 20, quoted=11)), page(tweet(40, 40, replied_to=41, quoted=30)))
+    sample = Sample([a, b], 1.0, StdlibDecoder())
+    # 20 quotes a tweet of 10 in another file, the quote of 30 by a reply doesn't join.
+    assert sample.components == 3
+    assert sample.conversation_ids == {10, 20, 30, 40}
+    assert os.path.exists(index_file_name(a)) and os.path.exists(tweets_file_name(b))
+
+
+def test_components_are_kept_whole(tmp_path):
+    pages = [page(tweet(n, n)) for n in range(1, 200)] + [page(tweet(1000 + n, 1000 + n, retweeted=n)) for n in range(1, 200)]
+    file_name = write(tmp_path, "a.jsonl", *pages)
+    sample = Sample([file_name], 0.3, StdlibDecoder())
+    assert sample.components == 199
+    assert 0 < sample.sampled_components < 199
+    for n in range(1, 200):
+        assert (n in sample.conversation_ids) == (1000 + n in sample.conversation_ids)
+    assert len(sample.pages[file_name]) == 2 * sample.sampled_components
+    # A second sample reuses the index and picks the same pages.
+    assert Sample([file_name], 0.3, StdlibDecoder()).pages == sample.pages
@@ -0,0 +1,81 @@
+import json
+import os
+
+import pytest
+
+from text_index import TextIndex, build, parse_query, read_varint, tokenize, write_varint
+
+
+def test_varint_round_trip():
+    values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32 - 1, 2 ** 63 + 5]
+    buf = bytearray()
+    for value in values:
+        write_varint(buf, value)
+    assert buf[:1] == b'\x00' and buf[2:3] == b'\x7f' and buf[3:5] == b'\x80\x01'
+    (pos, decoded) = (0, [])
+    while pos < len(buf):
+        (value, pos) = read_varint(buf, pos)
+        decoded.append(value)
+    assert decoded == values
+
+
+def test_tokenize_hashtags_mentions_and_urls():
+    assert tokenize("Join the #Convoy, @TruckerJoe: https://www.example.com/a?b=1.") == [
+        ["join"], ["the"], ["#convoy", "convoy"], ["@truckerjoe", "truckerjoe"],
+        ["https://www.example.com/a?b=1", "site:example.com"]]
+
+
+def test_tokenize_unsegmented_scripts_as_bigrams():
+    assert tokenize("东京塔 ok") == [["东京"], ["京塔"], ["ok"]]
+    assert tokenize("Ｃａｆé 日") == [["café"], ["日"]]
+
+
+def test_parse_query_precedence():
+    (convoy, ottawa, truck, police) = (('terms', [word]) for word in ("convoy", "ottawa", "truck", "police"))
+    assert parse_query("convoy ottawa OR truck -police") == ('or', [('and', [convoy, ottawa]), ('and', [truck, ('not', police)])])
+    assert parse_query("convoy AND NOT (ottawa OR truck)") == ('and', [convoy, ('not', ('or', [ottawa, truck]))])
+    assert parse_query('"Freedom Convoy" lang:EN') == ('and', [('terms', ["freedom", "convoy"]), ('terms', ["lang:en"])])
+    with pytest.raises(ValueError):
+        parse_query("(convoy OR truck")
+    with pytest.raises(ValueError):
+        parse_query("convoy OR")
+
+
+@pytest.fixture
+def index_path(tmp_path) -> str:
+    tweets = [
+        (1, "en", "freedom convoy arrives in Ottawa"),
+        (2, "en", "convoy of freedom"),
+        (3, "fr", "le convoi de la liberté, freedom convoy"),
+        (4, "en", "police clear the freedom convoy"),
+        (5, "ja", "東京のトラック"),
+        (6, "en", "no convoy today, freedom tomorrow"),
+    ]
+    path = str(tmp_path / "index")
+    # Tiny segments, so that the tweets are spread over several of them.
+    build(path, tweets, segment_bytes=1)
+    return path
+
+
+def test_segments(index_path):
+    with open(os.path.join(index_path, "manifest.json")) as f:
+        assert len(json.load(f)["segments"]) == 6
+
+
+def test_search_boolean(index_path):
+    index = TextIndex(index_path)
+    assert index.search("convoy -police") == [1, 2, 3, 6]
+    assert index.search("convoy NOT (police OR ottawa)") == [2, 3, 6]
+    assert index.search("convoi OR ottawa lang:en") == [1, 3]
+    assert index.doc_frequency("freedom") == 5
+    with pytest.raises(ValueError):
+        index.search("-convoy")
+
+
+def test_search_phrases_across_segments(index_path):
+    index = TextIndex(index_path)
+    assert index.search('"freedom convoy"') == [1, 3, 4]
+    assert index.search('"convoy freedom"') == []
+    # A run of Japanese is matched as the phrase of its bigrams.
+    assert index.search("東京") == [5]
+    assert index.search("京のト") == [5]
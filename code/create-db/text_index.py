@@ -0,0 +1,356 @@
+"""On-disk inverted index of tweet texts, an alternative to the FULLTEXT index of tweets_a. Written by
+8_build_text_index.py, queried with TextIndex.search.
+
+Texts are NFKC normalised and case-folded. Words are tokens as such, except that runs of Chinese, Japanese, Thai and
+other scripts written without spaces are split into overlapping character bigrams. Hashtags, mentions and urls are kept
+whole as #tag, @user and the url, and the tag, user name and host of the url are indexed at the same position as the
+word tag, the word user and site:host. Every tweet also gets a lang:<lang> term.
+
+The index is a directory of segments, each covering an increasing run of tweet ids, and a manifest.json listing them.
+A segment is three files:
+
+- <segment>.dict: for every term in utf-8 byte order, a record of dict_record: the offset and length of the term in
+  <segment>.terms and the offset, length and document frequency of its postings in <segment>.postings
+- <segment>.terms: the utf-8 bytes of the terms, one after another
+- <segment>.postings: the postings of the terms. A posting list is, for every tweet containing the term, the varint
+  encoded difference of the tweet id to the previous tweet id in the list, the number of positions of the term in the
+  tweet and the differences of the positions to the previous one.
+
+All files are memory-mapped when queried, so opening an index costs next to nothing whatever its size."""
+import json
+import mmap
+import os
+import re
+import struct
+import unicodedata
+from typing import Iterable, Iterator
+
+dict_record = struct.Struct('<QIQII')
+
+token_re = re.compile(r"(https?://\S+)|([#@])?((?:\w|[\u0300-\u036f\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff])+)")
+unsegmented_re = re.compile(r"([\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)")
+url_trailing_punctuation = '.,;:!?)]}"\'…'
+
+
+def split_unsegmented(word: str) -> list[str]:
+    """Splits the runs of scripts written without spaces in a word into overlapping character bigrams"""
+    tokens = []
+    for (i, part) in enumerate(unsegmented_re.split(word)):
+        if part == '':
+            continue
+        if i % 2 == 0:
+            tokens.append(part)
+        elif len(part) == 1:
+            tokens.append(part)
+        else:
+            tokens.extend(part[j:j + 2] for j in range(len(part) - 1))
+    return tokens
+
+
+def tokenize(text: str) -> list[list[str]]:
+    """Returns the terms at each position of a text. The first term at a position is the token itself, the rest are
+    terms indexed at the same position so that e.g. a search for convoy also finds #convoy."""
+    positions = []
+    for match in token_re.finditer(unicodedata.normalize('NFKC', text).casefold()):
+        (url, prefix, word) = match.groups()
+        if url is not None:
+            url = url.rstrip(url_trailing_punctuation)
+            host = url.split('/')[2].split(':')[0]
+            positions.append([url, f"site:{host.removeprefix('www.')}"])
+        elif prefix is not None:
+            positions.append([prefix + word, word])
+        else:
+            positions.extend([token] for token in split_unsegmented(word))
+    return positions
+
+
+def write_varint(buf: bytearray, value: int):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def read_varint(buf, pos: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class IndexWriter:
+    """Builds an index from tweets added in increasing tweet id order. Postings are collected in memory and written out
+    as a segment whenever they take more than segment_bytes."""
+
+    def __init__(self, path: str, segment_bytes: int = 256 * 1024 ** 2):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.segments = []
+        self.postings: dict[str, bytearray] = dict()
+        self.last_tweet_ids: dict[str, int] = dict()
+        self.doc_frequencies: dict[str, int] = dict()
+        self.bytes = 0
+        self.docs = 0
+        self.first_tweet_id = None
+        self.last_tweet_id = None
+        os.makedirs(path, exist_ok=True)
+
+    def add_term(self, term: str, tweet_id: int, positions: list[int]):
+        buf = self.postings.get(term)
+        if buf is None:
+            buf = self.postings[term] = bytearray()
+            self.last_tweet_ids[term] = 0
+            self.doc_frequencies[term] = 0
+            self.bytes += 200 + len(term)
+        size = len(buf)
+        write_varint(buf, tweet_id - self.last_tweet_ids[term])
+        write_varint(buf, len(positions))
+        previous = 0
+        for position in positions:
+            write_varint(buf, position - previous)
+            previous = position
+        self.last_tweet_ids[term] = tweet_id
+        self.doc_frequencies[term] += 1
+        self.bytes += len(buf) - size
+
+    def add(self, tweet_id: int, lang: str | None, text: str):
+        if self.last_tweet_id is not None and tweet_id <= self.last_tweet_id:
+            raise ValueError(f"Tweet {tweet_id} added after {self.last_tweet_id}. Tweets must be added in increasing tweet id order.")
+        if self.first_tweet_id is None:
+            self.first_tweet_id = tweet_id
+        self.last_tweet_id = tweet_id
+        term_positions: dict[str, list[int]] = dict()
+        for (position, terms) in enumerate(tokenize(text)):
+            for term in terms:
+                term_positions.setdefault(term, []).append(position)
+        if lang is not None:
+            term_positions[f"lang:{lang.casefold()}"] = []
+        for (term, positions) in term_positions.items():
+            self.add_term(term, tweet_id, positions)
+        self.docs += 1
+        if self.bytes >= self.segment_bytes:
+            self.write_segment()
+
+    def write_segment(self):
+        if self.docs == 0:
+            return
+        name = f"{len(self.segments):05d}"
+        terms = sorted(self.postings, key=lambda term: term.encode('utf-8'))
+        term_offset = postings_offset = 0
+        with open(os.path.join(self.path, f"{name}.dict"), "wb") as dict_file, \
+                open(os.path.join(self.path, f"{name}.terms"), "wb") as terms_file, \
+                open(os.path.join(self.path, f"{name}.postings"), "wb") as postings_file:
+            for term in terms:
+                term_bytes = term.encode('utf-8')
+                postings = self.postings[term]
+                dict_file.write(dict_record.pack(term_offset, len(term_bytes), postings_offset, len(postings), self.doc_frequencies[term]))
+                terms_file.write(term_bytes)
+                postings_file.write(postings)
+                term_offset += len(term_bytes)
+                postings_offset += len(postings)
+        self.segments.append(dict(name=name, docs=self.docs, terms=len(terms), first_tweet_id=self.first_tweet_id, last_tweet_id=self.last_tweet_id))
+        self.postings = dict()
+        self.last_tweet_ids = dict()
+        self.doc_frequencies = dict()
+        self.bytes = 0
+        self.docs = 0
+        self.first_tweet_id = None
+
+    def close(self):
+        self.write_segment()
+        with open(os.path.join(self.path, "manifest.json"), "w") as f:
+            json.dump(dict(version=1, segments=self.segments), f, indent=2)
+
+
+def map_file(file_name: str):
+    with open(file_name, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Segment:
+    def __init__(self, path: str, name: str):
+        self.dict = map_file(os.path.join(path, f"{name}.dict"))
+        self.terms = map_file(os.path.join(path, f"{name}.terms"))
+        self.postings = map_file(os.path.join(path, f"{name}.postings"))
+        self.term_count = len(self.dict) // dict_record.size
+
+    def lookup(self, term: str) -> tuple[int, int, int] | None:
+        """Returns the offset, length and document frequency of the postings of a term, or None if it doesn't occur"""
+        term_bytes = term.encode('utf-8')
+        low = 0
+        high = self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            (term_offset, term_length, postings_offset, postings_length, doc_frequency) = dict_record.unpack_from(self.dict, middle * dict_record.size)
+            middle_term = self.terms[term_offset:term_offset + term_length]
+            if middle_term < term_bytes:
+                low = middle + 1
+            elif middle_term > term_bytes:
+                high = middle
+            else:
+                return postings_offset, postings_length, doc_frequency
+        return None
+
+    def postings_of(self, term: str, with_positions: bool = True) -> Iterator[tuple[int, list[int]]]:
+        """Yields the tweets containing a term in increasing tweet id order, with the positions of the term in each"""
+        found = self.lookup(term)
+        if found is None:
+            return
+        (pos, length, _) = found
+        end = pos + length
+        buf = self.postings
+        tweet_id = 0
+        while pos < end:
+            (delta, pos) = read_varint(buf, pos)
+            tweet_id += delta
+            (count, pos) = read_varint(buf, pos)
+            positions = []
+            position = 0
+            for _ in range(count):
+                (delta, pos) = read_varint(buf, pos)
+                position += delta
+                if with_positions:
+                    positions.append(position)
+            yield tweet_id, positions
+
+    def docs(self, term: str) -> set[int]:
+        return {tweet_id for (tweet_id, _) in self.postings_of(term, with_positions=False)}
+
+    def phrase(self, terms: list[str]) -> set[int]:
+        """Returns the tweets containing the terms at consecutive positions"""
+        postings = [dict(self.postings_of(term)) for term in terms]
+        result = set()
+        for (tweet_id, positions) in min(postings, key=len).items():
+            if all(tweet_id in p for p in postings):
+                starts = set(postings[0][tweet_id])
+                for (offset, p) in enumerate(postings[1:], start=1):
+                    starts &= {position - offset for position in p[tweet_id]}
+                if len(starts) > 0:
+                    result.add(tweet_id)
+        return result
+
+
+query_token_re = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|(-)?([^\s()"]+))')
+
+
+def parse_query(query: str):
+    """Parses a query into a tree of ('or', [...]), ('and', [...]), ('not', q) and ('terms', [...]) nodes. Words are
+    combined with AND unless separated by OR, NOT or a leading - negates, parentheses group and double quotes make a
+    phrase. A word the tokenizer splits into several terms, such as a run of Chinese, is matched as a phrase too."""
+    tokens = []
+    for match in query_token_re.finditer(query):
+        (open_paren, close_paren, phrase, minus, word) = match.groups()
+        if open_paren or close_paren:
+            tokens.append(open_paren or close_paren)
+        elif phrase is not None:
+            tokens.append(('terms', query_terms(phrase)))
+        elif word in ('AND', 'OR', 'NOT'):
+            tokens.append(word)
+        else:
+            if minus:
+                tokens.append('NOT')
+            tokens.append(('terms', query_terms(word)))
+    pos = 0
+
+    def parse_or():
+        nonlocal pos
+        operands = [parse_and()]
+        while pos < len(tokens) and tokens[pos] == 'OR':
+            pos += 1
+            operands.append(parse_and())
+        return operands[0] if len(operands) == 1 else ('or', operands)
+
+    def parse_and():
+        nonlocal pos
+        operands = [parse_unary()]
+        while pos < len(tokens) and tokens[pos] not in ('OR', ')'):
+            if tokens[pos] == 'AND':
+                pos += 1
+            operands.append(parse_unary())
+        return operands[0] if len(operands) == 1 else ('and', operands)
+
+    def parse_unary():
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ValueError(f"Unexpected end of query: {query}")
+        token = tokens[pos]
+        pos += 1
+        if token == 'NOT':
+            return 'not', parse_unary()
+        if token == '(':
+            node = parse_or()
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise ValueError(f"Missing ) in query: {query}")
+            pos += 1
+            return node
+        if isinstance(token, tuple):
+            return token
+        raise ValueError(f"Unexpected {token} in query: {query}")
+
+    node = parse_or()
+    if pos != len(tokens):
+        raise ValueError(f"Unexpected {tokens[pos]} in query: {query}")
+    return node
+
+
+def query_terms(text: str) -> list[str]:
+    if re.fullmatch(r"(lang|site):\S+", text, flags=re.IGNORECASE):
+        return [text.casefold()]
+    return [terms[0] for terms in tokenize(text)]
+
+
+class TextIndex:
+    def __init__(self, path: str):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.segments = [Segment(path, segment['name']) for segment in self.manifest['segments']]
+
+    def evaluate(self, segment: Segment, node) -> set[int]:
+        (kind, operand) = node
+        if kind == 'terms':
+            if len(operand) == 0:
+                return set()
+            return segment.docs(operand[0]) if len(operand) == 1 else segment.phrase(operand)
+        if kind == 'or':
+            return set().union(*(self.evaluate(segment, child) for child in operand))
+        if kind == 'and':
+            positives = [child for child in operand if child[0] != 'not']
+            if len(positives) == 0:
+                raise ValueError("A query can't consist of negated terms only.")
+            result = self.evaluate(segment, positives[0])
+            for child in positives[1:]:
+                if len(result) == 0:
+                    break
+                result &= self.evaluate(segment, child)
+            for child in operand:
+                if child[0] == 'not' and len(result) > 0:
+                    result -= self.evaluate(segment, child[1])
+            return result
+        raise ValueError("A query can't consist of negated terms only.")
+
+    def search(self, query: str) -> list[int]:
+        """Returns the ids of the tweets matching a query in increasing order, see parse_query for the syntax"""
+        node = parse_query(query)
+        tweet_ids = []
+        for segment in self.segments:
+            tweet_ids.extend(sorted(self.evaluate(segment, node)))
+        return tweet_ids
+
+    def doc_frequency(self, term: str) -> int:
+        return sum(found[2] for found in (segment.lookup(term) for segment in self.segments) if found is not None)
+
+
+def build(path: str, tweets: Iterable[tuple[int, str | None, str]], segment_bytes: int = 256 * 1024 ** 2) -> IndexWriter:
+    """Builds an index at path from (tweet_id, lang, text) tuples in increasing tweet id order"""
+    writer = IndexWriter(path, segment_bytes)
+    for (tweet_id, lang, text) in tweets:
+        writer.add(tweet_id, lang, text)
+    writer.close()
+    return writer
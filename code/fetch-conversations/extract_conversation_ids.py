@@ -1,9 +1,14 @@
 #%%
-import json
 import logging
 from collections import Counter
 from json import JSONDecodeError
 
+# orjson is several times faster on the large result pages, and its JSONDecodeError subclasses the stdlib one.
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
 logging.basicConfig(level = logging.INFO)
 
 convs = Counter()
@@ -13,11 +18,11 @@ tweets = 0
 treplies = 0
 zreplies = 0
 
-with open("tweets.jsonl", 'rt') as jsonlf:
+with open("tweets.jsonl", 'rb') as jsonlf:
     for jsonl in jsonlf:
         lines += 1
         try:
-            d = json.loads(jsonl)
+            d = loads(jsonl)
             for tweet in d['data']:
                 replies = tweet['public_metrics']['reply_count']
                 tweets += 1
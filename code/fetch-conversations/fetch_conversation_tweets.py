@@ -1,30 +1,99 @@
 #!/usr/bin/env python3
 
+import datetime
 import logging
+import os
+import sys
+import time
+import zlib
+from json import JSONDecodeError
+from os.path import exists, splitext
+from typing import Iterator, TextIO
 
 import requests
 from more_itertools import chunked
 import json
 from twarc.client2 import Twarc2
 from tqdm import tqdm
-from os.path import exists
-import sys
 import click
 
 from twarc.decorators2 import catch_request_exceptions, rate_limit
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create-db'))
+from profiling import profiled
+
 twarc_log = logging.getLogger("twarc")
 
+tweet_fields = "attachments,author_id,conversation_id,created_at,entities,geo,id,in_reply_to_user_id,lang,public_metrics,text,possibly_sensitive,referenced_tweets,reply_settings,source,withheld"
+
+
+class Credential:
+    __slots__ = ('token', 'remaining', 'reset', 'quarantined')
+
+    def __init__(self, token: str):
+        self.token = token
+        self.remaining: int | None = None
+        self.reset = 0.0
+        self.quarantined = False
+
+
+class CredentialPool:
+    """A pool of bearer tokens, each with its remaining request budget and reset time as last reported by the API in
+    the x-rate-limit-* response headers. Requests go to the token with the most headroom, tokens that get a 403 are
+    quarantined, and only when every token is exhausted do we sleep until the earliest reset."""
+
+    def __init__(self, tokens: list[str]):
+        self.credentials = [Credential(token) for token in tokens]
+
+    def available(self) -> list[Credential]:
+        return [credential for credential in self.credentials if not credential.quarantined]
+
+    def acquire(self) -> Credential:
+        while True:
+            available = self.available()
+            if len(available) == 0:
+                raise RuntimeError("All bearer tokens have been quarantined.")
+            now = time.time()
+            for credential in available:
+                if credential.reset <= now:
+                    credential.remaining = None
+            usable = [credential for credential in available if credential.remaining is None or credential.remaining > 0]
+            if len(usable) > 0:
+                # Tokens we have no budget information for yet are tried first.
+                return max(usable, key=lambda credential: float('inf') if credential.remaining is None else credential.remaining)
+            seconds = max(min(credential.reset for credential in available) - now + 10, 1)
+            logging.warning(f"All {len(available)} bearer tokens exhausted, sleeping {seconds:.0f} seconds.")
+            time.sleep(seconds)
+
+    def update(self, credential: Credential, response: requests.Response):
+        if 'x-rate-limit-remaining' in response.headers:
+            credential.remaining = int(response.headers['x-rate-limit-remaining'])
+        if 'x-rate-limit-reset' in response.headers:
+            credential.reset = float(response.headers['x-rate-limit-reset'])
+        if response.status_code == 429:
+            if credential.remaining:
+                # Budget left but still limited: the 1 request/second limit of the search/all endpoint.
+                time.sleep(1)
+            else:
+                credential.remaining = 0
+                credential.reset = max(credential.reset, time.time() + 60)
+        elif response.status_code == 403:
+            logging.error(f"Got 403 Unauthorized for {response.url} with bearer token {self.credentials.index(credential)}. Quarantining the token.")
+            credential.quarantined = True
+
 
 class MyTwarc2(Twarc2):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, bearer_tokens: list[str], api_url: str | None = None, *args, **kwargs):
+        super().__init__(*args, bearer_token=bearer_tokens[0], **kwargs)
+        self.credentials = CredentialPool(bearer_tokens)
+        self.api_url = api_url
 
-    def get(self, *args, **kwargs):
+    def get(self, url: str, *args, **kwargs):
         """
-        Make a GET request to a specified URL.
+        Make a GET request to a specified URL using the bearer token with the most rate limit headroom.
 
         Args:
+            url: URL to get. If api_url is set, it replaces https://api.twitter.com.
             *args: Variable length argument list.
             **kwargs: Arbitrary keyword arguments.
 
@@ -33,51 +102,148 @@ class MyTwarc2(Twarc2):
         """
         if not self.client:
             self.connect()
-        twarc_log.info("getting %s %s", args, kwargs)
-        r = self.last_response = self.client.get(*args, timeout=(3.05, 31), **kwargs)
-        return r
+        if self.api_url is not None:
+            url = url.replace("https://api.twitter.com", self.api_url, 1)
+        while True:
+            credential = self.credentials.acquire()
+            twarc_log.info("getting %s %s %s", url, args, kwargs)
+            r = self.last_response = self.client.get(url, *args, headers={"Authorization": f"Bearer {credential.token}"}, timeout=(3.05, 31), **kwargs)
+            self.credentials.update(credential, r)
+            if r.status_code == 429 or r.status_code == 403 and len(self.credentials.available()) > 0:
+                continue
+            return r
     get = catch_request_exceptions(get, tries=7)
     get = rate_limit(get, tries=7)
 
+    def search_all_raw(self, query: str, tweet_fields: str, max_results: int, next_token: str | None = None) -> Iterator[tuple[bytes, dict]]:
+        """
+        Like search_all, but yields each page as the raw response body together with its meta object, without
+        decoding the rest of the page. Pages are yielded as sent by the API, without twarc's __twarc metadata.
 
-@click.command()
-@click.option('-i', '--input', required=True, help="input file containing conversation ids, one per line")
-@click.option('-o', '--output', required=True, help="output jsonl file which will contain all conversation tweets")
-@click.option('-s', '--status', required=True, help="status file for recovering")
-@click.option('-l', '--log', required=True, help="error log file")
-@click.option('-t', '--bearer-token', required=True, help="Twitter academic bearer token to use")
-def fetch_conversations(input: str, output: str, status: str, log: str, bearer_token: str):
-    """Program to efficiently fetch full Twitter conversation threads given conversation ids"""
-    with open(input, 'rt') as cf:
-        queries = list(["conversation_id:" + " OR conversation_id:".join(conversation_ids) for conversation_ids in chunked([line.rstrip('\n') for line in cf.readlines()], 26)])
+        Args:
+            query: The query string to be passed directly to the Twitter API.
+            tweet_fields: Comma separated tweet fields to request.
+            max_results: The maximum number of results per request.
+            next_token: Token of the page to start from.
+
+        Returns:
+            generator[tuple[bytes, dict]]: a generator of (page, meta) for each paginated response.
+        """
+        params = self._prepare_params(query=query,
+                                      max_results=max_results,
+                                      start_time=datetime.datetime(2006, 3, 21, tzinfo=datetime.timezone.utc),
+                                      next_token=next_token,
+                                      expansions=None,
+                                      tweet_fields=tweet_fields,
+                                      user_fields=None,
+                                      media_fields=None,
+                                      poll_fields=None,
+                                      place_fields=None)
+        while True:
+            response = self.get("https://api.twitter.com/2/tweets/search/all", params=params)
+            page = response.content
+            meta = extract_meta(page)
+            # Keep to the search/all limit of one request per second, as search_all does.
+            time.sleep(1.05)
+            if meta.get('result_count', 0) > 0:
+                if b'\n' in page or b'\r' in page:
+                    # Raw line breaks in JSON can only be whitespace between tokens, so they can go.
+                    page = page.replace(b'\n', b'').replace(b'\r', b'')
+                yield page, meta
+            else:
+                twarc_log.info("Retrieved an empty page of results.")
+            if 'next_token' not in meta:
+                break
+            params['next_token'] = meta['next_token']
+
+
+def extract_meta(page: bytes, window: int = 4096) -> dict:
+    """Parse only the top level meta object of a raw API response. It is the last member of the response object, so
+    only the last window bytes of the page are searched. Falls back to parsing the whole page if it isn't found there."""
+    pos = page.rfind(b'"meta":', max(len(page) - window, 0))
+    if pos > 0 and page[pos - 1:pos] != b'\\':
+        try:
+            (meta, _) = json.JSONDecoder().raw_decode(page[pos + 7:].decode('utf-8').lstrip())
+            if isinstance(meta, dict):
+                return meta
+        except (JSONDecodeError, UnicodeDecodeError):
+            pass
+    return json.loads(page).get('meta', {})
+
+
+class ShardWriter:
+    """Appends pages to the output files of one shard, starting a new part file whenever the current one reaches
+    max_bytes (0 for no limit). An interrupted crawl continues appending to the last existing part."""
+
+    def __init__(self, output: str, shard: int | None, max_bytes: int):
+        self.output = output
+        self.shard = shard
+        self.max_bytes = max_bytes
+        self.part = 0
+        if shard is not None:
+            while exists(self.part_name(self.part + 1)):
+                self.part += 1
+        self.of = open(self.part_name(self.part), 'ab')
+
+    def part_name(self, part: int) -> str:
+        if self.shard is None:
+            return self.output
+        (root, ext) = splitext(self.output)
+        return f"{root}-{self.shard:03d}-{part:05d}{ext}"
+
+    def write(self, page: bytes):
+        self.of.write(page)
+        self.of.write(b"\n")
+        self.of.flush()
+        if self.max_bytes and self.of.tell() >= self.max_bytes:
+            self.of.close()
+            self.part += 1
+            self.of = open(self.part_name(self.part), 'ab')
+
+    def close(self):
+        self.of.close()
+
+
+def shard_of(query: str, shards: int) -> int:
+    return zlib.crc32(query.encode('utf-8')) % shards
+
+
+def read_status(status: str, queries: list[str]) -> tuple[int, str | None] | None:
+    """Returns the query index and next token to continue crawling queries from, or None if the crawl is complete"""
     if exists(status):
         with open(status, 'rt') as sf:
             parts = sf.readline().split('/')
-            if len(parts) == 1 and parts[0] == 'done.\n':
-                sys.exit("Status file reports crawl already complete.")
+            if len(parts) == 1 and parts[0].rstrip('\n') == 'done.':
+                return None
             elif len(parts) == 4:
                 start = int(parts[0])
                 next_token = parts[2] if parts[1] != "0" else None
                 assert queries[start] == parts[3].rstrip('\n'), f"{queries[start]} != {parts[3]}"
                 logging.warning(f"Continuing from page {parts[1]} of query {start}.")
-            else:
-                start = 0
-                next_token = None
-    else:
-        start = 0
-        next_token = None
+                return start, next_token
+    return 0, None
+
+
+def crawl(t: MyTwarc2, queries: list[str], status: str, writer: ShardWriter, lf: TextIO, raw: bool):
+    """Fetch all pages of queries into writer, recording progress in the status file after every page. If raw, pages are written as received from the API instead of being decoded and re-encoded."""
+    position = read_status(status, queries)
+    if position is None:
+        logging.warning(f"Status file {status} reports crawl already complete.")
+        return
+    (start, next_token) = position
     queries = queries[start:]
-    t = MyTwarc2(bearer_token=bearer_token)
-    with open(output, 'at') as of, open(status, 'at') as sf, open(log, 'at') as lf:
+    with open(status, 'at') as sf:
         for index, query in enumerate(tqdm(queries, unit="query", smoothing=0)):
             try:
-                for page_index, result_page in enumerate(tqdm(t.search_all(query, tweet_fields="attachments,author_id,conversation_id,created_at,entities,geo,id,in_reply_to_user_id,lang,public_metrics,text,possibly_sensitive,referenced_tweets,reply_settings,source,withheld", max_results=500, next_token=next_token), leave=False, unit="page")):
-                    json.dump(result_page, of)
-                    of.write("\n")
-                    of.flush()
+                if raw:
+                    pages = t.search_all_raw(query, tweet_fields=tweet_fields, max_results=500, next_token=next_token)
+                else:
+                    pages = ((json.dumps(result_page).encode('utf-8'), result_page.get('meta', {})) for result_page in t.search_all(query, tweet_fields=tweet_fields, max_results=500, next_token=next_token))
+                for page_index, (page, meta) in enumerate(tqdm(pages, leave=False, unit="page")):
+                    writer.write(page)
                     sf.truncate(0)
-                    if 'meta' in result_page and 'next_token' in result_page['meta']:
-                        sf.write(f"{start+index}/{page_index}/{result_page['meta']['next_token']}/{query}")
+                    if 'next_token' in meta:
+                        sf.write(f"{start+index}/{page_index}/{meta['next_token']}/{query}")
                     elif index + 1 < len(queries):
                         sf.write(f"{start + index + 1}/0//{queries[index + 1]}")
                     else:
@@ -86,7 +252,7 @@ def fetch_conversations(input: str, output: str, status: str, log: str, bearer_t
                 next_token = None
             except requests.exceptions.HTTPError as exception:
                 if exception.response.status_code == 403:
-                    logging.exception(f"Got 403 Unauthorized for {exception.response.url}.")
+                    logging.exception(f"Got 403 Unauthorized for {exception.response.url} with every bearer token.")
                     raise
                 logging.exception(
                     f"Too many request/connection exceptions processing {start + index}/{query}. Abandoning and moving on to the next one.")
@@ -101,6 +267,41 @@ def fetch_conversations(input: str, output: str, status: str, log: str, bearer_t
                 raise
 
 
+@profiled
+@click.command()
+@click.option('-i', '--input', required=True, help="input file containing conversation ids, one per line")
+@click.option('-o', '--output', required=True, help="output jsonl file which will contain all conversation tweets. With sharding, shard files are named after it as <output>-<shard>-<part>.jsonl")
+@click.option('-s', '--status', required=True, help="status file for recovering. With sharding, each shard has its own status file <status>.<shard>")
+@click.option('-l', '--log', required=True, help="error log file")
+@click.option('-t', '--bearer-token', required=True, multiple=True, help="Twitter academic bearer token to use. Give several times to spread requests over a pool of tokens")
+@click.option('--api-url', help="base URL of the API to use instead of https://api.twitter.com, e.g. a local mock server")
+@click.option('-n', '--shards', type=click.IntRange(min=1), default=1, show_default=True, help="number of output shards to route queries to by a hash of the query")
+@click.option('--shard', type=int, help="crawl only this shard, from 0 to --shards - 1, e.g. to crawl shards in separate processes")
+@click.option('--shard-size', default=0, show_default=True, help="start a new shard part file when the current one reaches this many bytes (0 for no limit)")
+@click.option('--raw', is_flag=True, help="write pages byte for byte as received from the API, decoding only their meta object")
+def fetch_conversations(input: str, output: str, status: str, log: str, bearer_token: list[str], api_url: str | None, shards: int, shard: int | None, shard_size: int, raw: bool):
+    """Program to efficiently fetch full Twitter conversation threads given conversation ids"""
+    if shard is not None and not 0 <= shard < shards:
+        raise click.BadParameter(f"{shard} is not a shard of {shards} shards, shards are numbered from 0 to {shards - 1}.", param_hint="'--shard'")
+    with open(input, 'rt') as cf:
+        queries = list(["conversation_id:" + " OR conversation_id:".join(conversation_ids) for conversation_ids in chunked([line.rstrip('\n') for line in cf.readlines()], 26)])
+    t = MyTwarc2(list(bearer_token), api_url)
+    with open(log, 'at') as lf:
+        if shards == 1 and shard_size == 0:
+            writer = ShardWriter(output, None, 0)
+            try:
+                crawl(t, queries, status, writer, lf, raw)
+            finally:
+                writer.close()
+            return
+        for current_shard in range(shards) if shard is None else [shard]:
+            logging.info(f"Crawling shard {current_shard + 1}/{shards}.")
+            writer = ShardWriter(output, current_shard, shard_size)
+            try:
+                crawl(t, [query for query in queries if shard_of(query, shards) == current_shard], f"{status}.{current_shard}", writer, lf, raw)
+            finally:
+                writer.close()
+
+
 if __name__ == '__main__':
     fetch_conversations()
-        
@@ -0,0 +1,82 @@
+"""A local stand-in for the search/all endpoint of the Twitter API, to point fetch_conversation_tweets.py at with
+--api-url. Every bearer token has a budget of requests per rate limit window. Responses carry the x-rate-limit-*
+headers of the API, and requests beyond the budget get 429 Too Many Requests until the window resets."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockApi:
+    """Serves pages pages of one tweet each for any query. Times are taken from clock, which needs a time() like the
+    time module, so that tests can pass a fake clock shared with the client."""
+
+    def __init__(self, budgets: dict[str, int], pages: int = 1, window: float = 900, clock=time):
+        self.budgets = budgets
+        self.pages = pages
+        self.window = window
+        self.clock = clock
+        self.remaining = dict(budgets)
+        self.reset = {token: 0.0 for token in budgets}
+        # The (token, status) of every request received. Tokens without a budget get 403 Forbidden.
+        self.requests: list[tuple[str, int]] = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def respond(self, token: str, page: int) -> tuple[int, dict[str, str], dict]:
+        """Returns the status, rate limit headers and body of a request for a page with a token"""
+        with self.lock:
+            now = self.clock.time()
+            if self.reset[token] <= now:
+                self.remaining[token] = self.budgets[token]
+                self.reset[token] = now + self.window
+            status = 200 if self.remaining[token] > 0 else 429
+            self.remaining[token] = max(self.remaining[token] - 1, 0)
+            self.requests.append((token, status))
+            headers = {'x-rate-limit-limit': str(self.budgets[token]),
+                       'x-rate-limit-remaining': str(self.remaining[token]),
+                       'x-rate-limit-reset': str(int(self.reset[token]))}
+        if status == 429:
+            return status, headers, dict(title="Too Many Requests", status=429)
+        meta = dict(result_count=1, newest_id=str(page + 1), oldest_id=str(page + 1))
+        if page + 1 < self.pages:
+            meta['next_token'] = str(page + 1)
+        return status, headers, dict(data=[dict(id=str(page + 1), conversation_id="1", text=f"page {page}")], meta=meta)
+
+    def handler(self) -> type[BaseHTTPRequestHandler]:
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+                if token not in api.budgets:
+                    with api.lock:
+                        api.requests.append((token, 403))
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                params = parse_qs(urlparse(self.path).query)
+                (status, headers, body) = api.respond(token, int(params.get('next_token', ['0'])[0]))
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for (header, value) in headers.items():
+                    self.send_header(header, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self) -> 'MockApi':
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,86 @@
+import json
+
+import pytest
+import requests
+
+import fetch_conversation_tweets
+from fetch_conversation_tweets import MyTwarc2
+from mock_api import MockApi
+
+
+class FakeClock:
+    """Stands in for the time module of the fetcher, so that sleeping until a rate limit resets takes no time"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+        self.sleeps: list[float] = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(fetch_conversation_tweets, 'time', clock)
+    return clock
+
+
+def fetch(api: MockApi, tokens: list[str]) -> list[str]:
+    t = MyTwarc2(tokens, api.url)
+    return [json.loads(page)['data'][0]['text'] for (page, _) in t.search_all_raw("conversation_id:1", tweet_fields="id", max_results=500)]
+
+
+def test_rotates_tokens_before_waiting(clock):
+    with MockApi({"a": 1, "b": 1}, pages=3, window=900, clock=clock) as api:
+        assert fetch(api, ["a", "b"]) == ["page 0", "page 1", "page 2"]
+    # The second token is used as soon as the first reports its budget spent, and once both are spent the pool waits
+    # for the earliest reset instead of running into 429s.
+    assert api.requests == [("a", 200), ("b", 200), ("a", 200)]
+    assert any(seconds >= 900 for seconds in clock.sleeps)
+
+
+def test_backs_off_token_on_429(clock):
+    with MockApi({"a": 0, "b": 2}, pages=2, clock=clock) as api:
+        assert fetch(api, ["a", "b"]) == ["page 0", "page 1"]
+    # The rate limited token is not retried until its window resets.
+    assert api.requests == [("a", 429), ("b", 200), ("b", 200)]
+
+
+def test_waits_for_reset_with_single_token(clock):
+    with MockApi({"a": 1}, pages=1, window=60, clock=clock) as api:
+        # The budget of the token was spent before the crawl started.
+        api.remaining["a"] = 0
+        api.reset["a"] = clock.now + 60
+        assert fetch(api, ["a"]) == ["page 0"]
+    assert api.requests == [("a", 429), ("a", 200)]
+    assert any(seconds >= 60 for seconds in clock.sleeps)
+
+
+def test_quarantines_forbidden_token(clock):
+    with MockApi({"a": 5}, pages=2, clock=clock) as api:
+        t = MyTwarc2(["revoked", "a"], api.url)
+        assert [json.loads(page)['data'][0]['text'] for (page, _) in t.search_all_raw("conversation_id:1", tweet_fields="id", max_results=500)] == ["page 0", "page 1"]
+    # The crawl goes on with the remaining token and never tries the forbidden one again.
+    assert api.requests == [("revoked", 403), ("a", 200), ("a", 200)]
+    assert [credential.quarantined for credential in t.credentials.credentials] == [True, False]
+
+
+def test_stops_when_all_tokens_forbidden(clock, tmp_path):
+    status = tmp_path / "status.txt"
+    output = tmp_path / "out.jsonl"
+    with MockApi({}, clock=clock) as api, open(tmp_path / "errors.log", "w") as lf:
+        t = MyTwarc2(["revoked", "expired"], api.url)
+        writer = fetch_conversation_tweets.ShardWriter(str(output), None, 0)
+        with pytest.raises(requests.exceptions.HTTPError) as exception:
+            fetch_conversation_tweets.crawl(t, ["conversation_id:1", "conversation_id:2"], str(status), writer, lf, raw=True)
+        writer.close()
+    assert exception.value.response.status_code == 403
+    assert api.requests == [("revoked", 403), ("expired", 403)]
+    # Nothing is recorded as fetched, so the crawl continues from the first query once there are working tokens.
+    assert output.read_bytes() == b""
+    assert fetch_conversation_tweets.read_status(str(status), ["conversation_id:1", "conversation_id:2"]) == (0, None)
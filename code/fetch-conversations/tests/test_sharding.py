@@ -0,0 +1,12 @@
+from click.testing import CliRunner
+
+from fetch_conversation_tweets import fetch_conversations
+
+
+def test_rejects_shard_out_of_range(tmp_path):
+    (tmp_path / "ids.txt").write_text("1\n")
+    args = ['-i', str(tmp_path / "ids.txt"), '-o', str(tmp_path / "out.jsonl"), '-s', str(tmp_path / "status"), '-l', str(tmp_path / "errors.log"), '-t', "token", '--shards', "4"]
+    result = CliRunner().invoke(fetch_conversations, args + ['--shard', "4"])
+    assert result.exit_code == 2
+    assert "--shard" in result.output
+    assert not (tmp_path / "status.4").exists()